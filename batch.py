@@ -0,0 +1,133 @@
+import os
+import argparse
+import multiprocessing
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+
+def process_scene(scene_id, raw_data_path, base_path, output_dir, args):
+    """
+    Preprocess and infer one downloaded scene with the resumable pipeline, in its own folders.
+
+    :return: path of the scene's stitched mosaic
+    """
+    import torch
+    from pipeline import run_scene
+
+    if args.threads_per_scene:
+        torch.set_num_threads(args.threads_per_scene)
+
+    work_dir = os.path.join(base_path, "data", "sentinel", scene_id)
+    return run_scene(raw_data_path, work_dir, os.path.join(output_dir, scene_id), args)
+
+
+def run_batch(scenes, download, process, download_workers=2, scene_workers=1):
+    """
+    Download scenes concurrently and feed each one, as soon as it is on disk, to a bounded pool
+    of worker processes running preprocessing + inference. A failing scene is reported and does
+    not stop the others.
+
+    :param scenes: scene ids
+    :param download: callable(scene) -> raw data path, run in threads
+    :param process: picklable callable(scene, raw data path) -> result, run in worker processes
+    :param download_workers: number of concurrent scene downloads
+    :param scene_workers: number of scenes processed at the same time
+    :return: ({scene: result}, {scene: exception})
+    """
+    results, failures = {}, {}
+    # Spawned workers do not inherit CUDA/thread-pool state from this process
+    context = multiprocessing.get_context("spawn")
+
+    with ThreadPoolExecutor(max_workers=download_workers) as downloads, \
+            ProcessPoolExecutor(max_workers=scene_workers, mp_context=context) as workers:
+        pending = {downloads.submit(download, scene): scene for scene in scenes}
+        processing = {}
+
+        for future in as_completed(pending):
+            scene = pending[future]
+            try:
+                raw_data_path = future.result()
+            except Exception as e:
+                print(f"Download of {scene} failed: {e}")
+                failures[scene] = e
+                continue
+            print(f"Downloaded {scene}, queued for processing")
+            processing[workers.submit(process, scene, raw_data_path)] = scene
+
+        for future in as_completed(processing):
+            scene = processing[future]
+            try:
+                results[scene] = future.result()
+                print(f"Processed {scene}: {results[scene]}")
+            except Exception as e:
+                print(f"Processing of {scene} failed: {e}")
+                failures[scene] = e
+
+    return results, failures
+
+
+def main(args):
+    import downloader
+    from pystac_client import Client
+
+    s3 = downloader.connect_s3()
+    client = Client.open(downloader.STAC_URL)
+
+    print(f"Searching Sentinel-2 imagery ({args.start_date} to {args.end_date}) with cloud cover "
+          f"<={args.max_cloud_cover}%")
+    items = downloader.search_sentinel_items(client, downloader.get_aoi_bbox(args.aoi), args.start_date,
+                                             args.end_date, args.max_cloud_cover, downloader.PRODUCT_TYPE)
+    if args.select == "cover":
+        items = downloader.select_covering_items(items, downloader.get_aoi_geometry(args.aoi))
+    if not items:
+        print("No matching Sentinel-2 products found.")
+        return
+
+    print(f"{len(items)} scenes selected")
+    items_by_id = {item.id: item for item in items}
+    raw_dir = os.path.join(args.base_path, "Sentinel-2")
+
+    def _download(scene_id):
+        # Downloads run side by side, so each one gets a share of the connection pool
+        return downloader.download_item(s3, items_by_id[scene_id], raw_dir,
+                                        workers=max(1, downloader.DOWNLOAD_WORKERS // args.download_workers))
+
+    process = partial(process_scene, base_path=args.base_path, output_dir=args.output_dir, args=args)
+    results, failures = run_batch(list(items_by_id), _download, process, download_workers=args.download_workers,
+                                  scene_workers=args.scene_workers)
+    print(f"Batch finished: {len(results)} scenes processed, {len(failures)} failed")
+
+    if args.temporal_state and results:
+        from temporal import TemporalState
+
+        # Revisits enter the history in acquisition order, whatever order they finished in
+        scenes = sorted(results, key=lambda scene_id: items_by_id[scene_id].datetime)
+        state = TemporalState.open(args.temporal_state, reference_path=results[scenes[0]], aoi_path=args.aoi)
+        for scene_id in scenes:
+            state.ingest(scene_id, items_by_id[scene_id].datetime.isoformat(), results[scene_id],
+                         change_path=os.path.join(args.output_dir, scene_id, "change.tif"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Search, download, preprocess and infer every matching scene.")
+    parser.add_argument("--weights", required=True, help="Path to model weights (.pth), or the exported model for --engine.")
+    parser.add_argument("--engine", default="eager", help="Runtime backend, see engines.py.")
+    parser.add_argument("--aoi", default="boundary.geojson", help="AOI used for the search (and the cover selection).")
+    parser.add_argument("--start_date", default="2021-07-01", help="Start of the search period.")
+    parser.add_argument("--end_date", default="2021-09-30", help="End of the search period.")
+    parser.add_argument("--max_cloud_cover", type=float, default=3, help="Maximum cloud cover in percent.")
+    parser.add_argument("--select", choices=["all", "cover"], default="cover",
+                        help="Every matching scene, or the least cloudy scenes covering the AOI.")
+    parser.add_argument("--base_path", default=os.getcwd(), help="Folder for Sentinel-2/ downloads and data/.")
+    parser.add_argument("--output_dir", default="outputs", help="Per-scene inference and stitched outputs.")
+    parser.add_argument("--download_workers", type=int, default=2, help="Scenes downloaded at the same time.")
+    parser.add_argument("--scene_workers", type=int, default=1, help="Scenes processed at the same time.")
+    parser.add_argument("--threads_per_scene", type=int, help="Torch threads per scene worker.")
+    parser.add_argument("--patch_size", type=int, default=512, help="Patch size in pixels.")
+    parser.add_argument("--overlap", type=int, default=10, help="Patch overlap in pixels.")
+    parser.add_argument("--batch_size", type=int, default=4, help="Batch size for inference.")
+    parser.add_argument("--blend", action="store_true", help="Blend probability patches when stitching.")
+    parser.add_argument("--checksum", action="store_true", help="Detect changes by content hash instead of size + mtime.")
+    parser.add_argument("--temporal_state", help="Add the processed scenes to this temporal state and write change rasters.")
+
+    main(parser.parse_args())
@@ -0,0 +1,236 @@
+import os
+import json
+import time
+import shutil
+import argparse
+import platform
+import subprocess
+import tracemalloc
+from functools import partial
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+from util import re_projection, combine_bands, split_and_save_patches
+from instrumentation import peak_rss_mb, sample_rss
+
+BAND_LIST = ["02", "03", "04", "08"]
+
+# Typical L2A reflectances (x 10000) of water and land for B02, B03, B04, B08
+WATER_REFLECTANCE = {"02": 700, "03": 900, "04": 600, "08": 200}
+LAND_REFLECTANCE = {"02": 500, "03": 800, "04": 900, "08": 3000}
+
+
+def make_synthetic_scene(scene_dir, size=2048, pixel_size=10, seed=0):
+    """
+    Write a synthetic Sentinel-2 10m scene: one JP2 per band, in UTM like the real products,
+    with a wavy coastline between a water half and a land half plus sensor-like noise.
+    Existing band files are reused, so repeated runs only pay for the encoding once.
+
+    :param scene_dir: output folder, laid out like IMG_DATA (R10m/T33TEST_B02_10m.jp2, ...)
+    :param size: scene width and height in pixels
+    :param pixel_size: pixel size in metres
+    :param seed: random seed of the noise
+    :return: list of band paths, in BAND_LIST order
+    """
+    os.makedirs(os.path.join(scene_dir, "R10m"), exist_ok=True)
+    rows, cols = np.mgrid[0:size, 0:size]
+    water = cols < size / 2 + size / 8 * np.sin(rows / size * 4 * np.pi)
+    rng = np.random.default_rng(seed)
+
+    band_paths = []
+    for b in BAND_LIST:
+        path = os.path.join(scene_dir, "R10m", f"T33TEST_B{b}_10m.jp2")
+        band_paths.append(path)
+        if os.path.isfile(path):
+            continue
+
+        data = np.where(water, WATER_REFLECTANCE[b], LAND_REFLECTANCE[b]).astype('float32')
+        data += rng.normal(0, 50, data.shape)
+        with rasterio.open(path, 'w', driver='JP2OpenJPEG', height=size, width=size, count=1, dtype='uint16',
+                           crs='EPSG:32633', transform=from_origin(500000, 4600000, pixel_size, pixel_size)) as dst:
+            dst.write(np.clip(data, 1, 10000).astype('uint16'), 1)
+
+    return band_paths
+
+
+def time_stage(results, name, fn, megabytes=None, items=None, trace_memory=False):
+    """
+    Run and time one stage, appending its metrics to `results`.
+
+    The timed run only samples the resident memory; with trace_memory the stage is run a second
+    time under tracemalloc, whose bookkeeping would otherwise slow down allocation-heavy stages.
+
+    :param results: list collecting the stage reports
+    :param name: stage name
+    :param fn: callable running the stage (twice with trace_memory); may return the number of
+               items it processed
+    :param megabytes: data volume the stage processes, for MB/s
+    :param items: number of items (patches) processed, if fn does not return it
+    :param trace_memory: also report the peak of the Python/numpy allocations of the stage
+    :return: the return value of fn
+    """
+    with sample_rss() as rss:
+        start = time.perf_counter()
+        value = fn()
+        seconds = time.perf_counter() - start
+
+    if items is None and isinstance(value, int):
+        items = value
+
+    report = {
+        "stage": name,
+        "seconds": round(seconds, 4),
+        # How far the stage raised the resident memory above where it started
+        "rss_delta_mb": round(rss["peak"] - rss["start"], 1),
+        # High-water mark of the whole process so far
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+    if trace_memory:
+        tracemalloc.start()
+        fn()
+        _, traced_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        report["peak_traced_mb"] = round(traced_peak / 1024 ** 2, 1)
+    if megabytes is not None:
+        report["mb"] = round(megabytes, 2)
+        report["mb_per_s"] = round(megabytes / seconds, 2)
+    if items is not None:
+        report["patches"] = items
+        report["patches_per_s"] = round(items / seconds, 2)
+    results.append(report)
+
+    print(f"{name}: {seconds:.2f}s" + "".join(f", {k} {report[k]}" for k in ("mb_per_s", "patches_per_s", "rss_delta_mb")
+                                               if k in report))
+    return value
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(work_dir, size=2048, patch_size=512, overlap=10, batch_size=4, max_patches=None,
+                  loader_workers=0, trace_memory=False):
+    """
+    Time every stage of the pipeline on a synthetic scene.
+
+    :param work_dir: folder for the synthetic scene and all intermediate outputs
+    :param size: scene width and height in pixels
+    :param patch_size: patch size in pixels
+    :param overlap: patch overlap in pixels
+    :param batch_size: inference batch size
+    :param max_patches: limit the patches loaded/inferred (a CPU forward pass is the slowest stage)
+    :param loader_workers: DataLoader worker processes
+    :param trace_memory: run every stage a second time under tracemalloc, see time_stage
+    :return: benchmark report (dict)
+    """
+    import torch
+    from torch.utils.data import DataLoader, Subset
+
+    from dataloader import SentinelDataset
+    from inference import run_inference
+    from model_utils import load_model
+    from stitching import stitch_tiff_patches
+
+    band_paths = make_synthetic_scene(os.path.join(work_dir, "scene"), size=size)
+    band_mb = size * size * 2 / 1024 ** 2
+    results = []
+    stage = partial(time_stage, results, trace_memory=trace_memory)
+
+    reprojected = []
+    os.makedirs(os.path.join(work_dir, "reprojection"), exist_ok=True)
+    for b, path in zip(BAND_LIST, band_paths):
+        out_path = os.path.join(work_dir, "reprojection", os.path.basename(path).replace(".jp2", "_wgs84.tif"))
+        stage(f"re_projection_B{b}", lambda: re_projection(path, out_path), megabytes=band_mb)
+        reprojected.append(out_path)
+
+    merged = os.path.join(work_dir, "combined_4band.tif")
+    stage("combine_bands", lambda: combine_bands(reprojected, merged), megabytes=band_mb * len(reprojected))
+
+    patch_dir = os.path.join(work_dir, "patches")
+    inference_dir = os.path.join(work_dir, "inference_outputs")
+    # Outputs of an earlier run with other settings must not be loaded or stitched
+    for path in (patch_dir, inference_dir):
+        shutil.rmtree(path, ignore_errors=True)
+
+    num_patches = stage("split_and_save_patches",
+                        lambda: split_and_save_patches(merged, patch_dir, patch_size=patch_size, overlap=overlap,
+                                                       bands=[1, 2, 3, 4]),
+                        megabytes=os.path.getsize(merged) / 1024 ** 2)
+
+    dataset = SentinelDataset(patch_dir, raw=True)
+    if max_patches is not None:
+        dataset = Subset(dataset, range(min(max_patches, len(dataset))))
+    patch_mb = len(dataset) * len(BAND_LIST) * patch_size ** 2 * 2 / 1024 ** 2
+
+    def _load():
+        loader = DataLoader(dataset, batch_size=batch_size, num_workers=loader_workers)
+        return sum(len(batch['image']) for batch in loader)
+
+    stage("SentinelDataset", _load, megabytes=patch_mb)
+
+    # Randomly initialized weights: the timing does not depend on what the model learned
+    torch.manual_seed(0)
+    weights = os.path.join(work_dir, "random_weights.pth")
+    torch.save({}, weights)
+    model = load_model(weights)
+    loader = DataLoader(dataset, batch_size=batch_size, num_workers=loader_workers)
+    stage("run_inference", lambda: run_inference(model, loader, inference_dir, "cpu"), megabytes=patch_mb)
+
+    mosaic = os.path.join(work_dir, "stitched_output.tif")
+    stage("stitch_tiff_patches", lambda: stitch_tiff_patches(inference_dir, mosaic),
+          megabytes=len(dataset) * patch_size ** 2 / 1024 ** 2, items=len(dataset))
+
+    return {
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "cpu_count": os.cpu_count(),
+        "torch_threads": torch.get_num_threads(),
+        "config": {"size": size, "patch_size": patch_size, "overlap": overlap, "batch_size": batch_size,
+                   "max_patches": max_patches, "loader_workers": loader_workers, "patches": num_patches,
+                   "trace_memory": trace_memory},
+        "stages": results,
+    }
+
+
+def compare(report, baseline):
+    """Print the time of every stage relative to a baseline report (e.g. from an earlier commit)."""
+    before = {stage["stage"]: stage for stage in baseline["stages"]}
+    print(f"Compared with {baseline.get('commit') or 'baseline'}:")
+    for stage in report["stages"]:
+        if stage["stage"] in before:
+            ratio = stage["seconds"] / max(before[stage["stage"]]["seconds"], 1e-9)
+            print(f"  {stage['stage']}: {before[stage['stage']]['seconds']:.2f}s -> {stage['seconds']:.2f}s "
+                  f"(x{ratio:.2f})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark every pipeline stage on a synthetic Sentinel-2 scene.")
+    parser.add_argument("--work_dir", default="benchmark_data", help="Folder for the synthetic scene and outputs.")
+    parser.add_argument("--size", type=int, default=2048, help="Scene width/height in pixels (a full tile is 10980).")
+    parser.add_argument("--patch_size", type=int, default=512, help="Patch size in pixels.")
+    parser.add_argument("--overlap", type=int, default=10, help="Patch overlap in pixels.")
+    parser.add_argument("--batch_size", type=int, default=4, help="Inference batch size.")
+    parser.add_argument("--max_patches", type=int, help="Limit the patches loaded and inferred.")
+    parser.add_argument("--loader_workers", type=int, default=0, help="DataLoader worker processes.")
+    parser.add_argument("--trace_memory", action="store_true", help="Rerun every stage under tracemalloc for its allocation peak.")
+    parser.add_argument("--output", default="benchmark.json", help="JSON report path.")
+    parser.add_argument("--compare", help="Earlier JSON report to compare against.")
+
+    args = parser.parse_args()
+    report = run_benchmark(args.work_dir, size=args.size, patch_size=args.patch_size, overlap=args.overlap,
+                           batch_size=args.batch_size, max_patches=args.max_patches,
+                           loader_workers=args.loader_workers, trace_memory=args.trace_memory)
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Benchmark report saved to: {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
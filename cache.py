@@ -0,0 +1,91 @@
+import os
+import hashlib
+import numpy as np
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """
+    Content digest of a file (e.g. the model weights), read in chunks
+
+    :param path: file path
+    :param chunk_size: read size in bytes
+    :return: hex digest
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class PredictionCache:
+    """
+    On-disk, content-addressed cache of patch predictions.
+
+    Entries are keyed by a hash of the input patch pixels together with the model digest (weights
+    file + anything else that changes the output), so rerunning on overlapping scenes or revisited
+    tiles only recomputes patches whose pixels or model changed. Reads refresh an entry's mtime and
+    the least recently used entries are evicted once the cache grows beyond max_bytes.
+    """
+
+    def __init__(self, cache_dir, model_digest, max_bytes=2 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.model_digest = model_digest
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self.size = sum(entry.stat().st_size for entry in os.scandir(cache_dir) if entry.name.endswith(".npy"))
+
+    def key(self, patch, kind="pred"):
+        """Cache key of an input patch (any array) for the given kind of output."""
+        patch = np.ascontiguousarray(patch)
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(f"{self.model_digest}:{kind}:{patch.dtype.str}:{patch.shape}".encode())
+        digest.update(patch.data)
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.npy")
+
+    def get(self, key):
+        """Cached prediction for the key, or None."""
+        path = self._path(key)
+        try:
+            pred = np.load(path)
+            os.utime(path)  # mark as recently used
+        except (FileNotFoundError, ValueError, OSError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return pred
+
+    def put(self, key, pred):
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, pred)
+        # Atomic, so concurrent workers sharing the cache never see partial entries
+        os.replace(tmp_path, path)
+        self.size += os.path.getsize(path)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """Drop least recently used entries until the cache is back under 90% of max_bytes."""
+        entries = sorted((entry.stat().st_mtime, entry.stat().st_size, entry.path)
+                         for entry in os.scandir(self.cache_dir) if entry.name.endswith(".npy"))
+        self.size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self.size <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass  # already evicted by another worker
+            self.size -= size
+
+    def report(self):
+        total = self.hits + self.misses
+        rate = self.hits / total if total else 0.
+        print(f"Prediction cache: {self.hits} hits, {self.misses} misses ({rate:.1%} hit rate)")
@@ -0,0 +1,54 @@
+import sys
+import argparse
+import importlib
+
+# Subcommand -> (module, entry point taking the parsed arguments, help). The module is only
+# imported when its subcommand runs (or prints its help), so `python cli.py --help` does not pay
+# for torch, rasterio, geopandas or boto3, and each subcommand only loads what it needs.
+COMMANDS = {
+    "download": ("downloader", "main", "Search the STAC catalogue and download a matching Sentinel-2 product."),
+    "preprocess": ("data_preprocessing", "main", "Reproject, merge and patch the Sentinel-2 10m bands."),
+    "infer": ("main", "run", "Run inference on patches or a merged scene and stitch the predictions."),
+    "export": ("engines", "main", "Export the model to TorchScript/ONNX, optionally int8-quantized."),
+    "stitch": ("stitching", "run", "Stitch prediction patches into a single mosaic."),
+    "coastline": ("coastline", "run", "Extract coastline vectors from a stitched water/land mask."),
+    "temporal": ("temporal", "run", "Track the masks of successive revisits and write change rasters."),
+}
+
+
+def build_parser(command=None):
+    """
+    Parser with every subcommand; only `command`, if given, gets its options, which requires
+    importing its module.
+
+    :param command: subcommand whose options are added
+    :return: argparse.ArgumentParser
+    """
+    parser = argparse.ArgumentParser(prog="cli.py", description="Sentinel-2 coastline segmentation pipeline.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for name, (module, _, help_text) in COMMANDS.items():
+        subparser = subparsers.add_parser(name, help=help_text, description=help_text)
+        if name == command:
+            add_arguments = getattr(importlib.import_module(module), "add_arguments", None)
+            if add_arguments is not None:
+                add_arguments(subparser)
+    return parser
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    # The subcommand is the first positional argument
+    command = next((arg for arg in argv if not arg.startswith("-")), None)
+    args = build_parser(command).parse_args(argv)
+
+    module_name, entry_point, _ = COMMANDS[args.command]
+    module = importlib.import_module(module_name)
+    if hasattr(module, "add_arguments"):
+        getattr(module, entry_point)(args)
+    else:
+        # e.g. the download, configured by the constants at the top of downloader.py
+        getattr(module, entry_point)()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import rasterio
+import shapely
+from rasterio.windows import Window
+
+WATER_LABEL = 1
+LAND_LABEL = 0
+
+
+def _boundary_edges(block, water_label=WATER_LABEL, land_label=LAND_LABEL):
+    """
+    Pixel edges separating a water pixel from a land pixel (edges towards nodata are not
+    coastline), as segments in the block's pixel coordinates.
+
+    :param block: label array, HxW
+    :return: float64 array of segments, Nx2x2 ((x0, y0), (x1, y1))
+    """
+    water = block == water_label
+    land = block == land_label
+
+    # Horizontal neighbours (r, c) / (r, c + 1) share the vertical edge x = c + 1
+    rows, cols = np.nonzero((water[:, :-1] & land[:, 1:]) | (land[:, :-1] & water[:, 1:]))
+    vertical = np.stack([np.stack([cols + 1, rows], axis=-1), np.stack([cols + 1, rows + 1], axis=-1)], axis=1)
+
+    # Vertical neighbours (r, c) / (r + 1, c) share the horizontal edge y = r + 1
+    rows, cols = np.nonzero((water[:-1] & land[1:]) | (land[:-1] & water[1:]))
+    horizontal = np.stack([np.stack([cols, rows + 1], axis=-1), np.stack([cols + 1, rows + 1], axis=-1)], axis=1)
+
+    return np.concatenate([vertical, horizontal]).astype('float64')
+
+
+def _block_lines(mask_path, window, water_label, land_label):
+    """
+    Coastline pieces of one block, merged into lines in mosaic pixel coordinates.
+
+    The block is read with a one pixel halo on its right and bottom side, so it owns every edge
+    between its own pixels and their right/lower neighbours: no edge is found twice or missed
+    along the seams, and pieces of neighbouring blocks meet at identical vertices.
+    """
+    with rasterio.open(mask_path) as src:
+        halo = Window(window.col_off, window.row_off,
+                      min(window.width + 1, src.width - window.col_off),
+                      min(window.height + 1, src.height - window.row_off))
+        block = src.read(1, window=halo)
+
+    segments = _boundary_edges(block, water_label, land_label)
+    if not len(segments):
+        return []
+
+    # Edges on the halo's far side belong to the neighbouring block
+    inside = ~(((segments[:, :, 0] > window.width) | (segments[:, :, 1] > window.height)).any(axis=1))
+    segments = segments[inside] + [window.col_off, window.row_off]
+    if not len(segments):
+        return []
+
+    merged = shapely.line_merge(shapely.multilinestrings(shapely.linestrings(segments)))
+    return list(shapely.get_parts(merged))
+
+
+def extract_coastline(mask_path, output_path, block_size=2048, workers=None, simplify=1.0, min_length=0,
+                      water_label=WATER_LABEL, land_label=LAND_LABEL):
+    """
+    Turn a stitched water/land mask into simplified coastline vectors.
+
+    The mask is processed block by block in worker processes, so no process holds more than
+    one block of the raster; the block pieces are joined across the seams by merging lines at
+    their shared end vertices, then simplified and georeferenced.
+
+    :param mask_path: label GeoTIFF (e.g. stitched_output.tif)
+    :param output_path: .gpkg (GeoPackage) or .geojson output
+    :param block_size: block size in pixels
+    :param workers: number of worker processes (default: CPU count)
+    :param simplify: Douglas-Peucker tolerance in pixels (0 keeps the pixel staircase)
+    :param min_length: drop lines shorter than this many pixels (specks of noise)
+    :param water_label: label of water pixels
+    :param land_label: label of land pixels
+    :return: number of coastline features written
+    """
+    import geopandas as gpd
+
+    with rasterio.open(mask_path) as src:
+        width, height = src.width, src.height
+        transform, crs = src.transform, src.crs
+
+    windows = [Window(col, row, min(block_size, width - col), min(block_size, height - row))
+               for row in range(0, height, block_size)
+               for col in range(0, width, block_size)]
+
+    pieces = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_block_lines, mask_path, window, water_label, land_label) for window in windows]
+        for future in futures:
+            pieces.extend(future.result())
+
+    lines = []
+    if pieces:
+        # Seam reconciliation: pieces ending on a block border share their end vertex
+        lines = list(shapely.get_parts(shapely.line_merge(shapely.multilinestrings(pieces))))
+    if min_length:
+        lines = [line for line in lines if line.length >= min_length]
+    if simplify:
+        lines = list(shapely.simplify(lines, simplify, preserve_topology=True))
+
+    def _to_map(coords):
+        cols, rows = coords[:, 0], coords[:, 1]
+        return np.stack([transform.a * cols + transform.b * rows + transform.c,
+                         transform.d * cols + transform.e * rows + transform.f], axis=-1)
+
+    lengths = [line.length for line in lines]
+    lines = list(shapely.transform(lines, _to_map)) if lines else []
+
+    gdf = gpd.GeoDataFrame({"length_px": lengths}, geometry=lines, crs=crs)
+    driver = "GPKG" if output_path.lower().endswith(".gpkg") else "GeoJSON"
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    gdf.to_file(output_path, driver=driver)
+
+    print(f"{len(lines)} coastline features saved to: {output_path}")
+    return len(lines)
+
+
+def add_arguments(parser):
+    """Options shared by `python coastline.py` and `python cli.py coastline`."""
+    parser.add_argument("mask_path", type=str, help="Stitched label GeoTIFF (e.g. outputs/stitched_output.tif).")
+    parser.add_argument("output_path", type=str, help="Output .gpkg or .geojson.")
+    parser.add_argument("--block_size", type=int, default=2048, help="Block size in pixels.")
+    parser.add_argument("--workers", type=int, help="Worker processes (default: CPU count).")
+    parser.add_argument("--simplify", type=float, default=1.0, help="Simplification tolerance in pixels.")
+    parser.add_argument("--min_length", type=float, default=0, help="Drop lines shorter than this many pixels.")
+    return parser
+
+
+def run(args):
+    extract_coastline(args.mask_path, args.output_path, block_size=args.block_size, workers=args.workers,
+                      simplify=args.simplify, min_length=args.min_length)
+
+
+if __name__ == "__main__":
+    parser = add_arguments(argparse.ArgumentParser(description="Extract coastline vectors from a stitched water/land mask."))
+    run(parser.parse_args())
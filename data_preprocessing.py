@@ -1,57 +1,90 @@
 
 import os
-import rasterio
 from pathlib import Path
-from util import find_img_data_folder, re_projection, combine_bands, crop_image, split_and_save_patches
+import argparse
+from util import find_img_data_folder, batch_re_projection, combine_bands, crop_image, split_and_save_patches, \
+    reproject_merge_clip
 import glob
 
 
-base_path = Path(os.getcwd())
-raw_data_path = os.path.join(base_path, "Sentinel-2")
-aoi_path = os.path.join(base_path, "boundary.geojson")
+def main(args):
+    base_path = Path(os.getcwd())
+    raw_data_path = os.path.join(base_path, "Sentinel-2")
+    aoi_path = os.path.join(base_path, "boundary.geojson")
+    # Only patch (and later infer/stitch) the part of the tile around the AOI
+    patch_aoi_path = aoi_path if args.aoi_patches else None
 
-b_path = os.path.join(base_path, "data/sentinel")
+    b_path = os.path.join(base_path, "data/sentinel")
 
-# Setting up different directories for the data
-(base_path / 'data' / 'sentinel').mkdir(exist_ok=True, parents=True)
-(base_path / 'data' /'sentinel' / 'reprojection').mkdir(exist_ok=True, parents=True)
-reproject_path = os.path.join(b_path, 'reprojection')
+    # Setting up different directories for the data
+    (base_path / 'data' / 'sentinel').mkdir(exist_ok=True, parents=True)
+    (base_path / 'data' /'sentinel' / 'reprojection').mkdir(exist_ok=True, parents=True)
+    reproject_path = os.path.join(b_path, 'reprojection')
 
-merge_output_path = os.path.join(b_path, "combined_4band.tif")
-# crop_aoi_path = os.path.join(b_path, "aoi_imagery.tif")
-output_dir = os.path.join(b_path, "patches")
+    merge_output_path = os.path.join(b_path, "combined_4band.tif")
+    # crop_aoi_path = os.path.join(b_path, "aoi_imagery.tif")
+    output_dir = os.path.join(b_path, "patches")
 
-band_list = ["02", "03", "04", "08"] # processing the 10m bands
-all_bands_path = []
+    band_list = ["02", "03", "04", "08"] # processing the 10m bands
+    all_bands_path = []
+    to_reproject = []
 
-for b in band_list:
+    img_data_path = find_img_data_folder(raw_data_path)
 
-    print("Working on band {}".format(b))
+    if args.fused:
+        # Warp the raw JP2 bands straight into one tiled COG, without per-band intermediates
+        raw_bands_path = [glob.glob(os.path.join(img_data_path, 'R10m/*_B{}_*.jp2'.format(b)))[0] for b in band_list]
+        reproject_merge_clip(raw_bands_path, merge_output_path, aoi_path=aoi_path if args.clip else None)
+        split_and_save_patches(merge_output_path, output_dir, patch_size=512, overlap=10, bands=[1, 2, 3, 4], skip_partial=True,
+                               output_format=args.patch_format, aoi_path=patch_aoi_path, aoi_buffer=args.aoi_buffer)
+        return
 
-    img_data_path = find_img_data_folder(raw_data_path)
+    for b in band_list:
+
+        print("Working on band {}".format(b))
+
+        band_granules_path = glob.glob(
+            os.path.join(img_data_path, 'R10m/*_B{}_*.jp2'.format(b)))
+
+        proj_band_path = [os.path.join(reproject_path, Path(i).stem + '_wgs84.tif') for i in band_granules_path]
+
+        all_bands_path.append(proj_band_path[0])
+
+        for file, outfile in zip(band_granules_path, proj_band_path):
+
+            infilename = os.path.basename(file).split('.')[0]
+            outfilename_pre = os.path.basename(outfile).split('.')[0][0:-6]
 
-    band_granules_path = glob.glob(
-        os.path.join(img_data_path, 'R10m/*_B{}_*.jp2'.format(b)))
+            if infilename == outfilename_pre and not os.path.isfile(outfile):
+                print("Reproject file {}".format(file))
+                to_reproject.append((file, outfile))
 
-    band_granules_src = [rasterio.open(i, driver='JP2OpenJPEG') for i in band_granules_path]
-    proj_band_path = [os.path.join(reproject_path, Path(i).stem + '_wgs84.tif') for i in band_granules_path]
+    # Reproject all bands to wgs-84, concurrently and with a shared warp plan
+    if to_reproject:
+        batch_re_projection([i for i, _ in to_reproject], [o for _, o in to_reproject])
 
-    all_bands_path.append(proj_band_path[0])
 
-    # Reproject all bands to wgs-84
-    for file, outfile in zip(band_granules_path, proj_band_path):
+    combine_bands(all_bands_path, merge_output_path)
+    print("merged_imagery_path is {}".format(merge_output_path))
 
-        infilename = os.path.basename(file).split('.')[0]
-        outfilename_pre = os.path.basename(outfile).split('.')[0][0:-6]
+    # crop_image(merge_output_path, aoi_path, crop_aoi_path)
+    split_and_save_patches(merge_output_path, output_dir, patch_size=512, overlap=10, bands=[1, 2, 3, 4], skip_partial=True,
+                           output_format=args.patch_format, aoi_path=patch_aoi_path, aoi_buffer=args.aoi_buffer)
 
-        if infilename == outfilename_pre and not os.path.isfile(outfile):
-            print("Reproject file {}".format(file))
 
-            re_projection(file, outfile)
+def add_arguments(parser):
+    """Options shared by `python data_preprocessing.py` and `python cli.py preprocess`."""
+    parser.add_argument("--fused", action="store_true", help="Single-pass reproject + merge into one tiled COG.")
+    parser.add_argument("--patch_format", choices=["tif", "npy"], default="tif",
+                        help="One GeoTIFF per patch, or one memory-mappable array + JSON index.")
+    parser.add_argument("--clip", action="store_true", help="Clip to boundary.geojson during the fused warp.")
+    parser.add_argument("--aoi_patches", action="store_true", help="Only write the patches intersecting boundary.geojson.")
+    parser.add_argument("--aoi_buffer", type=int, default=0, help="Buffer around the AOI in pixels (--aoi_patches).")
+    return parser
 
 
-combine_bands(all_bands_path, merge_output_path)
-print("merged_imagery_path is {}".format(merge_output_path))
+if __name__ == "__main__":
+    parser = add_arguments(argparse.ArgumentParser(description="Reproject, merge and patch the Sentinel-2 10m bands."))
 
-# crop_image(merge_output_path, aoi_path, crop_aoi_path)
-split_and_save_patches(merge_output_path, output_dir, patch_size=512, overlap=10, bands=[1, 2, 3, 4], skip_partial=True)
\ No newline at end of file
+    # The guard keeps the reprojection worker processes from re-running the pipeline
+    main(parser.parse_args())
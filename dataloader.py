@@ -1,16 +1,52 @@
-
 import os
+import json
 import rasterio
+from rasterio.transform import Affine
 import torch
 from torch.utils.data import Dataset, DataLoader
 from torchvision import transforms
 import numpy as np
 
+from util import generate_windows, AOICellMask
+from instrumentation import metrics
+
+
+def preprocess_image(image):
+    """
+    Scale a raw (C, H, W) Sentinel patch and pad it to the 6 channels the model was trained on.
+
+    :param image: raw reflectance array, CxHxW
+    :return: float32 array, HxWxC
+    """
+    image = image / 10000.  # scale data
+
+    # Adding additional 2 channels to cope with the trained model
+    first_channel = image[0:1, :, :]  # shape: (1, H, W)
+    new_channels = np.repeat(first_channel, 2, axis=0)  # shape: (2, H, W)
+    image = np.concatenate([image, new_channels], axis=0)  # shape: (4 + 2, H, W)
+
+    return np.moveaxis(image, [0, 1, 2], [2, 0, 1]).astype('float32')  # CxHxW to HxWxC
+
+
+def raw_tensor(image):
+    """
+    Wrap a raw (C, H, W) patch as a tensor without converting it; uint16 pixels are passed as an
+    int16 view (torch has no usable uint16 dtype) and restored by preprocessing.prepare_batch.
+
+    :param image: raw array, CxHxW
+    :return: tensor sharing memory with the array
+    """
+    if image.dtype == np.uint16:
+        image = image.view(np.int16)
+    return torch.from_numpy(np.ascontiguousarray(image))
+
 
 class SentinelDataset(Dataset):
-    def __init__(self, folder_path, transform=None):
+    def __init__(self, folder_path, transform=None, raw=False):
         self.folder_path = folder_path
         self.transform = transform
+        # raw=True skips the per-sample scaling/padding; do it batched on the device instead
+        self.raw = raw
         self.image_files = sorted([
             os.path.join(folder_path, f)
             for f in os.listdir(folder_path)
@@ -22,17 +58,19 @@ class SentinelDataset(Dataset):
 
     def __getitem__(self, idx):
         img_path = self.image_files[idx]
-        src = rasterio.open(img_path)
-        image = src.read()
+        with metrics.timer("dataset.read"), rasterio.open(img_path) as src:
+            image = src.read()
+            georef = {
+                'transform': torch.tensor(list(src.transform)[:6], dtype=torch.float64),
+                'crs': src.crs.to_wkt() if src.crs else '',
+            }
 
-        image = image / 10000.  # scale data
+        metrics.count("dataset.bytes_read", image.nbytes)
 
-        # Adding additional 2 channels to cope with the trained model
-        first_channel = image[0:1, :, :]  # shape: (1, H, W)
-        new_channels = np.repeat(first_channel, 2, axis=0)  # shape: (2, H, W)
-        image = np.concatenate([image, new_channels], axis=0)  # shape: (4 + 2, H, W)
+        if self.raw:
+            return {'image': raw_tensor(image), 'filename': os.path.basename(img_path), **georef}
 
-        image = np.moveaxis(image, [0, 1, 2], [2, 0, 1]).astype('float32')  # CxHxW to HxWxC
+        image = preprocess_image(image)
 
         # Apply transform if given
         if self.transform:
@@ -40,4 +78,140 @@ class SentinelDataset(Dataset):
         else:
             image = transforms.ToTensor()(image)
 
-        return {'image': image, 'filename': os.path.basename(img_path)}
\ No newline at end of file
+        return {'image': image, 'filename': os.path.basename(img_path), **georef}
+
+
+class SentinelWindowDataset(Dataset):
+    """
+    Serve fixed-size windows straight from a merged scene raster (e.g. combined_4band.tif),
+    so no patch files have to be written to disk before inference. With an AOI only the windows
+    intersecting it (plus `aoi_buffer` pixels) are served, without writing a cropped copy.
+    """
+
+    def __init__(self, tif_path, patch_size=512, overlap=0, bands=None, transform=None, raw=False, aoi_path=None,
+                 aoi_buffer=0):
+        self.tif_path = tif_path
+        self.bands = bands
+        self.transform = transform
+        self.raw = raw
+
+        with rasterio.open(tif_path) as src:
+            self.profile = src.profile
+            self.width = src.width
+            self.height = src.height
+            self.aoi_mask = None
+            if aoi_path is not None:
+                self.aoi_mask = AOICellMask(aoi_path, src.transform, src.width, src.height, crs=src.crs,
+                                            buffer=aoi_buffer)
+
+        self.windows = generate_windows(self.width, self.height, patch_size=patch_size, overlap=overlap,
+                                        aoi_mask=self.aoi_mask)
+
+        # The dataset handle is opened lazily, once per DataLoader worker process
+        self._src = None
+        self._pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_src'] = None
+        state['_pid'] = None
+        return state
+
+    def _dataset(self):
+        if self._src is None or self._pid != os.getpid():
+            self._src = rasterio.open(self.tif_path)
+            self._pid = os.getpid()
+        return self._src
+
+    def close(self):
+        if self._src is not None:
+            self._src.close()
+            self._src = None
+
+    def __len__(self):
+        return len(self.windows)
+
+    def __getitem__(self, idx):
+        window = self.windows[idx]
+        with metrics.timer("dataset.read"):
+            image = self._dataset().read(indexes=self.bands, window=window)
+        metrics.count("dataset.bytes_read", image.nbytes)
+
+        if self.raw:
+            image = raw_tensor(image)
+        else:
+            image = preprocess_image(image)
+
+            if self.transform:
+                image = self.transform(image)
+            else:
+                image = transforms.ToTensor()(image)
+
+        window_tensor = torch.tensor([window.col_off, window.row_off, window.width, window.height])
+
+        return {'image': image, 'window': window_tensor}
+
+
+class SentinelArrayDataset(Dataset):
+    """
+    Patches from the single (N, C, H, W) uint16 array written by
+    split_and_save_patches(..., output_format="npy"), memory-mapped so samples are served without
+    opening files or copying pixels.
+
+    Samples are raw: the uint16 patch is exposed to torch as an int16 view (torch has no usable
+    uint16 dtype), and scaling/channel padding is left to preprocessing.prepare_batch on the
+    inference device.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, "patches.json")) as f:
+            self.index = json.load(f)
+
+        self.shape = tuple(self.index["shape"])
+        self.dtype = np.dtype(self.index["dtype"])
+        self.image_files = [f"{p['name']}.tif" for p in self.index["patches"]]
+
+        # The memmap is opened lazily, once per DataLoader worker process
+        self._patches = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_patches'] = None
+        return state
+
+    def _array(self):
+        if self._patches is None:
+            self._patches = np.memmap(os.path.join(self.store_dir, "patches.dat"), dtype=self.dtype,
+                                      mode="c", shape=self.shape)
+        return self._patches
+
+    def __len__(self):
+        return self.shape[0]
+
+    def get_profile(self, idx):
+        """GeoTIFF profile (georeferencing) of patch idx, from the sidecar index."""
+        _, count, height, width = self.shape
+        return {
+            "driver": "GTiff",
+            "count": count,
+            "height": height,
+            "width": width,
+            "dtype": self.dtype.name,
+            "crs": self.index["crs"],
+            "nodata": self.index["nodata"],
+            "transform": Affine(*self.index["patches"][idx]["transform"]),
+        }
+
+    def __getitem__(self, idx):
+        # Copy-on-write memmap: writable for torch, but nothing is copied unless written to
+        image = raw_tensor(self._array()[idx])
+
+        return {
+            'image': image,
+            'filename': self.image_files[idx],
+            'index': idx,
+            'transform': torch.tensor(self.index["patches"][idx]["transform"], dtype=torch.float64),
+            'crs': self.index["crs"] or '',
+        }
+
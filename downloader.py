@@ -1,9 +1,20 @@
 
 import os
-import boto3
-import geopandas as gpd
-from pystac_client import Client
-from typing import Tuple, List
+import re
+import math
+import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from shapely.geometry import shape
+from typing import TYPE_CHECKING, Tuple, List, Optional, Dict
+
+from instrumentation import metrics, timed
+
+if TYPE_CHECKING:
+    # boto3, geopandas and pystac_client are imported where they are used, so importing this
+    # module (e.g. for the CLI) stays cheap
+    from boto3.s3.transfer import TransferConfig
+    from pystac_client import Client
 
 
 # -------- Configuration -------- #
@@ -23,6 +34,28 @@ END_DATE = "2021-09-30"
 AOI_PATH = "boundary.geojson"
 OUTPUT_DIR = ""
 
+# -------- Download tuning -------- #
+DOWNLOAD_WORKERS = 8
+DOWNLOAD_RETRIES = 5
+# Only fetch what data_preprocessing.py consumes (the 10m B02/B03/B04/B08 JP2s); None downloads everything
+BAND_PATTERNS = [r"/R10m/[^/]*_B(02|03|04|08)_[^/]*\.jp2$"]
+# 4xx error codes that are worth retrying
+THROTTLING_ERRORS = {"SlowDown", "Throttling", "ThrottlingException", "RequestTimeout", "TooManyRequests",
+                     "RequestLimitExceeded"}
+TRANSFER_SETTINGS = dict(
+    multipart_threshold=32 * 1024 * 1024,
+    multipart_chunksize=16 * 1024 * 1024,
+    max_concurrency=4,
+    use_threads=True,
+)
+
+
+def default_transfer_config() -> "TransferConfig":
+    """boto3 transfer settings of the downloads (TRANSFER_SETTINGS)"""
+    from boto3.s3.transfer import TransferConfig
+
+    return TransferConfig(**TRANSFER_SETTINGS)
+
 
 def get_url_parts(url: str) -> Tuple[str, str]:
     """Extract the bucket download path"""
@@ -30,27 +63,140 @@ def get_url_parts(url: str) -> Tuple[str, str]:
     return bucket, path
 
 
-def download_s3_product(bucket, product_prefix: str, target_dir: str = "") -> None:
-    """Download all files under a prefix from a public S3 bucket."""
-    files = bucket.objects.filter(Prefix=product_prefix)
-    if not list(files):
+def matches_patterns(key: str, patterns: Optional[List[str]]) -> bool:
+    """Whether an object key passes the band/resolution filter (no patterns keeps everything)."""
+    return patterns is None or any(re.search(p, key) for p in patterns)
+
+
+def local_etag(path: str, chunk_size: int, parts: int = 1) -> str:
+    """S3-style ETag of a local file: the MD5, or the MD5 of the part MD5s for multipart uploads."""
+    with open(path, "rb") as f:
+        if parts <= 1:
+            digest = hashlib.md5()
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+            return digest.hexdigest()
+
+        part_digests = [hashlib.md5(chunk).digest() for chunk in iter(lambda: f.read(chunk_size), b"")]
+    return f"{hashlib.md5(b''.join(part_digests)).hexdigest()}-{len(part_digests)}"
+
+
+def is_complete(local_path: str, size: int, etag: str, chunk_size: int) -> bool:
+    """
+    Whether a previous download of the object is complete: the size must match, and the ETag
+    too whenever it can be reproduced locally. Multipart ETags depend on the uploader's part
+    size, so both our chunk size and the part size implied by the size and part count (rounded
+    up to a whole MiB) are tried; if neither reproduces it, the size match is trusted.
+    """
+    if not os.path.isfile(local_path) or os.path.getsize(local_path) != size:
+        return False
+
+    etag = (etag or "").strip('"')
+    if not etag:
+        return True
+    if "-" not in etag:
+        return local_etag(local_path, chunk_size) == etag
+
+    parts = int(etag.split("-")[1])
+    mib = 1024 * 1024
+    implied = math.ceil(size / parts / mib) * mib
+    for part_size in dict.fromkeys([chunk_size, implied]):
+        if math.ceil(size / part_size) == parts and local_etag(local_path, part_size, parts=parts) == etag:
+            return True
+
+    metrics.count("download_s3_product.etag_unverified")
+    return True
+
+
+def is_transient(error: Exception) -> bool:
+    """Whether a download error may go away on retry: anything but a 4xx from S3 (throttling excepted)."""
+    from botocore.exceptions import ClientError
+
+    if not isinstance(error, ClientError):
+        return True
+    response = error.response
+    status = response.get("ResponseMetadata", {}).get("HTTPStatusCode") or 0
+    code = response.get("Error", {}).get("Code", "")
+    return not 400 <= int(status) < 500 or code in THROTTLING_ERRORS
+
+
+def download_file(client, bucket_name: str, key: str, local_path: str, transfer_config: "TransferConfig",
+                  retries: int = DOWNLOAD_RETRIES, backoff: float = 1.0) -> None:
+    """Download one object to a temporary file and move it into place, retrying with exponential backoff."""
+    from boto3.exceptions import Boto3Error
+    from botocore.exceptions import BotoCoreError, ClientError
+
+    os.makedirs(os.path.dirname(local_path) or ".", exist_ok=True)
+    tmp_path = local_path + ".part"
+
+    for attempt in range(retries):
+        try:
+            with metrics.timer("download_s3_product.file"):
+                client.download_file(bucket_name, key, tmp_path, Config=transfer_config)
+            os.replace(tmp_path, local_path)
+            metrics.count("download_s3_product.bytes_read", os.path.getsize(local_path))
+            return
+        except (Boto3Error, BotoCoreError, ClientError, OSError) as e:
+            if attempt == retries - 1 or not is_transient(e):
+                raise
+            metrics.count("download_s3_product.retries")
+            wait = backoff * 2 ** attempt
+            print(f"Retrying {key} in {wait:.0f}s ({e})")
+            time.sleep(wait)
+
+
+@timed("download_s3_product")
+def download_s3_product(bucket, product_prefix: str, target_dir: str = "", patterns: Optional[List[str]] = None,
+                        workers: int = DOWNLOAD_WORKERS, transfer_config: Optional["TransferConfig"] = None,
+                        retries: int = DOWNLOAD_RETRIES) -> Dict[str, List[str]]:
+    """
+    Download the files under a prefix from an S3 bucket, concurrently.
+
+    Files already downloaded completely (same size/ETag) are skipped, so an interrupted download
+    resumes where it stopped; `patterns` restricts the download to matching keys.
+    """
+    transfer_config = transfer_config or default_transfer_config()
+    objects = list(bucket.objects.filter(Prefix=product_prefix))  # list the prefix once
+    if not objects:
         raise FileNotFoundError(f"No files found for product: {product_prefix}")
 
-    for file in files:
-        local_path = os.path.join(target_dir, file.key)
-        os.makedirs(os.path.dirname(local_path), exist_ok=True)
-        if not os.path.isdir(local_path):
-            print(f"Downloading: {file.key}")
-            bucket.download_file(file.key, local_path)
+    selected = [obj for obj in objects if not obj.key.endswith("/") and matches_patterns(obj.key, patterns)]
+    summary = {"downloaded": [], "skipped": []}
+    pending = []
+    for obj in selected:
+        local_path = os.path.join(target_dir, obj.key)
+        if is_complete(local_path, obj.size, obj.e_tag, transfer_config.multipart_chunksize):
+            summary["skipped"].append(obj.key)
+        else:
+            pending.append((obj.key, local_path))
+
+    print(f"{len(pending)} of {len(selected)} files to download ({len(objects) - len(selected)} filtered out)")
+    metrics.count("download_s3_product.files_skipped", len(summary["skipped"]))
+
+    # Clients are thread-safe, resources are not
+    client = bucket.meta.client
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(download_file, client, bucket.name, key, local_path, transfer_config, retries): key
+            for key, local_path in pending
+        }
+        for future in as_completed(futures):
+            future.result()
+            print(f"Downloaded: {futures[future]}")
+            summary["downloaded"].append(futures[future])
+
+    return summary
 
 
 def get_aoi_bbox(aoi_file: str) -> List[float]:
     """Get the bounding box of AOI"""
+    import geopandas as gpd
+
     gdf = gpd.read_file(aoi_file)
     return gdf.total_bounds.tolist()
 
 
-def search_sentinel_items(client: Client, bbox: List[float], start: str, end: str, cloud_cover: int, product_type: str) -> List:
+def search_sentinel_items(client: "Client", bbox: List[float], start: str, end: str, cloud_cover: int, product_type: str) -> List:
     """Search STAC for Sentinel items with filters."""
     results = client.search(
         collections=[DATA_COLLECTION],
@@ -65,13 +211,82 @@ def search_sentinel_items(client: Client, bbox: List[float], start: str, end: st
     ]
 
 
-# -------- Main Process -------- #
+def get_aoi_geometry(aoi_file: str):
+    """Union of the AOI features, in EPSG:4326 like the STAC item footprints"""
+    import geopandas as gpd
+
+    gdf = gpd.read_file(aoi_file)
+    if gdf.crs is not None:
+        gdf = gdf.to_crs("EPSG:4326")
+    return gdf.geometry.union_all()
+
+
+def select_covering_items(items: List, aoi, min_gain: float = 0.01) -> List:
+    """
+    Greedy cover of the AOI: going from the least to the most cloudy item, keep an item only if
+    its footprint adds at least `min_gain` of the AOI area not covered by the items kept so far.
+    """
+    remaining = aoi
+    selected = []
+    for item in sorted(items, key=lambda i: i.properties.get("cloudCover", 100)):
+        footprint = shape(item.geometry)
+        if remaining.intersection(footprint).area > min_gain * aoi.area:
+            selected.append(item)
+            remaining = remaining.difference(footprint)
+        if remaining.is_empty:
+            break
+    return selected
 
-def main():
 
+def get_product_s3_path(item) -> Optional[str]:
+    """S3 href of the .SAFE product of a STAC item, if the catalogue exposes one"""
+    product = item.assets.get("PRODUCT")
+    if product is None:
+        return None
+    return product.to_dict().get("alternate", {}).get("s3", {}).get("href")
+
+
+def connect_s3():
+    """S3 resource for the Copernicus eodata endpoint"""
     if not ACCESS_KEY or not SECRET_KEY:
-        raise("Fill the ACCESS KEY and SECRET KEY")
+        raise ValueError("Fill the ACCESS KEY and SECRET KEY")
+
+    import boto3
+    from botocore.config import Config
+
+    session = boto3.session.Session()
+    return session.resource(
+        's3',
+        endpoint_url=ENDPOINT_URL,
+        aws_access_key_id=ACCESS_KEY,
+        aws_secret_access_key=SECRET_KEY,
+        region_name='default',
+        # Every file thread runs its own multipart threads; the default pool of 10 would drop connections
+        config=Config(max_pool_connections=DOWNLOAD_WORKERS * TRANSFER_SETTINGS["max_concurrency"])
+    )
+
 
+def download_item(s3, item, target_dir: str, patterns: Optional[List[str]] = BAND_PATTERNS,
+                  workers: int = DOWNLOAD_WORKERS) -> str:
+    """Download the product of one STAC item under target_dir/<item id>, returning that folder"""
+    href = get_product_s3_path(item)
+    if not href:
+        raise FileNotFoundError(f"Downloadable asset not found in STAC metadata: {item.id}")
+
+    bucket_name, product_path = get_url_parts(href)
+    scene_dir = os.path.join(target_dir, item.id)
+    print(f"Downloading path: {product_path}")
+    download_s3_product(s3.Bucket(bucket_name), product_path, target_dir=scene_dir, patterns=patterns,
+                        workers=workers)
+    return scene_dir
+
+
+# -------- Main Process -------- #
+
+def main():
+    from pystac_client import Client
+
+    s3 = connect_s3()
     client = Client.open(STAC_URL)
     bbox = get_aoi_bbox(AOI_PATH)
 
@@ -82,27 +297,18 @@ def main():
         print("No matching Sentinel-2 products found.")
         return
 
-    item = items[0]  # Download first result for illustration
-    safe_asset = item.assets.get("PRODUCT").to_dict().get("alternate", {}).get("s3")
+    item = items[0]  # Download first result for illustration; see batch.py for all of them
+    safe_asset = get_product_s3_path(item)
 
     if not safe_asset:
         print("Downloadable asset not found in STAC metadata.")
         return
 
     print("Found downloadable product. Connecting to S3...")
-    session = boto3.session.Session()
-    s3 = session.resource(
-        's3',
-        endpoint_url=ENDPOINT_URL,
-        aws_access_key_id=ACCESS_KEY,
-        aws_secret_access_key=SECRET_KEY,
-        region_name='default'
-    )
-
-    bucket_name, product_path = get_url_parts(safe_asset["href"])
+    bucket_name, product_path = get_url_parts(safe_asset)
     print(f"Downloading path: {product_path}")
 
-    download_s3_product(s3.Bucket(bucket_name), product_path, target_dir=OUTPUT_DIR)
+    download_s3_product(s3.Bucket(bucket_name), product_path, target_dir=OUTPUT_DIR, patterns=BAND_PATTERNS)
     print(f"Download completed! Files saved to: {OUTPUT_DIR}")
 
 
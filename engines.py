@@ -0,0 +1,248 @@
+import os
+import inspect
+import argparse
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader
+
+from dataloader import SentinelArrayDataset, SentinelDataset
+from model_utils import load_model, model_input_channels
+from preprocessing import prepare_batch
+
+ENGINES = ("eager", "torchscript", "onnxruntime")
+
+
+class _OutOnly(nn.Module):
+    """Return the 'out' logits as a plain tensor; tracers and exporters do not like dict outputs."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x):
+        return self.model(x)['out']
+
+
+class TorchScriptModel:
+    """Callable wrapper giving a traced TorchScript model the eager model's {'out': logits} interface."""
+
+    def __init__(self, path, device="cpu"):
+        extra_files = {"in_channels": ""}
+        self.module = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+        self.in_channels = int(extra_files["in_channels"] or 6)
+
+    def eval(self):
+        self.module.eval()
+        return self
+
+    def to(self, device):
+        self.module.to(device)
+        return self
+
+    def __call__(self, x):
+        return {'out': self.module(x)}
+
+
+class OnnxRuntimeModel:
+    """Callable wrapper running an ONNX export through ONNX Runtime (CPU) behind the {'out': logits} interface."""
+
+    def __init__(self, path, num_threads=None):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(path, sess_options=options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+        self.in_channels = self.session.get_inputs()[0].shape[1]
+
+    def eval(self):
+        return self
+
+    def to(self, device):
+        return self
+
+    def __call__(self, x):
+        out = self.session.run(None, {self.input_name: x.detach().cpu().numpy()})[0]
+        return {'out': torch.from_numpy(out)}
+
+
+def export_torchscript(model, output_path, example):
+    """
+    Trace the model to TorchScript
+
+    :param model: eager segmentation model
+    :param output_path: path of the .pt file
+    :param example: example input batch (float32, B x C x H x W)
+    :return:
+    """
+    model.eval()
+    with torch.no_grad():
+        traced = torch.jit.trace(_OutOnly(model).eval(), example)
+    traced = torch.jit.freeze(traced)
+    torch.jit.save(traced, output_path, _extra_files={"in_channels": str(example.shape[1])})
+    print(f"TorchScript model saved to: {output_path}")
+
+
+def export_onnx(model, output_path, example, opset=17):
+    """
+    Export the model to ONNX with dynamic batch size and patch size
+
+    :param model: eager segmentation model
+    :param output_path: path of the .onnx file
+    :param example: example input batch (float32, B x C x H x W)
+    :param opset: ONNX opset version
+    :return:
+    """
+    model.eval()
+    kwargs = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        kwargs["dynamo"] = False  # the TorchScript-based exporter needs no extra dependencies
+
+    with torch.no_grad():
+        torch.onnx.export(_OutOnly(model).eval(), example, output_path, opset_version=opset,
+                          input_names=["image"], output_names=["out"],
+                          dynamic_axes={"image": {0: "batch", 2: "height", 3: "width"},
+                                        "out": {0: "batch", 2: "height", 3: "width"}},
+                          **kwargs)
+    print(f"ONNX model saved to: {output_path}")
+
+
+class _CalibrationReader:
+    """Feed ONNX Runtime's static quantizer a sample of preprocessed patches."""
+
+    def __init__(self, batches, input_name):
+        self.batches = iter(batches)
+        self.input_name = input_name
+
+    def get_next(self):
+        batch = next(self.batches, None)
+        return None if batch is None else {self.input_name: batch.numpy()}
+
+
+def quantize_onnx(onnx_path, output_path, calibration_batches=None):
+    """
+    int8-quantize an ONNX model with ONNX Runtime
+
+    Without calibration data the weights are quantized dynamically (activations quantized at
+    runtime); with calibration batches the activation ranges are calibrated and fixed (static).
+    PyTorch's own dynamic quantization only covers Linear/LSTM layers, so the convolutional
+    model is quantized on the ONNX side.
+
+    :param onnx_path: fp32 ONNX model
+    :param output_path: int8 ONNX model
+    :param calibration_batches: optional list of preprocessed float32 batches
+    :return:
+    """
+    from onnxruntime.quantization import QuantType, quantize_dynamic, quantize_static
+
+    if calibration_batches:
+        import onnxruntime as ort
+
+        input_name = ort.InferenceSession(onnx_path, providers=["CPUExecutionProvider"]).get_inputs()[0].name
+        quantize_static(onnx_path, output_path, _CalibrationReader(calibration_batches, input_name),
+                        weight_type=QuantType.QInt8, activation_type=QuantType.QUInt8)
+    else:
+        quantize_dynamic(onnx_path, output_path, weight_type=QuantType.QUInt8)
+    print(f"Quantized ONNX model saved to: {output_path}")
+
+
+def load_engine(engine, weight_path, device="cpu", num_threads=None, fold_channels=False):
+    """
+    Load a model for one of the runtime backends; all of them are called as model(x)['out']
+
+    :param engine: 'eager' (.pth state dict), 'torchscript' (.pt) or 'onnxruntime' (.onnx)
+    :param weight_path: model file for the engine
+    :param device: torch device (ONNX Runtime always runs on CPU)
+    :param num_threads: intra-op threads for ONNX Runtime
+    :param fold_channels: eager only, see model_utils.load_model
+    :return: model
+    """
+    if engine == "eager":
+        return load_model(weight_path, device=device, fold_channels=fold_channels)
+    if engine == "torchscript":
+        return TorchScriptModel(weight_path, device=device)
+    if engine == "onnxruntime":
+        return OnnxRuntimeModel(weight_path, num_threads=num_threads)
+    raise ValueError(f"Unknown engine: {engine}")
+
+
+def check_parity(reference, candidate, batch):
+    """
+    Compare a candidate engine against the eager reference on one batch
+
+    :param reference: eager model
+    :param candidate: engine model
+    :param batch: preprocessed float32 batch
+    :return: dict with the max absolute logit difference and the fraction of matching labels
+    """
+    with torch.no_grad():
+        expected = reference(batch)['out']
+        actual = candidate(batch)['out']
+
+    return {
+        "max_abs_diff": float((expected - actual).abs().max()),
+        "label_agreement": float((expected.argmax(1) == actual.argmax(1)).float().mean()),
+    }
+
+
+def sample_batches(data_path, in_channels, num_samples=32, batch_size=4):
+    """Preprocessed batches from the first patches of a patch folder, for tracing/calibration."""
+    if os.path.isfile(os.path.join(data_path, "patches.json")):
+        dataset = SentinelArrayDataset(data_path)
+    else:
+        dataset = SentinelDataset(data_path, raw=True)
+    indices = range(min(num_samples, len(dataset)))
+    loader = DataLoader(torch.utils.data.Subset(dataset, indices), batch_size=batch_size)
+    return [prepare_batch(batch['image'], out_channels=in_channels) for batch in loader]
+
+
+def main(args):
+    model = load_model(args.weights, fold_channels=args.fold_channels).eval()
+    in_channels = model_input_channels(model)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    if args.data_path:
+        batches = sample_batches(args.data_path, in_channels, num_samples=args.num_samples)
+    else:
+        batches = [torch.rand(1, in_channels, args.patch_size, args.patch_size)]
+    example = batches[0]
+
+    stem = os.path.splitext(os.path.basename(args.weights))[0]
+    exported = []
+
+    ts_path = os.path.join(args.output_dir, f"{stem}.pt")
+    export_torchscript(model, ts_path, example)
+    exported.append(("torchscript", ts_path))
+
+    onnx_path = os.path.join(args.output_dir, f"{stem}.onnx")
+    export_onnx(model, onnx_path, example)
+    exported.append(("onnxruntime", onnx_path))
+
+    if args.quantize != "none":
+        int8_path = os.path.join(args.output_dir, f"{stem}_int8.onnx")
+        quantize_onnx(onnx_path, int8_path, calibration_batches=batches if args.quantize == "static" else None)
+        exported.append(("onnxruntime", int8_path))
+
+    for engine, path in exported:
+        parity = check_parity(model, load_engine(engine, path), example)
+        print(f"Parity {os.path.basename(path)} vs eager: max |diff| {parity['max_abs_diff']:.2e}, "
+              f"label agreement {parity['label_agreement']:.4f}")
+
+
+def add_arguments(parser):
+    """Export options, shared by `python engines.py` and `python cli.py export`."""
+    parser.add_argument("--weights", required=True, help="Path to model weights (.pth).")
+    parser.add_argument("--output_dir", default="weights", help="Directory for the exported models.")
+    parser.add_argument("--data_path", help="Patch folder/array store used for tracing, calibration and the parity check.")
+    parser.add_argument("--num_samples", type=int, default=32, help="Number of patches used for calibration.")
+    parser.add_argument("--patch_size", type=int, default=512, help="Example patch size when no data is given.")
+    parser.add_argument("--quantize", choices=["none", "dynamic", "static"], default="none", help="int8 quantization of the ONNX model.")
+    parser.add_argument("--fold_channels", action="store_true", help="Export the 4-channel folded model.")
+    return parser
+
+
+if __name__ == "__main__":
+    parser = add_arguments(argparse.ArgumentParser(description="Export the model to TorchScript/ONNX for CPU inference."))
+    main(parser.parse_args())
@@ -1,39 +1,538 @@
 
 import os
+import math
+import time
+import queue
+import threading
+import numpy as np
 import torch
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader, Subset
 import rasterio
+from rasterio.transform import Affine
+from rasterio.enums import Resampling
+from rasterio.windows import Window
 
-def run_inference(model, dataloader, output_dir, device):
+from preprocessing import prepare_batch
+from model_utils import model_input_channels
+from stitching import NODATA_LABEL
+from util import cog_output
+from instrumentation import metrics, timed
+
+
+class PredictionWriter:
+    """
+    Pool of writer threads draining a bounded queue, so compressing and writing predictions
+    overlaps with the next forward pass instead of stalling it. GDAL releases the GIL while
+    encoding, so threads are enough. When the queue is full, submit() blocks, which keeps
+    memory bounded if writing falls behind.
+    """
+
+    def __init__(self, write_fn, num_workers=2, max_queue=16, name="writer"):
+        self.write_fn = write_fn
+        self.name = name
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.errors = []
+        self.threads = [threading.Thread(target=self._work, daemon=True) for _ in range(num_workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            try:
+                with metrics.timer(f"{self.name}.write"):
+                    self.write_fn(*item)
+            except Exception as e:
+                self.errors.append(e)
+
+    def submit(self, *args):
+        if self.errors:
+            raise self.errors[0]
+        metrics.gauge(f"{self.name}.queue_depth", self.queue.qsize())
+        self.queue.put(args)
+
+    def close(self, raise_errors=True):
+        """Wait for all queued writes; re-raise the first write error unless `raise_errors` is False."""
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.errors and raise_errors:
+            raise self.errors[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # An error of the inference loop itself wins over a write error
+        self.close(raise_errors=exc_type is None)
+
+
+def _write_prediction(out_path, pred, profile):
+    with rasterio.open(out_path, 'w', **profile) as dst:
+        dst.write(pred)
+    metrics.count("run_inference.bytes_written", pred.nbytes)
+
+
+@timed("run_inference")
+def run_inference(model, dataloader, output_dir, device, save_probabilities=False, writers=2, cache=None,
+                  prefilter=None, report=True):
+    """
+    Predict every patch of a SentinelDataset and write one prediction GeoTIFF per patch.
+
+    :param model: segmentation model returning {'out': logits}
+    :param dataloader: DataLoader over a dataloader.SentinelDataset or SentinelArrayDataset
+    :param output_dir: directory for the prediction patches
+    :param device: torch device
+    :param save_probabilities: write per-class softmax probabilities (uint8, scaled to 0-255) as
+                               prob_<patch>.tif instead of argmax labels, for blended stitching
+    :param writers: number of threads writing prediction GeoTIFFs in the background
+    :param cache: optional cache.PredictionCache; cached patches skip the forward pass
+    :param prefilter: optional preprocessing.PatchPrefilter; nodata and homogeneous patches are
+                      labelled without the forward pass
+    :param report: print the cache and prefilter counts at the end (sharded workers leave it to
+                   the parent, which adds up the counts of all workers)
+    :return: number of patches predicted
+    """
 
     model.eval()
     model.to(device)
 
     os.makedirs(output_dir, exist_ok=True)
+    in_channels = model_input_channels(model)
+    count = 0
 
-    with torch.no_grad():
+    with torch.no_grad(), PredictionWriter(_write_prediction, num_workers=writers, name="run_inference") as writer:
         print("Working on Inferencing...")
+        # Time spent waiting for the loader, separate from the forward pass and the writes
+        loaded = time.perf_counter()
         for i, batch in enumerate(dataloader):
+            metrics.observe("run_inference.data_load", time.perf_counter() - loaded)
 
             print("Working on batch {}".format(i))
-            X = batch['image'].to(device)
+            images = batch['image']
+            metrics.count("run_inference.bytes_read", images.nbytes)
             filenames = batch['filename']  # list of filenames in the batch
-            output = model(X)['out']
-            preds = torch.argmax(output, dim=1).cpu().numpy()  # shape: (B, H, W)
-
-            for pred, fname in zip(preds, filenames):
-                original_path = os.path.join(dataloader.dataset.folder_path, fname)
-                with rasterio.open(original_path) as src:
-                    profile = src.profile
-                    profile.update({
-                        "count": 1,
-                        "dtype": 'uint8',
-                        "compress": "lzw"})
-
-                    out_path = os.path.join(output_dir, f"pred_{fname}")
-                    with rasterio.open(out_path, 'w', **profile) as dst:
-                        dst.write(pred.astype('uint8'), 1)  # Write to band 1
+            prefix = "prob" if save_probabilities else "pred"
+
+            preds = [None] * len(images)
+            if prefilter is not None:
+                labels, valid = prefilter.classify(images)
+                for j in torch.nonzero(labels >= 0).flatten().tolist():
+                    preds[j] = prefilter.prediction(int(labels[j]), valid[j], probabilities=save_probabilities)
+
+            if cache is not None:
+                keys = [cache.key(image.numpy(), kind=prefix) if pred is None else None
+                        for image, pred in zip(images, preds)]
+                preds = [cache.get(key) if pred is None else pred for key, pred in zip(keys, preds)]
+
+            # Forward pass only for the patches the cache could not answer
+            todo = [j for j, pred in enumerate(preds) if pred is None]
+            if todo:
+                with metrics.timer("run_inference.forward"):
+                    X = (images if len(todo) == len(images) else images[todo]).to(device)
+                    if not X.is_floating_point():
+                        # Raw patches are scaled and padded on the device, as one batched op
+                        X = prepare_batch(X, out_channels=in_channels)
+                    output = model(X)['out']
+                    if save_probabilities:
+                        probs = torch.softmax(output, dim=1)
+                        computed = torch.round(probs * 255).cpu().numpy().astype('uint8')  # shape: (B, C, H, W)
+                    else:
+                        computed = torch.argmax(output, dim=1).cpu().numpy().astype('uint8')  # shape: (B, H, W)
+                        computed = computed[:, None]
+                metrics.count("run_inference.forward_patches", len(todo))
+
+                for j, pred in zip(todo, computed):
+                    preds[j] = pred
+                    if cache is not None:
+                        cache.put(keys[j], pred)
+
+            # Georeferencing travels with the batch, no need to reopen the input patch
+            for pred, fname, transform, crs in zip(preds, filenames, batch['transform'].tolist(), batch['crs']):
+                profile = {
+                    "driver": "GTiff",
+                    "height": pred.shape[1],
+                    "width": pred.shape[2],
+                    "count": pred.shape[0],
+                    "dtype": 'uint8',
+                    # Labels outside the data (see PatchPrefilter) are masked when stitching
+                    "nodata": None if save_probabilities else NODATA_LABEL,
+                    "crs": crs or None,
+                    "transform": Affine(*transform),
+                    "compress": "lzw"}
+
+                writer.submit(os.path.join(output_dir, f"{prefix}_{fname}"), pred, profile)
 
+            count += len(preds)
+            metrics.count("run_inference.patches", len(preds))
+            loaded = time.perf_counter()
+
+    if report and cache is not None:
+        cache.report()
+    if report and prefilter is not None:
+        prefilter.report()
     print(f"Inference complete. Predictions saved to: {output_dir}")
+    return count
+
+
+def _trim_window(col_off, row_off, width, height, margin, img_width, img_height):
+    """
+    Part of a window a windowed prediction is written to: the overlapping margin is trimmed on
+    the edges that are not the image border.
+
+    :return: (output Window, (row slice, column slice) of the prediction)
+    """
+    left = margin if col_off > 0 else 0
+    top = margin if row_off > 0 else 0
+    right = width - (margin if col_off + width < img_width else 0)
+    bottom = height - (margin if row_off + height < img_height else 0)
+    return Window(col_off + left, row_off + top, right - left, bottom - top), (slice(top, bottom), slice(left, right))
+
+
+@timed("run_windowed_inference")
+def run_windowed_inference(model, dataloader, output_path, device, overlap=0, fills=(), cog=True,
+                           compress="deflate"):
+    """
+    Predict straight off a scene raster and write every window into one pre-allocated output.
+
+    :param model: segmentation model returning {'out': logits}
+    :param dataloader: DataLoader over a dataloader.SentinelWindowDataset
+    :param output_path: path of the single-band prediction GeoTIFF
+    :param device: torch device
+    :param overlap: window overlap used by the dataset; half of it is trimmed from each inner
+                    window edge so border predictions of a window are replaced by its neighbour
+    :param fills: (Window, label) pairs of windows already known to hold a single label,
+                  written without the model (see run_adaptive_inference)
+    :param cog: write a Cloud-Optimized GeoTIFF with mode-resampled overviews, like the stitchers
+    :param compress: GDAL compression of the COG
+    :return:
+    """
+    model.eval()
+    model.to(device)
+
+    dataset = dataloader.dataset
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+
+    profile = dataset.profile.copy()
+    profile.update({
+        "driver": "GTiff",
+        "count": 1,
+        "dtype": 'uint8',
+        # Windows left out by an AOI are never written and read back as nodata
+        "nodata": NODATA_LABEL if dataset.aoi_mask is not None else None,
+        "compress": "lzw",
+        "tiled": True,
+        "blockxsize": 512,
+        "blockysize": 512})
+
+    margin = overlap // 2
+    in_channels = model_input_channels(model)
+
+    def _write_window(pred, window):
+        dst.write(pred, 1, window=window)
+
+    # A single writer thread: the output dataset must not be written concurrently
+    with cog_output(output_path, cog, compress=compress, resampling="mode") as tiled_path, \
+            rasterio.open(tiled_path, 'w', **profile) as dst, torch.no_grad(), \
+            PredictionWriter(_write_window, num_workers=1, name="run_windowed_inference") as writer:
+        for window, label in fills:
+            window, _ = _trim_window(window.col_off, window.row_off, window.width, window.height, margin,
+                                     dataset.width, dataset.height)
+            writer.submit(np.full((window.height, window.width), label, dtype='uint8'), window)
+
+        print("Working on windowed inferencing...")
+        loaded = time.perf_counter()
+        for i, batch in enumerate(dataloader):
+            metrics.observe("run_windowed_inference.data_load", time.perf_counter() - loaded)
+
+            print("Working on batch {}".format(i))
+            with metrics.timer("run_windowed_inference.forward"):
+                X = batch['image'].to(device)
+                if not X.is_floating_point():
+                    X = prepare_batch(X, out_channels=in_channels)
+                output = model(X)['out']
+                preds = torch.argmax(output, dim=1).cpu().numpy().astype('uint8')  # shape: (B, H, W)
+            metrics.count("run_windowed_inference.patches", len(preds))
+
+            for pred, (col_off, row_off, width, height) in zip(preds, batch['window'].tolist()):
+                window, trim = _trim_window(col_off, row_off, width, height, margin, dataset.width, dataset.height)
+                writer.submit(pred[trim], window)
+            loaded = time.perf_counter()
+
+    dataset.close()
+    print(f"Windowed inference complete. Prediction saved to: {output_path}")
+
+
+def _coarse_prediction(model, tif_path, device, factor, patch_size, bands=None, batch_size=4, windows=None,
+                       aoi_mask=None):
+    """
+    Labels and confidences of the scene downsampled by `factor` (block averages), so one coarse
+    pass costs about 1 / factor^2 of a full-resolution pass.
+
+    With `windows`, only the part of the coarse grid they (plus one coarse pixel around them) need
+    is read, and with `aoi_mask` the coarse tiles too far from the AOI to matter are not predicted.
+
+    :param windows: full-resolution windows the coarse prediction is needed for (None: the whole scene)
+    :param aoi_mask: optional util.AOICellMask at full resolution
+    :return: (uint8 labels, float32 max class probability, (row, col) coarse offset of both arrays)
+    """
+    from util import generate_windows
+    from dataloader import raw_tensor
+
+    with rasterio.open(tif_path) as src:
+        indexes = bands or list(range(1, src.count + 1))
+        coarse_height, coarse_width = math.ceil(src.height / factor), math.ceil(src.width / factor)
+        row0, col0, row1, col1 = 0, 0, coarse_height, coarse_width
+        if windows is not None:
+            # Coarse bounds of the windows, one coarse pixel wider like the refine decision
+            row0 = max(min(w.row_off for w in windows) // factor - 1, 0)
+            col0 = max(min(w.col_off for w in windows) // factor - 1, 0)
+            row1 = min(max(math.ceil((w.row_off + w.height) / factor) for w in windows) + 1, coarse_height)
+            col1 = min(max(math.ceil((w.col_off + w.width) / factor) for w in windows) + 1, coarse_width)
+        scene = Window(0, 0, src.width, src.height)
+        window = Window(col0 * factor, row0 * factor, (col1 - col0) * factor, (row1 - row0) * factor)
+        window = window.intersection(scene)
+        shape = (len(indexes), row1 - row0, col1 - col0)
+        image = src.read(indexes=indexes, window=window, out_shape=shape, resampling=Resampling.average)
+
+    labels = np.zeros(shape[1:], dtype='uint8')
+    confidence = np.zeros(shape[1:], dtype='float32')
+    tiles = generate_windows(shape[2], shape[1], patch_size=patch_size)
+    if aoi_mask is not None:
+        # A refined window touches the AOI, so every coarse pixel its decision reads lies within
+        # one window plus one coarse pixel of it
+        margin = patch_size + factor
+        tiles = [t for t in tiles if aoi_mask.intersects(Window(
+            (t.col_off + col0) * factor - margin, (t.row_off + row0) * factor - margin,
+            t.width * factor + 2 * margin, t.height * factor + 2 * margin).intersection(scene))]
+    in_channels = model_input_channels(model)
+
+    with torch.no_grad():
+        for start in range(0, len(tiles), batch_size):
+            batch = tiles[start:start + batch_size]
+            X = torch.stack([raw_tensor(image[:, w.row_off:w.row_off + w.height, w.col_off:w.col_off + w.width])
+                             for w in batch]).to(device)
+            if not X.is_floating_point():
+                X = prepare_batch(X, out_channels=in_channels)
+            probs = torch.softmax(model(X)['out'], dim=1)
+            best, label = probs.max(dim=1)
+            for w, p, l in zip(batch, best.cpu().numpy(), label.cpu().numpy()):
+                region = (slice(w.row_off, w.row_off + w.height), slice(w.col_off, w.col_off + w.width))
+                confidence[region] = p
+                labels[region] = l
+
+    return labels, confidence, (row0, col0)
+
+
+def _compare_masks(path, reference_path):
+    """Pixel agreement and water IoU of a label mask against a reference mask (nodata ignored)."""
+    agree = valid = intersection = union = 0
+    with rasterio.open(path) as src, rasterio.open(reference_path) as ref:
+        for _, window in ref.block_windows(1):
+            a, b = src.read(1, window=window), ref.read(1, window=window)
+            mask = (a != NODATA_LABEL) & (b != NODATA_LABEL)
+            agree += int((a == b)[mask].sum())
+            valid += int(mask.sum())
+            intersection += int(((a == 1) & (b == 1))[mask].sum())
+            union += int(((a == 1) | (b == 1))[mask].sum())
+
+    return {
+        "pixel_agreement": agree / valid if valid else 1.0,
+        "water_iou": intersection / union if union else 1.0,
+    }
+
+
+@timed("run_adaptive_inference")
+def run_adaptive_inference(model, tif_path, output_path, device, patch_size=512, overlap=0, factor=4,
+                           min_confidence=0.9, batch_size=4, loader_workers=0, bands=None, aoi_path=None,
+                           aoi_buffer=0, compare=False, cog=True, compress="deflate"):
+    """
+    Coarse-to-fine windowed inference: run the model once over the scene downsampled by `factor`
+    (with an AOI, only over the part of it around the AOI), then run it at full resolution only
+    on the windows where the coarse prediction (plus one coarse pixel around the window) has a
+    land/water boundary or a probability below `min_confidence`. The other windows are filled
+    with their single coarse label.
+
+    :param model: segmentation model returning {'out': logits}
+    :param tif_path: merged scene raster
+    :param output_path: path of the single-band prediction GeoTIFF
+    :param device: torch device
+    :param patch_size: window size, at both resolutions
+    :param overlap: window overlap, see run_windowed_inference
+    :param factor: downsampling factor of the coarse pass
+    :param min_confidence: coarse class probability under which a window is refined
+    :param batch_size: batch size of both passes
+    :param loader_workers: DataLoader worker processes of the full-resolution pass
+    :param bands: band indexes to read (None reads all)
+    :param aoi_path: optional AOI, see dataloader.SentinelWindowDataset
+    :param aoi_buffer: AOI buffer in pixels
+    :param compare: also run the full-resolution pass on every window (to <output>_full.tif)
+                    and report the agreement of both masks
+    :param cog: write Cloud-Optimized GeoTIFFs, see run_windowed_inference
+    :param compress: GDAL compression of the COGs
+    :return: report dict
+    """
+    from dataloader import SentinelWindowDataset
+
+    model.eval()
+    model.to(device)
+
+    start = time.perf_counter()
+    dataset = SentinelWindowDataset(tif_path, patch_size=patch_size, overlap=overlap, bands=bands, raw=True,
+                                    aoi_path=aoi_path, aoi_buffer=aoi_buffer)
+    refine, fills = [], []
+    if dataset.windows:
+        # With an AOI, the coarse pass only covers the windows that are written
+        with metrics.timer("run_adaptive_inference.coarse"):
+            labels, confidence, (row0, col0) = _coarse_prediction(
+                model, tif_path, device, factor, patch_size, bands=bands, batch_size=batch_size,
+                windows=dataset.windows, aoi_mask=dataset.aoi_mask)
+
+    for window in dataset.windows:
+        rows = slice(max(window.row_off // factor - 1, 0) - row0,
+                     math.ceil((window.row_off + window.height) / factor) + 1 - row0)
+        cols = slice(max(window.col_off // factor - 1, 0) - col0,
+                     math.ceil((window.col_off + window.width) / factor) + 1 - col0)
+        region = labels[rows, cols]
+        if region.min() == region.max() and confidence[rows, cols].min() >= min_confidence:
+            fills.append((window, int(region.flat[0])))
+        else:
+            refine.append(window)
+
+    num_windows = len(dataset.windows)
+    dataset.windows = refine
+    print(f"Adaptive inference: refining {len(refine)} of {num_windows} windows at full resolution")
+    run_windowed_inference(model, make_dataloader(dataset, batch_size=batch_size, loader_workers=loader_workers),
+                           output_path, device, overlap=overlap, fills=fills, cog=cog, compress=compress)
+
+    report = {
+        "windows": num_windows,
+        "refined": len(refine),
+        "full_res_passes_avoided": len(fills) / num_windows if num_windows else 0.0,
+        "seconds": round(time.perf_counter() - start, 3),
+    }
+
+    if compare:
+        full_path = os.path.splitext(output_path)[0] + "_full.tif"
+        full = SentinelWindowDataset(tif_path, patch_size=patch_size, overlap=overlap, bands=bands, raw=True,
+                                     aoi_path=aoi_path, aoi_buffer=aoi_buffer)
+        start = time.perf_counter()
+        run_windowed_inference(model, make_dataloader(full, batch_size=batch_size, loader_workers=loader_workers),
+                               full_path, device, overlap=overlap, cog=cog, compress=compress)
+        report["full_seconds"] = round(time.perf_counter() - start, 3)
+        report.update(_compare_masks(output_path, full_path))
+
+    print("Adaptive inference: " + ", ".join(
+        f"{k} {v:.4f}" if isinstance(v, float) else f"{k} {v}" for k, v in report.items()))
+    return report
+
+
+def make_dataloader(dataset, batch_size=4, loader_workers=0, prefetch_factor=2, pin_memory=False):
+    """DataLoader for inference: ordered, with optional worker processes prefetching batches."""
+    kwargs = {}
+    if loader_workers > 0:
+        kwargs.update(prefetch_factor=prefetch_factor)
+    return DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=loader_workers,
+                      pin_memory=pin_memory, **kwargs)
+
+
+def _inference_worker(rank, engine, weights, dataset, indices, output_dir, threads, batch_size, loader_workers,
+                      save_probabilities, fold_channels, cache, prefilter, results):
+    # Imported here so the spawned worker only pays for what it uses
+    from engines import load_engine
+
+    # Pin the intra-op parallelism so replicas do not oversubscribe the cores
+    torch.set_num_threads(threads)
+    model = load_engine(engine, weights, device="cpu", num_threads=threads, fold_channels=fold_channels)
+    dataloader = make_dataloader(Subset(dataset, indices), batch_size=batch_size, loader_workers=loader_workers)
+
+    # The cache and prefilter are copies; only what this worker adds to their counters is sent back
+    cache_before = (cache.hits, cache.misses) if cache is not None else (0, 0)
+    prefilter_before = dict(prefilter.counts) if prefilter is not None else {}
+
+    start = time.perf_counter()
+    count = run_inference(model, dataloader, output_dir, "cpu", save_probabilities=save_probabilities, cache=cache,
+                          prefilter=prefilter, report=False)
+    cache_counts = (cache.hits - cache_before[0], cache.misses - cache_before[1]) if cache is not None else (0, 0)
+    prefilter_counts = {name: value - prefilter_before[name] for name, value in prefilter.counts.items()} \
+        if prefilter is not None else {}
+    results.put((rank, count, time.perf_counter() - start, cache_counts, prefilter_counts))
+
+
+def run_sharded_inference(engine, weights, dataset, output_dir, workers=2, threads_per_worker=None, batch_size=4,
+                          loader_workers=1, save_probabilities=False, fold_channels=False, cache=None,
+                          prefilter=None):
+    """
+    CPU data-parallel inference: split the patches into contiguous shards and run one model replica
+    per shard in its own process, each with a fixed number of torch threads and its own prefetching
+    loader workers. Predictions land in the same output directory, one file per patch, so the shards
+    need no merging.
+
+    :param engine: runtime backend, see engines.load_engine
+    :param weights: model file for the engine
+    :param dataset: patch dataset (SentinelDataset or SentinelArrayDataset), must be picklable
+    :param output_dir: directory for the prediction patches
+    :param workers: number of model replicas / processes
+    :param threads_per_worker: torch intra-op threads per replica (default: CPUs / workers)
+    :param batch_size: batch size per replica
+    :param loader_workers: DataLoader worker processes per replica
+    :param save_probabilities: see run_inference
+    :param fold_channels: see model_utils.load_model
+    :param cache: optional cache.PredictionCache, shared on disk by all workers
+    :param prefilter: optional preprocessing.PatchPrefilter, copied to every worker; the counts of all
+                      workers are added to it and reported once
+    :return: number of patches predicted
+    """
+    threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // workers)
+    shards = [list(shard) for shard in torch.arange(len(dataset)).tensor_split(workers) if len(shard)]
+
+    ctx = mp.get_context("spawn")
+    results = ctx.Queue()
+    processes = [
+        ctx.Process(target=_inference_worker,
+                    args=(rank, engine, weights, dataset, [int(i) for i in shard], output_dir, threads_per_worker,
+                          batch_size, loader_workers, save_probabilities, fold_channels, cache, prefilter, results))
+        for rank, shard in enumerate(shards)
+    ]
+
+    start = time.perf_counter()
+    for process in processes:
+        process.start()
+
+    # Drain the results before joining so no worker blocks on a full queue
+    reports = []
+    while len(reports) < len(processes):
+        try:
+            reports.append(results.get(timeout=1))
+        except queue.Empty:
+            failed = [p for p in processes if p.exitcode not in (None, 0)]
+            if failed:
+                for process in processes:
+                    process.terminate()
+                raise RuntimeError(f"Inference worker exited with code {failed[0].exitcode}")
+    for process in processes:
+        process.join()
+    elapsed = time.perf_counter() - start
 
+    total = 0
+    for rank, count, seconds, (hits, misses), prefilter_counts in sorted(reports, key=lambda r: r[0]):
+        total += count
+        print(f"Worker {rank}: {count} patches in {seconds:.1f}s ({count / seconds:.2f} patches/s)")
+        if cache is not None:
+            cache.hits += hits
+            cache.misses += misses
+        for name, value in prefilter_counts.items():
+            prefilter.counts[name] += value
+    print(f"Sharded inference: {total} patches in {elapsed:.1f}s ({total / elapsed:.2f} patches/s) "
+          f"with {len(processes)} workers x {threads_per_worker} threads")
+    if cache is not None:
+        cache.report()
+    if prefilter is not None:
+        prefilter.report()
 
+    return total
 
@@ -0,0 +1,234 @@
+import os
+import sys
+import json
+import time
+import resource
+import functools
+import threading
+import contextlib
+from collections import defaultdict
+
+
+def peak_rss_mb():
+    """High-water mark of this process's resident memory (the OS reports it in kB on Linux, bytes on macOS)."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+def current_rss_mb():
+    """Resident memory of this process right now (Linux /proc); elsewhere the high-water mark."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+    except (OSError, ValueError):
+        return peak_rss_mb()
+
+
+@contextlib.contextmanager
+def sample_rss(interval=0.01):
+    """
+    Sample the resident memory of the process in a background thread while the block runs.
+
+    :param interval: sampling interval in seconds
+    :return: dict whose "start" and "peak" (MB) are filled in
+    """
+    sampled = {"start": current_rss_mb()}
+    sampled["peak"] = sampled["start"]
+    stop = threading.Event()
+
+    def _sample():
+        while not stop.wait(interval):
+            sampled["peak"] = max(sampled["peak"], current_rss_mb())
+
+    thread = threading.Thread(target=_sample, daemon=True)
+    thread.start()
+    try:
+        yield sampled
+    finally:
+        stop.set()
+        thread.join()
+        sampled["peak"] = max(sampled["peak"], current_rss_mb())
+
+
+class Metrics:
+    """
+    In-process registry of stage timers, counters and gauges, safe to update from writer threads.
+
+    Timers accumulate calls and wall time per name; names are dotted per stage, e.g.
+    "run_inference.forward". Counters sum quantities such as "run_inference.patches" or
+    "split_and_save_patches.bytes_read". Gauges keep the last and the maximum value of a level
+    such as a queue depth. DataLoader and pool workers are separate processes, so what they
+    record stays in the worker.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.profile_mode = None
+        self.profile_stages = ()
+        self.profile_dir = "."
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.timers = defaultdict(lambda: {"calls": 0, "seconds": 0.0, "max_seconds": 0.0})
+            self.counters = defaultdict(float)
+            self.gauges = {}
+            self.memory = {}
+
+    def observe(self, name, seconds):
+        with self._lock:
+            timer = self.timers[name]
+            timer["calls"] += 1
+            timer["seconds"] += seconds
+            timer["max_seconds"] = max(timer["max_seconds"], seconds)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def gauge(self, name, value):
+        with self._lock:
+            last_max = self.gauges.get(name, {}).get("max", value)
+            self.gauges[name] = {"last": value, "max": max(last_max, value)}
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Time a whole stage, sample the resident memory while it runs and profile it if configured.
+        The stage records its peak RSS and how far it raised the RSS above where it started (the
+        largest of its calls), not the process high-water mark, which an earlier stage may have set.
+        """
+        with self._profiled(name), self.timer(name), sample_rss() as rss:
+            yield
+        with self._lock:
+            memory = self.memory.setdefault(name, {"peak_rss_mb": 0.0, "rss_delta_mb": 0.0})
+            memory["peak_rss_mb"] = max(memory["peak_rss_mb"], rss["peak"])
+            memory["rss_delta_mb"] = max(memory["rss_delta_mb"], rss["peak"] - rss["start"])
+
+    def configure_profiling(self, mode, stages, output_dir="."):
+        """
+        Wrap the named stages in a profiler.
+
+        :param mode: 'cprofile' (a .prof file per stage, for pstats/snakeviz) or 'torch'
+                     (torch.profiler, a Chrome trace per stage plus an operator summary)
+        :param stages: stage names to profile
+        :param output_dir: folder for the profiles
+        """
+        if mode not in (None, "cprofile", "torch"):
+            raise ValueError(f"Unknown profiler: {mode}")
+        self.profile_mode = mode
+        self.profile_stages = tuple(stages)
+        self.profile_dir = output_dir
+
+    @contextlib.contextmanager
+    def _profiled(self, name):
+        if self.profile_mode is None or name not in self.profile_stages:
+            yield
+            return
+
+        os.makedirs(self.profile_dir, exist_ok=True)
+        if self.profile_mode == "cprofile":
+            import cProfile
+
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+                path = os.path.join(self.profile_dir, f"{name}.prof")
+                profiler.dump_stats(path)
+                print(f"Profile of {name} saved to: {path}")
+        else:
+            import torch
+            from torch.profiler import ProfilerActivity, profile
+
+            activities = [ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(ProfilerActivity.CUDA)
+            with profile(activities=activities) as profiler:
+                yield
+            path = os.path.join(self.profile_dir, f"{name}.trace.json")
+            profiler.export_chrome_trace(path)
+            print(profiler.key_averages().table(sort_by="self_cpu_time_total", row_limit=15))
+            print(f"Profile of {name} saved to: {path}")
+
+    def snapshot(self):
+        """All metrics as a JSON-serializable dict, with patches/s and MB/s derived per stage."""
+        with self._lock:
+            stages = {}
+            for name, timer in self.timers.items():
+                stage = dict(timer, seconds=round(timer["seconds"], 6), max_seconds=round(timer["max_seconds"], 6))
+                patches = self.counters.get(f"{name}.patches")
+                if patches and timer["seconds"] > 0:
+                    stage["patches_per_s"] = round(patches / timer["seconds"], 3)
+                moved = self.counters.get(f"{name}.bytes_read", 0) + self.counters.get(f"{name}.bytes_written", 0)
+                if moved and timer["seconds"] > 0:
+                    stage["mb_per_s"] = round(moved / 1024 ** 2 / timer["seconds"], 3)
+                if name in self.memory:
+                    stage.update({key: round(value, 1) for key, value in self.memory[name].items()})
+                stages[name] = stage
+
+            return {
+                "stages": stages,
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "peak_rss_mb": round(peak_rss_mb(), 1),
+            }
+
+    def write_json(self, path):
+        _atomic_write(path, json.dumps(self.snapshot(), indent=2))
+        print(f"Metrics saved to: {path}")
+
+    def write_prometheus(self, path, prefix="coastline"):
+        """Write the metrics in the Prometheus text format, e.g. for node_exporter's textfile collector."""
+        snapshot = self.snapshot()
+        lines = [
+            f"# TYPE {prefix}_stage_seconds_total counter",
+            *(f'{prefix}_stage_seconds_total{{stage="{name}"}} {s["seconds"]}' for name, s in snapshot["stages"].items()),
+            f"# TYPE {prefix}_stage_calls_total counter",
+            *(f'{prefix}_stage_calls_total{{stage="{name}"}} {s["calls"]}' for name, s in snapshot["stages"].items()),
+            f"# TYPE {prefix}_stage_peak_rss_bytes gauge",
+            *(f'{prefix}_stage_peak_rss_bytes{{stage="{name}"}} {int(s["peak_rss_mb"] * 1024 ** 2)}'
+              for name, s in snapshot["stages"].items() if "peak_rss_mb" in s),
+            f"# TYPE {prefix}_stage_rss_increase_bytes gauge",
+            *(f'{prefix}_stage_rss_increase_bytes{{stage="{name}"}} {int(s["rss_delta_mb"] * 1024 ** 2)}'
+              for name, s in snapshot["stages"].items() if "rss_delta_mb" in s),
+            f"# TYPE {prefix}_count_total counter",
+            *(f'{prefix}_count_total{{name="{name}"}} {value}' for name, value in snapshot["counters"].items()),
+            f"# TYPE {prefix}_gauge_max gauge",
+            *(f'{prefix}_gauge_max{{name="{name}"}} {g["max"]}' for name, g in snapshot["gauges"].items()),
+        ]
+        _atomic_write(path, "\n".join(lines) + "\n")
+        print(f"Metrics saved to: {path}")
+
+
+def _atomic_write(path, text):
+    # Scrapers must never read a half-written file
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        f.write(text)
+    os.replace(path + ".tmp", path)
+
+
+# Process-wide registry used by the pipeline modules
+metrics = Metrics()
+
+
+def timed(name):
+    """Decorator recording every call of a function as the stage `name`."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with metrics.stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -1,40 +1,152 @@
 
 
 import os
+import time
 import argparse
-import torch
-from dataloader import SentinelDataset
-from torch.utils.data import DataLoader
 
-from inference import run_inference
-from stitching import stitch_tiff_patches
-from model_utils import load_model
+from instrumentation import metrics
+
+DESCRIPTION = "Inference + Stitching pipeline for segmentation models on GeoTIFF patches."
+
 
 def main(args):
+    # torch and the modules built on it are only imported once there is something to infer,
+    # so --help and the CLI start quickly
+    import torch
+    from dataloader import SentinelDataset, SentinelWindowDataset, SentinelArrayDataset
+    from inference import run_inference, run_windowed_inference, run_sharded_inference, run_adaptive_inference, \
+        make_dataloader
+    from stitching import stitch_tiff_patches, stitch_tiff_patches_blockwise, stitch_blended_patches
+    from engines import load_engine
+    from cache import PredictionCache, file_digest
+    from preprocessing import PatchPrefilter
+
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-    model = load_model(args.weights, device=device)
-    dataset = SentinelDataset(args.data_path)
-    dataloader = DataLoader(dataset, batch_size=args.batch_size, shuffle=False)
+    if args.engine == "onnxruntime" or args.workers > 1:
+        device = torch.device("cpu")
+    if args.threads_per_worker:
+        torch.set_num_threads(args.threads_per_worker)
+
+    if args.input_tif:
+        # Windowed mode: read tiles straight from the merged scene, no patch files
+        model = load_engine(args.engine, args.weights, device=device, fold_channels=args.fold_channels)
+        output_mosaic_path = os.path.join(args.output_dir, "stitched_output.tif")
+        if args.adaptive_factor:
+            # Coarse pass over the downsampled scene, full resolution only around the shoreline
+            run_adaptive_inference(model, args.input_tif, output_mosaic_path, device, patch_size=args.patch_size,
+                                   overlap=args.overlap, factor=args.adaptive_factor,
+                                   min_confidence=args.adaptive_confidence, batch_size=args.batch_size,
+                                   loader_workers=args.loader_workers, aoi_path=args.aoi, aoi_buffer=args.aoi_buffer,
+                                   compare=args.adaptive_compare, cog=not args.no_cog)
+            return
+
+        dataset = SentinelWindowDataset(args.input_tif, patch_size=args.patch_size, overlap=args.overlap, raw=True,
+                                        aoi_path=args.aoi, aoi_buffer=args.aoi_buffer)
+        dataloader = make_dataloader(dataset, batch_size=args.batch_size, loader_workers=args.loader_workers)
+        run_windowed_inference(model, dataloader, output_mosaic_path, device, overlap=args.overlap,
+                               cog=not args.no_cog)
+        return
+
+    if os.path.isfile(os.path.join(args.data_path, "patches.json")):
+        # Memory-mapped patch store from split_and_save_patches(..., output_format="npy")
+        dataset = SentinelArrayDataset(args.data_path)
+    else:
+        dataset = SentinelDataset(args.data_path, raw=True)
 
     output_dir = os.path.join(args.output_dir, "inference_outputs")
-    run_inference(model, dataloader, output_dir, device)
+
+    cache = None
+    if args.cache_dir:
+        # Anything that changes the model output is part of the digest
+        model_digest = f"{file_digest(args.weights)}:{args.engine}:{args.fold_channels}"
+        cache = PredictionCache(args.cache_dir, model_digest, max_bytes=args.cache_size_mb * 1024 ** 2)
+
+    prefilter = None
+    if args.prefilter:
+        prefilter = PatchPrefilter(max_nodata_fraction=args.max_nodata_fraction, water_ndwi=args.water_ndwi,
+                                   land_ndwi=args.land_ndwi, min_fraction=args.homogeneous_fraction)
+
+    if args.workers > 1:
+        # One model replica per process, each on its own shard of the patches
+        run_sharded_inference(args.engine, args.weights, dataset, output_dir, workers=args.workers,
+                              threads_per_worker=args.threads_per_worker, batch_size=args.batch_size,
+                              loader_workers=args.loader_workers, save_probabilities=args.blend,
+                              fold_channels=args.fold_channels, cache=cache, prefilter=prefilter)
+    else:
+        model = load_engine(args.engine, args.weights, device=device, fold_channels=args.fold_channels)
+        dataloader = make_dataloader(dataset, batch_size=args.batch_size, loader_workers=args.loader_workers,
+                                     pin_memory=device.type == "cuda")
+        start = time.perf_counter()
+        count = run_inference(model, dataloader, output_dir, device, save_probabilities=args.blend, cache=cache,
+                              prefilter=prefilter)
+        elapsed = time.perf_counter() - start
+        print(f"{count} patches in {elapsed:.1f}s ({count / max(elapsed, 1e-9):.2f} patches/s)")
 
     if args.stitch:
         print("Stitching...")
         output_mosaic_path = os.path.join(args.output_dir, "stitched_output.tif")
-        stitch_tiff_patches(output_dir, output_mosaic_path)
+        cog = not args.no_cog
+        if args.blend:
+            stitch_blended_patches(output_dir, output_mosaic_path, overlap=args.overlap, cog=cog)
+        elif args.max_memory_mb:
+            stitch_tiff_patches_blockwise(output_dir, output_mosaic_path, max_memory_mb=args.max_memory_mb, cog=cog)
+        else:
+            stitch_tiff_patches(output_dir, output_mosaic_path, cog=cog)
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Inference + Stitching pipeline for segmentation models on GeoTIFF patches.")
-    parser.add_argument("--data_path", required=True, help="Path to folder with input TIFF patches.")
-    parser.add_argument("--weights", required=True, help="Path to model weights (.pth).")
+def add_arguments(parser):
+    """Inference options, shared by `python main.py` and `python cli.py infer`."""
+    inputs = parser.add_mutually_exclusive_group(required=True)
+    inputs.add_argument("--data_path", help="Path to folder with input TIFF patches or a patches.json/patches.dat array store.")
+    inputs.add_argument("--input_tif", help="Merged scene raster (e.g. combined_4band.tif) for windowed inference without patch files.")
+    parser.add_argument("--weights", required=True, help="Path to model weights (.pth), or the exported model for --engine.")
+    # Same as engines.ENGINES, which is not imported here because engines.py loads torch
+    parser.add_argument("--engine", choices=["eager", "torchscript", "onnxruntime"], default="eager", help="Runtime backend (export with `cli.py export`).")
     parser.add_argument("--output_dir", default="outputs", help="Directory to save inference and stitched outputs.")
     parser.add_argument("--batch_size", type=int, default=4, help="Batch size for inference.")
     parser.add_argument("--stitch", action="store_false", help="Stitch output TIFFs into a mosaic.")
+    parser.add_argument("--max_memory_mb", type=int, help="Stitch block by block within this memory budget (MB).")
+    parser.add_argument("--no_cog", action="store_true", help="Write the mosaic as a plain GeoTIFF instead of a Cloud-Optimized GeoTIFF.")
+    parser.add_argument("--fold_channels", action="store_true", help="Fold the duplicated input channels into conv1 so the model takes the 4 raw bands.")
+    parser.add_argument("--workers", type=int, default=1, help="Model replicas (processes) for CPU data-parallel inference.")
+    parser.add_argument("--threads_per_worker", type=int, help="torch intra-op threads per replica (default: CPUs / workers).")
+    parser.add_argument("--loader_workers", type=int, default=2, help="DataLoader worker processes (per replica) prefetching patches.")
+    parser.add_argument("--cache_dir", help="Directory of a persistent prediction cache; unchanged patches skip the model.")
+    parser.add_argument("--cache_size_mb", type=int, default=2048, help="Prediction cache size limit (LRU eviction).")
+    parser.add_argument("--blend", action="store_true", help="Save class probabilities and blend overlapping patches when stitching.")
+    parser.add_argument("--prefilter", action="store_true", help="Label nodata and homogeneous water/land patches from NDWI without the model.")
+    parser.add_argument("--max_nodata_fraction", type=float, default=1.0, help="Prefilter: nodata fraction from which a patch is labelled nodata.")
+    parser.add_argument("--water_ndwi", type=float, default=0.2, help="Prefilter: NDWI above which a pixel is confidently water.")
+    parser.add_argument("--land_ndwi", type=float, default=-0.2, help="Prefilter: NDWI below which a pixel is confidently land.")
+    parser.add_argument("--homogeneous_fraction", type=float, default=0.999, help="Prefilter: fraction of valid pixels that must agree.")
+    parser.add_argument("--patch_size", type=int, default=512, help="Window size for windowed inference.")
+    parser.add_argument("--overlap", type=int, default=10, help="Patch/window overlap in pixels.")
+    parser.add_argument("--aoi", help="Windowed mode: only infer the windows intersecting this AOI (e.g. boundary.geojson).")
+    parser.add_argument("--aoi_buffer", type=int, default=0, help="Buffer around the AOI in pixels.")
 
-    args = parser.parse_args()
+    parser.add_argument("--adaptive_factor", type=int, help="Windowed mode: coarse pass at 1/factor resolution, full resolution only near boundaries.")
+    parser.add_argument("--adaptive_confidence", type=float, default=0.9, help="Coarse probability under which a window is refined.")
+    parser.add_argument("--adaptive_compare", action="store_true", help="Also run the full pass and report the agreement of both masks.")
+    parser.add_argument("--metrics_json", help="Write per-stage timings, counters and queue depths to this JSON file.")
+    parser.add_argument("--metrics_prom", help="Write the same metrics as a Prometheus textfile (e.g. for node_exporter).")
+    parser.add_argument("--profile", choices=["cprofile", "torch"], help="Profile the --profile_stage stages.")
+    parser.add_argument("--profile_stage", nargs="+", default=["run_inference"], help="Stages to profile, e.g. run_inference stitch_tiff_patches.")
+    parser.add_argument("--profile_dir", default="profiles", help="Directory for the profiles.")
+    return parser
+
+
+def run(args):
+    """main() with the profiling and metrics options applied around it."""
+    if args.profile:
+        metrics.configure_profiling(args.profile, args.profile_stage, args.profile_dir)
     main(args)
 
+    if args.metrics_json:
+        metrics.write_json(args.metrics_json)
+    if args.metrics_prom:
+        metrics.write_prometheus(args.metrics_prom)
 
 
+if __name__ == "__main__":
+    parser = add_arguments(argparse.ArgumentParser(description=DESCRIPTION))
+    run(parser.parse_args())
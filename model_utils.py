@@ -1,11 +1,49 @@
-
-
 import torch.nn as nn
 from torchvision.models.segmentation import deeplabv3_resnet50
 import torch
 
-def load_model(weight_path, in_channels=6, num_classes=2, device="cpu"):
-    model = deeplabv3_resnet50(pretrained=False, num_classes=num_classes)
+# Channels 4 and 5 of the trained model are copies of channel 0 (see dataloader.preprocess_image)
+DUPLICATED_CHANNELS = {4: 0, 5: 0}
+
+
+def fold_duplicated_channels(model, duplicated=DUPLICATED_CHANNELS):
+    """
+    Fold input channels that are only ever fed copies of another channel into that channel's
+    conv1 weights, so the model consumes the raw bands directly (conv is linear in its input).
+
+    :param model: deeplabv3 model with the 6-channel conv1
+    :param duplicated: mapping of duplicated channel -> source channel
+    :return: the model, with a conv1 taking len(kept channels) inputs
+    """
+    conv1 = model.backbone.conv1
+    weight = conv1.weight.detach().clone()
+    for channel, source in duplicated.items():
+        weight[:, source] += weight[:, channel]
+
+    keep = [c for c in range(conv1.in_channels) if c not in duplicated]
+    folded = nn.Conv2d(len(keep), conv1.out_channels, kernel_size=conv1.kernel_size, stride=conv1.stride,
+                       padding=conv1.padding, bias=False)
+    folded.weight.data.copy_(weight[:, keep])
+    model.backbone.conv1 = folded
+    return model
+
+
+def model_input_channels(model, default=6):
+    """Number of input channels of the model's first conv (default if it cannot be inspected)."""
+    if hasattr(model, "in_channels"):
+        # Exported engines (see engines.py) record it explicitly
+        return model.in_channels
+    try:
+        return model.backbone.conv1.in_channels
+    except AttributeError:
+        return default
+
+
+def load_model(weight_path, in_channels=6, num_classes=2, device="cpu", fold_channels=False):
+    # The trained weights replace everything, so skip downloading the ImageNet backbone
+    model = deeplabv3_resnet50(weights=None, weights_backbone=None, num_classes=num_classes)
     model.backbone.conv1 = nn.Conv2d(in_channels, 64, kernel_size=7, stride=2, padding=3, bias=False)
     model.load_state_dict(torch.load(weight_path, map_location=device), strict=False)
+    if fold_channels:
+        model = fold_duplicated_channels(model)
     return model
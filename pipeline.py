@@ -0,0 +1,299 @@
+import os
+import glob
+import json
+import time
+import shutil
+import hashlib
+import argparse
+from pathlib import Path
+
+from util import find_img_data_folder, batch_re_projection, combine_bands, split_and_save_patches
+
+BAND_LIST = ["02", "03", "04", "08"]  # the 10m bands
+
+
+def fingerprint(path, checksum=False):
+    """
+    Cheap identity of a file or directory: size and mtime, or a content digest with checksum=True.
+    A directory is fingerprinted through the fingerprints of the files directly inside it.
+
+    :param path: file or directory path
+    :param checksum: hash the file contents instead of trusting size + mtime
+    :return: fingerprint string, or None if the path does not exist
+    """
+    if os.path.isdir(path):
+        digest = hashlib.blake2b(digest_size=20)
+        for name in sorted(os.listdir(path)):
+            digest.update(f"{name}:{fingerprint(os.path.join(path, name), checksum)}".encode())
+        return digest.hexdigest()
+
+    if not os.path.exists(path):
+        return None
+
+    if checksum:
+        digest = hashlib.blake2b(digest_size=20)
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    stat = os.stat(path)
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def load_manifest(manifest_dir, stage):
+    path = os.path.join(manifest_dir, f"{stage}.json")
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(manifest_dir, stage, manifest):
+    os.makedirs(manifest_dir, exist_ok=True)
+    path = os.path.join(manifest_dir, f"{stage}.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def stage_is_current(manifest_dir, stage, input_fps, params, outputs, checksum=False):
+    """Whether the stage's manifest shows it completed with the same inputs, parameters and (unchanged) outputs."""
+    manifest = load_manifest(manifest_dir, stage)
+    return bool(manifest.get("completed")
+                and manifest.get("inputs") == input_fps
+                and manifest.get("params") == params
+                and all(manifest["outputs"].get(path) == fingerprint(path, checksum) for path in outputs))
+
+
+def record_stage(manifest_dir, stage, input_fps, params, outputs, seconds, checksum=False):
+    """Record the manifest of a stage that just completed."""
+    save_manifest(manifest_dir, stage, {
+        "stage": stage,
+        "completed": True,
+        "inputs": input_fps,
+        "params": params,
+        "outputs": {path: fingerprint(path, checksum) for path in outputs},
+        "seconds": round(seconds, 3),
+    })
+
+
+def run_stage(manifest_dir, stage, inputs, params, outputs, fn, checksum=False):
+    """
+    Run a pipeline stage unless its manifest shows it already completed with the same inputs,
+    parameters and (unchanged) outputs. A fresh manifest is recorded after the stage ran.
+
+    :param manifest_dir: directory holding one <stage>.json manifest per stage
+    :param stage: stage name
+    :param inputs: input paths
+    :param params: JSON-serializable stage parameters
+    :param outputs: output paths
+    :param fn: callable running the stage
+    :param checksum: fingerprint files by content rather than size + mtime
+    :return: True if the stage ran, False if it was skipped
+    """
+    input_fps = {path: fingerprint(path, checksum) for path in inputs}
+    if stage_is_current(manifest_dir, stage, input_fps, params, outputs, checksum):
+        print(f"Skipping {stage}: up to date")
+        return False
+
+    print(f"Running {stage}...")
+    start = time.perf_counter()
+    fn()
+    record_stage(manifest_dir, stage, input_fps, params, outputs, time.perf_counter() - start, checksum)
+    return True
+
+
+def run_reprojection_stages(manifest_dir, band_paths, proj_paths, dst_crs="EPSG:4326", checksum=False):
+    """
+    One re_projection_B<band> stage per band, with the stale bands reprojected concurrently by
+    util.batch_re_projection; each band's manifest is recorded as soon as that band is done, so
+    an interrupted run keeps the bands that finished.
+
+    :param manifest_dir: directory holding the manifests
+    :param band_paths: dict of band -> raw band path
+    :param proj_paths: dict of band -> reprojected band path
+    :param dst_crs: target CRS
+    :param checksum: fingerprint files by content rather than size + mtime
+    :return: bands that were reprojected
+    """
+    params = {"dst_crs": dst_crs}
+    input_fps = {b: {path: fingerprint(path, checksum)} for b, path in band_paths.items()}
+    stale = []
+    for b in band_paths:
+        if stage_is_current(manifest_dir, f"re_projection_B{b}", input_fps[b], params, [proj_paths[b]], checksum):
+            print(f"Skipping re_projection_B{b}: up to date")
+        else:
+            stale.append(b)
+    if not stale:
+        return []
+
+    print(f"Running re_projection for bands {', '.join(stale)}...")
+    band_of = {proj_paths[b]: b for b in stale}
+
+    def _record(in_path, out_path, seconds):
+        b = band_of[out_path]
+        record_stage(manifest_dir, f"re_projection_B{b}", input_fps[b], params, [out_path], seconds, checksum)
+
+    batch_re_projection([band_paths[b] for b in stale], [proj_paths[b] for b in stale], dst_crs=dst_crs,
+                        on_done=_record)
+    return stale
+
+
+def _clear_dir(path):
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path, exist_ok=True)
+
+
+def run_inference_stage(manifest_dir, patch_dir, output_dir, args, checksum=False, chunk_size=64):
+    """
+    Patch-level resumable inference: only patches that are new, changed or have no prediction yet
+    are inferred, and progress is recorded in the manifest after every chunk of patches, so a
+    crash loses at most one chunk.
+
+    :return: number of patches inferred
+    """
+    import torch
+    from torch.utils.data import Subset
+
+    from cache import file_digest
+    from dataloader import SentinelDataset
+    from engines import load_engine
+    from inference import run_inference, make_dataloader
+
+    stage = "run_inference"
+    params = {
+        "weights": file_digest(args.weights),
+        "engine": args.engine,
+        "blend": args.blend,
+    }
+    prefix = "prob" if args.blend else "pred"
+
+    manifest = load_manifest(manifest_dir, stage)
+    done = manifest.get("patches", {}) if manifest.get("params") == params else {}
+
+    dataset = SentinelDataset(patch_dir, raw=True)
+    patch_fps = {os.path.basename(path): fingerprint(path, checksum) for path in dataset.image_files}
+    todo = [
+        idx for idx, path in enumerate(dataset.image_files)
+        if done.get(os.path.basename(path)) != patch_fps[os.path.basename(path)]
+        or not os.path.exists(os.path.join(output_dir, f"{prefix}_{os.path.basename(path)}"))
+    ]
+    # Forget patches that no longer exist
+    done = {name: fp for name, fp in done.items() if name in patch_fps}
+
+    # The stitch stage mosaics the whole directory: predictions of patches that are gone (other patch
+    # size or AOI) and those of the other --blend mode must not end up in the mask
+    other = "pred" if args.blend else "prob"
+    if os.path.isdir(output_dir):
+        for name in os.listdir(output_dir):
+            stale = name.startswith(f"{other}_") or (name.startswith(f"{prefix}_")
+                                                     and name[len(prefix) + 1:] not in patch_fps)
+            if stale and name.lower().endswith(".tif"):
+                os.remove(os.path.join(output_dir, name))
+
+    print(f"run_inference: {len(todo)} of {len(dataset)} patches to infer")
+    if todo:
+        device = torch.device("cuda" if torch.cuda.is_available() and args.engine != "onnxruntime" else "cpu")
+        model = load_engine(args.engine, args.weights, device=device)
+
+        for start in range(0, len(todo), chunk_size):
+            chunk = todo[start:start + chunk_size]
+            dataloader = make_dataloader(Subset(dataset, chunk), batch_size=args.batch_size)
+            run_inference(model, dataloader, output_dir, device, save_probabilities=args.blend)
+
+            # run_inference has flushed its writers, so the chunk is complete on disk
+            for idx in chunk:
+                name = os.path.basename(dataset.image_files[idx])
+                done[name] = patch_fps[name]
+            save_manifest(manifest_dir, stage, {"stage": stage, "completed": False, "params": params,
+                                                "patches": done})
+
+    save_manifest(manifest_dir, stage, {"stage": stage, "completed": True, "params": params, "patches": done})
+    return len(todo)
+
+
+def run_scene(raw_data_path, work_dir, output_dir, args):
+    """
+    Run every stage for the .SAFE product found under raw_data_path, resuming from the manifests.
+
+    :param raw_data_path: folder containing the downloaded .SAFE product
+    :param work_dir: folder for the intermediate rasters, patches and manifests
+    :param output_dir: folder for the predictions and the stitched mosaic
+    :param args: parsed pipeline arguments
+    :return: path of the stitched mosaic
+    """
+    b_path = work_dir
+    reproject_path = os.path.join(b_path, "reprojection")
+    merge_output_path = os.path.join(b_path, "combined_4band.tif")
+    patch_dir = os.path.join(b_path, "patches")
+    manifest_dir = os.path.join(b_path, "manifests")
+    inference_dir = os.path.join(output_dir, "inference_outputs")
+    mosaic_path = os.path.join(output_dir, "stitched_output.tif")
+    coastline_path = os.path.join(output_dir, "coastline.gpkg")
+    os.makedirs(reproject_path, exist_ok=True)
+
+    img_data_path = find_img_data_folder(raw_data_path)
+    if img_data_path is None:
+        raise FileNotFoundError(f"No .SAFE product with IMG_DATA found under: {raw_data_path}")
+
+    # Reprojection, one stage per band
+    band_paths = {b: glob.glob(os.path.join(img_data_path, 'R10m/*_B{}_*.jp2'.format(b)))[0] for b in BAND_LIST}
+    proj_paths = {b: os.path.join(reproject_path, Path(path).stem + '_wgs84.tif') for b, path in band_paths.items()}
+    run_reprojection_stages(manifest_dir, band_paths, proj_paths, checksum=args.checksum)
+    all_bands_path = [proj_paths[b] for b in BAND_LIST]
+
+    run_stage(manifest_dir, "combine_bands", all_bands_path, {}, [merge_output_path],
+              lambda: combine_bands(all_bands_path, merge_output_path), args.checksum)
+
+    split_params = {"patch_size": args.patch_size, "overlap": args.overlap, "bands": [1, 2, 3, 4]}
+
+    def _split():
+        _clear_dir(patch_dir)  # stale patches from other parameters must not survive
+        split_and_save_patches(merge_output_path, patch_dir, patch_size=args.patch_size, overlap=args.overlap,
+                               bands=[1, 2, 3, 4], skip_partial=True)
+
+    run_stage(manifest_dir, "split_and_save_patches", [merge_output_path], split_params, [patch_dir], _split,
+              args.checksum)
+
+    run_inference_stage(manifest_dir, patch_dir, inference_dir, args, checksum=args.checksum)
+
+    def _stitch():
+        from stitching import stitch_blended_patches, stitch_tiff_patches_blockwise
+
+        if args.blend:
+            stitch_blended_patches(inference_dir, mosaic_path, overlap=args.overlap)
+        else:
+            stitch_tiff_patches_blockwise(inference_dir, mosaic_path)
+
+    run_stage(manifest_dir, "stitch_tiff_patches", [inference_dir], {"blend": args.blend}, [mosaic_path], _stitch,
+              args.checksum)
+
+    def _coastline():
+        from coastline import extract_coastline
+
+        extract_coastline(mosaic_path, coastline_path)
+
+    run_stage(manifest_dir, "extract_coastline", [mosaic_path], {}, [coastline_path], _coastline, args.checksum)
+    return mosaic_path
+
+
+def main(args):
+    base_path = Path(args.base_path)
+    run_scene(os.path.join(base_path, "Sentinel-2"), os.path.join(base_path, "data", "sentinel"), args.output_dir,
+              args)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Resumable end-to-end pipeline: only stages (and patches) whose inputs changed or that did not complete are rerun.")
+    parser.add_argument("--weights", required=True, help="Path to model weights (.pth), or the exported model for --engine.")
+    parser.add_argument("--engine", default="eager", help="Runtime backend, see engines.py.")
+    parser.add_argument("--base_path", default=os.getcwd(), help="Folder containing Sentinel-2/ and data/.")
+    parser.add_argument("--output_dir", default="outputs", help="Directory to save inference and stitched outputs.")
+    parser.add_argument("--patch_size", type=int, default=512, help="Patch size in pixels.")
+    parser.add_argument("--overlap", type=int, default=10, help="Patch overlap in pixels.")
+    parser.add_argument("--batch_size", type=int, default=4, help="Batch size for inference.")
+    parser.add_argument("--blend", action="store_true", help="Blend probability patches when stitching.")
+    parser.add_argument("--checksum", action="store_true", help="Detect changes by content hash instead of size + mtime.")
+
+    main(parser.parse_args())
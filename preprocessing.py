@@ -0,0 +1,132 @@
+import numpy as np
+import torch
+
+REFLECTANCE_SCALE = 10000.
+
+
+def to_unsigned(images):
+    """
+    Undo the int16 view the patch datasets use to hand uint16 pixels to torch without a copy
+    (torch has no usable uint16 tensors), giving int32 values in 0-65535.
+
+    :param images: int16 tensor holding raw uint16 bits
+    :return: int32 tensor
+    """
+    return images.to(torch.int32) & 0xFFFF
+
+
+def prepare_batch(images, out_channels=6):
+    """
+    Turn a raw batch of uint16 reflectance patches into model input on whatever device the
+    batch already lives on: scale to reflectance and pad with copies of the first band up to
+    the channel count the model was trained on.
+
+    :param images: raw (B, C, H, W) batch, int16 view of uint16 pixels (other dtypes are taken as-is)
+    :param out_channels: number of channels the model expects
+    :return: float32 (B, out_channels, H, W) tensor
+    """
+    if images.dtype == torch.int16:
+        images = to_unsigned(images)
+    images = images.float() / REFLECTANCE_SCALE
+
+    extra = out_channels - images.shape[1]
+    if extra > 0:
+        images = torch.cat([images, images[:, 0:1].expand(-1, extra, -1, -1)], dim=1)
+
+    return images
+
+
+class PatchPrefilter:
+    """
+    Cheap per-patch decision taken before the forward pass, from the raw bands alone:
+    patches (almost) entirely nodata are labelled nodata, and patches whose valid pixels are
+    confidently all water or all land by NDWI = (green - NIR) / (green + NIR) get that label,
+    so the model only runs on patches that actually contain a boundary.
+
+    Band positions refer to the raw patch channels (B02, B03, B04, B08).
+    """
+
+    def __init__(self, nodata=0, max_nodata_fraction=1.0, water_ndwi=0.2, land_ndwi=-0.2, min_fraction=0.999,
+                 green_band=1, nir_band=3, water_label=1, land_label=0, nodata_label=255, num_classes=2):
+        """
+        :param nodata: raw nodata value of the patches
+        :param max_nodata_fraction: patches with at least this fraction of nodata pixels are labelled nodata
+        :param water_ndwi: pixels above this NDWI count as water
+        :param land_ndwi: pixels below this NDWI count as land
+        :param min_fraction: fraction of the valid pixels that must agree to label the patch without the model
+        :param green_band: channel index of B03
+        :param nir_band: channel index of B08
+        :param water_label: class index of water
+        :param land_label: class index of land
+        :param nodata_label: label written for nodata pixels
+        :param num_classes: number of classes in probability outputs
+        """
+        self.nodata = nodata
+        self.max_nodata_fraction = max_nodata_fraction
+        self.water_ndwi = water_ndwi
+        self.land_ndwi = land_ndwi
+        self.min_fraction = min_fraction
+        self.green_band = green_band
+        self.nir_band = nir_band
+        self.water_label = water_label
+        self.land_label = land_label
+        self.nodata_label = nodata_label
+        self.num_classes = num_classes
+        self.counts = {"nodata": 0, "water": 0, "land": 0, "model": 0}
+
+    def classify(self, images):
+        """
+        Decide a whole batch at once.
+
+        :param images: (B, C, H, W) batch, raw (int16 view of uint16) or already scaled
+        :return: (labels, valid): int64 (B,) patch labels, -1 where the model is needed, and the
+                 bool (B, H, W) valid-pixel mask
+        """
+        if images.dtype == torch.int16:
+            images = to_unsigned(images)
+        images = images.float()
+
+        valid = (images != self.nodata).any(dim=1)
+        valid_fraction = valid.float().mean(dim=(1, 2))
+        valid_count = valid.sum(dim=(1, 2)).clamp(min=1)
+
+        green, nir = images[:, self.green_band], images[:, self.nir_band]
+        ndwi = (green - nir) / (green + nir).clamp(min=1e-6)
+        water = ((ndwi > self.water_ndwi) & valid).sum(dim=(1, 2)) / valid_count
+        land = ((ndwi < self.land_ndwi) & valid).sum(dim=(1, 2)) / valid_count
+
+        labels = torch.full((images.shape[0],), -1, dtype=torch.int64)
+        labels[water >= self.min_fraction] = self.water_label
+        labels[land >= self.min_fraction] = self.land_label
+        nodata = 1 - valid_fraction >= self.max_nodata_fraction
+        labels[nodata] = self.nodata_label
+
+        self.counts["nodata"] += int(nodata.sum())
+        self.counts["water"] += int((labels == self.water_label).sum())
+        self.counts["land"] += int((labels == self.land_label).sum())
+        self.counts["model"] += int((labels == -1).sum())
+        return labels, valid
+
+    def prediction(self, label, valid, probabilities=False):
+        """
+        Prediction array for a patch labelled by classify, in run_inference's output format.
+
+        :param label: patch label
+        :param valid: bool (H, W) valid-pixel mask of the patch
+        :param probabilities: one-hot uint8 probabilities (0/255) instead of labels
+        :return: uint8 array, 1 x H x W labels or num_classes x H x W probabilities
+        """
+        valid = valid.numpy() & (label != self.nodata_label)
+        if probabilities:
+            # Nodata pixels get no probability mass, so they carry no weight when blending
+            probs = np.zeros((self.num_classes,) + valid.shape, dtype='uint8')
+            if label != self.nodata_label:
+                probs[label][valid] = 255
+            return probs
+        return np.where(valid, label, self.nodata_label).astype('uint8')[None]
+
+    def report(self):
+        total = sum(self.counts.values())
+        saved = total - self.counts["model"]
+        print(f"Prefilter: {saved} of {total} forward passes saved ({self.counts['nodata']} nodata, "
+              f"{self.counts['water']} water, {self.counts['land']} land)")
@@ -1,17 +1,35 @@
-
 import os
+import math
+from collections import defaultdict
+import numpy as np
 import rasterio
+from rasterio.enums import Resampling
+from rasterio.errors import WindowError
 from rasterio.merge import merge
+from rasterio.transform import from_origin
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window, from_bounds
 import argparse
 
-def stitch_tiff_patches(input_dir, output_path):
-    """Stitch GeoTIFF patches into a single mosaic."""
-    # Find all .tif files in the directory
-    tif_files = [
-        os.path.join(input_dir, f)
-        for f in os.listdir(input_dir)
-        if f.lower().endswith(".tif")
-    ]
+from instrumentation import metrics, timed
+from util import tiled_profile, cog_output
+
+NODATA_LABEL = 255
+
+
+def _mosaic_output(output_path, cog, block_size=512, compress="deflate"):
+    """
+    Path to write a mosaic to. With cog=True it is a tiled GeoTIFF that becomes a COG with a
+    mode-resampled overview pyramid once the mosaic is complete, so viewers and windowed reads
+    only touch the tiles (or overview tiles) they need; the intermediate never outlives the call.
+    """
+    return cog_output(output_path, cog, block_size=block_size, compress=compress, resampling="mode")
+
+
+@timed("stitch_tiff_patches")
+def stitch_tiff_patches(input_dir, output_path, cog=True, compress="deflate"):
+    """Stitch the label patches (pred_*.tif) of a directory into a single mosaic (a plain GeoTIFF with cog=False)."""
+    tif_files = _list_patches(input_dir, prefix="pred_")
 
     # Open all the datasets
     src_files_to_mosaic = [rasterio.open(fp) for fp in tif_files]
@@ -26,22 +44,344 @@ def stitch_tiff_patches(input_dir, output_path):
         "transform": out_transform
     })
 
+    for src in src_files_to_mosaic:
+        src.close()
+
+    if cog:
+        out_meta = tiled_profile(out_meta, compress=compress)
+
     # Write the stitched image
-    with rasterio.open(output_path, "w", **out_meta) as dest:
+    with _mosaic_output(output_path, cog, compress=compress) as tiled_path, \
+            rasterio.open(tiled_path, "w", **out_meta) as dest:
         dest.write(mosaic)
+    metrics.count("stitch_tiff_patches.patches", len(tif_files))
+    metrics.count("stitch_tiff_patches.bytes_written", mosaic.nbytes)
 
-    for src in src_files_to_mosaic:
-        src.close()
+    print(f"Stitched image saved to: {output_path}")
+
+
+def edge_weights(height, width, overlap, mode="cosine"):
+    """
+    Per-pixel blending weights for a patch: 1 in the interior, tapering towards 0 over the
+    `overlap` pixels along each edge, so overlapping patches hand over smoothly.
+
+    :param height: patch height
+    :param width: patch width
+    :param overlap: taper width in pixels (0 gives uniform weights)
+    :param mode: 'cosine' or 'linear' taper
+    :return: float32 array, HxW
+    """
+    def _ramp(size):
+        ramp = np.ones(size, dtype='float32')
+        n = min(overlap, size // 2)
+        if n <= 0:
+            return ramp
+        # Half-pixel offset keeps the outermost weight > 0 so the mosaic border stays covered
+        t = (np.arange(n, dtype='float32') + 0.5) / n
+        if mode == "cosine":
+            taper = 0.5 - 0.5 * np.cos(np.pi * t)
+        elif mode == "linear":
+            taper = t
+        else:
+            raise ValueError(f"Unknown weighting mode: {mode}")
+        ramp[:n] = taper
+        ramp[size - n:] = taper[::-1]
+        return ramp
+
+    return np.outer(_ramp(height), _ramp(width))
+
+
+def _patch_grid(tif_files):
+    """
+    Read the georeferencing of every patch (one file open at a time) and lay them out on a
+    common mosaic grid.
+
+    :return: (mosaic profile, list of (path, row_off, col_off, height, width))
+    """
+    headers = []
+    for fp in tif_files:
+        with rasterio.open(fp) as src:
+            headers.append((fp, src.bounds, src.height, src.width))
+            if len(headers) == 1:
+                profile = src.profile.copy()
+                res_x, res_y = src.res
+            elif src.count != profile["count"]:
+                raise ValueError(f"{fp} has {src.count} bands, {tif_files[0]} has {profile['count']}: "
+                                 f"labels and probabilities cannot be stitched together")
+
+    left = min(h[1].left for h in headers)
+    top = max(h[1].top for h in headers)
+    right = max(h[1].right for h in headers)
+    bottom = min(h[1].bottom for h in headers)
+
+    patches = [
+        (fp, int(round((top - bounds.top) / res_y)), int(round((bounds.left - left) / res_x)), height, width)
+        for fp, bounds, height, width in headers
+    ]
+
+    profile.update({
+        "driver": "GTiff",
+        "width": int(round((right - left) / res_x)),
+        "height": int(round((top - bottom) / res_y)),
+        "transform": from_origin(left, top, res_x, res_y),
+    })
+
+    return profile, patches
+
+
+class PatchIndex:
+    """
+    Bucket-grid spatial index over patch pixel extents on the mosaic grid, so a block of the
+    output only has to look at (and open) the patches that actually intersect it.
+    """
+
+    def __init__(self, patches, cell_size=512):
+        self.patches = patches
+        self.cell_size = cell_size
+        self._cells = defaultdict(list)
+        for i, (_, row_off, col_off, height, width) in enumerate(patches):
+            for cell in self._cells_for(row_off, col_off, row_off + height, col_off + width):
+                self._cells[cell].append(i)
+
+    def _cells_for(self, row0, col0, row1, col1):
+        size = self.cell_size
+        for cell_row in range(row0 // size, (row1 - 1) // size + 1):
+            for cell_col in range(col0 // size, (col1 - 1) // size + 1):
+                yield cell_row, cell_col
+
+    def query(self, row0, col0, row1, col1):
+        """Patches intersecting rows [row0, row1) and columns [col0, col1), in input order."""
+        candidates = set()
+        for cell in self._cells_for(row0, col0, row1, col1):
+            candidates.update(self._cells.get(cell, ()))
+
+        hits = []
+        for i in sorted(candidates):
+            _, row_off, col_off, height, width = self.patches[i]
+            if row_off < row1 and row_off + height > row0 and col_off < col1 and col_off + width > col0:
+                hits.append(self.patches[i])
+        return hits
+
+
+def _list_patches(input_dir, prefix):
+    """
+    Prediction patches of one kind: label (pred_*.tif) or probability (prob_*.tif) patches, which
+    run_inference writes into the same directory depending on the mode.
+    """
+    tif_files = sorted(
+        os.path.join(input_dir, f)
+        for f in os.listdir(input_dir)
+        if f.startswith(prefix) and f.lower().endswith(".tif")
+    )
+    if not tif_files:
+        raise FileNotFoundError(f"No {prefix}*.tif patches found in: {input_dir}")
+    return tif_files
+
+
+@timed("stitch_tiff_patches_blockwise")
+def stitch_tiff_patches_blockwise(input_dir, output_path, max_memory_mb=256, tile_size=512, cog=True,
+                                  compress="deflate"):
+    """
+    Out-of-core variant of stitch_tiff_patches (same first-wins rule as rasterio.merge).
+
+    The output is written as a tiled GeoTIFF one block of tiles at a time; for each block only
+    the patches intersecting it are opened, so peak memory is bounded by `max_memory_mb` and
+    the number of open files by the patches overlapping one block, whatever the mosaic size.
+
+    :param input_dir: directory with prediction patches
+    :param output_path: path of the stitched GeoTIFF
+    :param max_memory_mb: memory budget for the block buffers
+    :param tile_size: internal GeoTIFF tile size (multiple of 16); blocks are whole tiles
+    :param cog: write a Cloud-Optimized GeoTIFF with mode-resampled overviews
+    :param compress: GDAL compression ('deflate', 'zstd', ...)
+    :return:
+    """
+    profile, patches = _patch_grid(_list_patches(input_dir, prefix="pred_"))
+    count = profile["count"]
+    width, height = profile["width"], profile["height"]
+    dtype = np.dtype(profile["dtype"])
+    nodata = profile.get("nodata")
+
+    # Output block + one patch read + the filled mask, per pixel
+    bytes_per_pixel = 2 * count * dtype.itemsize + 1
+    tiles_per_side = max(1, int(math.sqrt(max_memory_mb * 1024 ** 2 / bytes_per_pixel)) // tile_size)
+    block_size = tiles_per_side * tile_size
+
+    index = PatchIndex(patches, cell_size=block_size)
+
+    out_profile = tiled_profile(profile, block_size=tile_size, compress=compress)
+
+    with _mosaic_output(output_path, cog, block_size=tile_size, compress=compress) as tiled_path, \
+            rasterio.open(tiled_path, "w", **out_profile) as dst:
+        for block_top in range(0, height, block_size):
+            for block_left in range(0, width, block_size):
+                block_bottom = min(block_top + block_size, height)
+                block_right = min(block_left + block_size, width)
+                rows, cols = block_bottom - block_top, block_right - block_left
+
+                block = np.full((count, rows, cols), nodata if nodata is not None else 0, dtype=dtype)
+                filled = np.zeros((rows, cols), dtype=bool)
+
+                for fp, row_off, col_off, p_height, p_width in index.query(block_top, block_left,
+                                                                           block_bottom, block_right):
+                    # Intersection of the patch and the block, in mosaic pixel coordinates
+                    r0, r1 = max(row_off, block_top), min(row_off + p_height, block_bottom)
+                    c0, c1 = max(col_off, block_left), min(col_off + p_width, block_right)
+
+                    with rasterio.open(fp) as src:
+                        data = src.read(window=Window(c0 - col_off, r0 - row_off, c1 - c0, r1 - r0), masked=True)
+
+                    target = (slice(r0 - block_top, r1 - block_top), slice(c0 - block_left, c1 - block_left))
+                    update = ~filled[target] & ~np.ma.getmaskarray(data).all(axis=0)
+                    block[(slice(None),) + target][:, update] = data.data[:, update]
+                    filled[target] |= update
+
+                dst.write(block, window=Window(block_left, block_top, cols, rows))
+                metrics.count("stitch_tiff_patches_blockwise.bytes_written", block.nbytes)
+
+    metrics.count("stitch_tiff_patches_blockwise.patches", len(patches))
 
     print(f"Stitched image saved to: {output_path}")
 
 
+@timed("stitch_blended_patches")
+def stitch_blended_patches(input_dir, output_path, overlap=10, weighting="cosine", strip_height=1024, cog=True,
+                           compress="deflate"):
+    """
+    Stitch per-class probability patches (prob_*.tif from run_inference(save_probabilities=True))
+    by weighted averaging in the overlaps, then take the argmax once per pixel.
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Stitch multiple GeoTIFF patches into a single mosaic.")
-    parser.add_argument("input_dir", type=str, help="Path to the directory containing GeoTIFF patches.")
+    The mosaic is computed in row strips of `strip_height` rows, so peak memory is one
+    (classes x strip_height x mosaic width) float accumulator rather than the whole scene.
+
+    :param input_dir: directory with probability patches
+    :param output_path: path of the stitched label GeoTIFF
+    :param overlap: patch overlap in pixels, used as the taper width of the edge weights
+    :param weighting: 'cosine' or 'linear' edge weights
+    :param strip_height: number of mosaic rows blended at a time
+    :param cog: write a Cloud-Optimized GeoTIFF with mode-resampled overviews
+    :param compress: GDAL compression ('deflate', 'zstd', ...)
+    :return:
+    """
+    profile, patches = _patch_grid(_list_patches(input_dir, prefix="prob_"))
+    num_classes = profile["count"]
+    width, height = profile["width"], profile["height"]
+    index = PatchIndex(patches, cell_size=strip_height)
+
+    out_profile = tiled_profile(profile, compress=compress)
+    out_profile.update({
+        "count": 1,
+        "dtype": "uint8",
+        "nodata": NODATA_LABEL,
+    })
+    weights_cache = {}
+
+    with _mosaic_output(output_path, cog, compress=compress) as tiled_path, \
+            rasterio.open(tiled_path, "w", **out_profile) as dst:
+        for strip_top in range(0, height, strip_height):
+            strip_bottom = min(strip_top + strip_height, height)
+            rows = strip_bottom - strip_top
+
+            accumulator = np.zeros((num_classes, rows, width), dtype="float32")
+            weight_sum = np.zeros((rows, width), dtype="float32")
+
+            for fp, row_off, col_off, p_height, p_width in index.query(strip_top, 0, strip_bottom, width):
+                # Rows of the patch that fall inside the current strip
+                r0 = max(strip_top - row_off, 0)
+                r1 = min(strip_bottom - row_off, p_height)
+
+                with rasterio.open(fp) as src:
+                    probs = src.read(window=Window(0, r0, p_width, r1 - r0))
+                metrics.count("stitch_blended_patches.bytes_read", probs.nbytes)
+                # Probabilities are stored quantized to uint8 by run_inference
+                probs = probs.astype("float32") / 255. if probs.dtype == np.uint8 else probs.astype("float32")
+
+                key = (p_height, p_width)
+                if key not in weights_cache:
+                    weights_cache[key] = edge_weights(p_height, p_width, overlap, mode=weighting)
+                # Pixels without probability mass (nodata, see PatchPrefilter) carry no weight
+                weights = weights_cache[key][r0:r1] * (probs.sum(axis=0) > 0)
+
+                s0 = row_off + r0 - strip_top
+                accumulator[:, s0:s0 + r1 - r0, col_off:col_off + p_width] += probs * weights
+                weight_sum[s0:s0 + r1 - r0, col_off:col_off + p_width] += weights
+
+            labels = np.argmax(accumulator, axis=0).astype("uint8")
+            labels[weight_sum == 0] = NODATA_LABEL
+            dst.write(labels, 1, window=Window(0, strip_top, width, rows))
+            metrics.count("stitch_blended_patches.bytes_written", labels.nbytes)
+
+    metrics.count("stitch_blended_patches.patches", len(patches))
+
+    print(f"Blended mosaic saved to: {output_path}")
+
+
+def read_mask_bbox(mask_path, bbox, bbox_crs=None, max_size=None):
+    """
+    Read the part of a stitched mask inside a bounding box. On a tiled mask (COG) GDAL only reads
+    the tiles intersecting the box; with max_size, a large box is read decimated, from the
+    overview level closest to the requested size.
+
+    :param mask_path: stitched mask (e.g. stitched_output.tif)
+    :param bbox: (left, bottom, right, top)
+    :param bbox_crs: CRS of the bbox (default: the mask CRS)
+    :param max_size: maximum width/height of the returned array
+    :return: (uint8 labels, HxW; affine transform of the returned array)
+    """
+    with rasterio.open(mask_path) as src:
+        if bbox_crs is not None:
+            bbox = transform_bounds(bbox_crs, src.crs, *bbox)
+
+        # Round outwards to whole pixels, then clip to the mask
+        window = from_bounds(*bbox, transform=src.transform)
+        col_off, row_off = math.floor(window.col_off), math.floor(window.row_off)
+        col_end = math.ceil(window.col_off + window.width)
+        row_end = math.ceil(window.row_off + window.height)
+        try:
+            window = Window(col_off, row_off, col_end - col_off, row_end - row_off).intersection(
+                Window(0, 0, src.width, src.height))
+        except WindowError:
+            raise ValueError(f"Bounding box {bbox} does not intersect the mask: {mask_path}")
+
+        out_shape = None
+        if max_size and max(window.width, window.height) > max_size:
+            scale = max_size / max(window.width, window.height)
+            out_shape = (max(1, round(window.height * scale)), max(1, round(window.width * scale)))
+
+        labels = src.read(1, window=window, out_shape=out_shape, resampling=Resampling.nearest)
+        transform = src.window_transform(window)
+
+    if out_shape is not None:
+        transform = transform * transform.scale(window.width / out_shape[1], window.height / out_shape[0])
+    return labels, transform
+
+
+def add_arguments(parser):
+    """Stitching options, shared by `python stitching.py` and `python cli.py stitch`."""
+    parser.add_argument("input_dir", type=str, help="Directory with the pred_*.tif (or, with --blend, prob_*.tif) patches.")
     parser.add_argument("output_path", type=str, help="Output path for the stitched GeoTIFF.")
+    parser.add_argument("--max_memory_mb", type=int, help="Stitch block by block within this memory budget.")
+    parser.add_argument("--blend", action="store_true", help="Blend probability patches instead of first-wins merging.")
+    parser.add_argument("--overlap", type=int, default=10, help="Patch overlap in pixels (blend mode).")
+    parser.add_argument("--weighting", choices=["cosine", "linear"], default="cosine", help="Edge weighting (blend mode).")
+    parser.add_argument("--strip_height", type=int, default=1024, help="Rows blended at a time (blend mode).")
+    parser.add_argument("--no_cog", action="store_true", help="Write a plain GeoTIFF instead of a Cloud-Optimized GeoTIFF.")
+    parser.add_argument("--compress", choices=["deflate", "zstd", "lzw"], default="deflate", help="Compression of the mosaic.")
+    return parser
+
 
-    args = parser.parse_args()
+def run(args):
+    cog = not args.no_cog
+    if args.blend:
+        stitch_blended_patches(args.input_dir, args.output_path, overlap=args.overlap, weighting=args.weighting,
+                               strip_height=args.strip_height, cog=cog, compress=args.compress)
+    elif args.max_memory_mb:
+        stitch_tiff_patches_blockwise(args.input_dir, args.output_path, max_memory_mb=args.max_memory_mb, cog=cog,
+                                      compress=args.compress)
+    else:
+        stitch_tiff_patches(args.input_dir, args.output_path, cog=cog, compress=args.compress)
 
-    stitch_tiff_patches(args.input_dir, args.output_path)
+
+if __name__ == "__main__":
+    parser = add_arguments(argparse.ArgumentParser(description="Stitch multiple GeoTIFF patches into a single mosaic."))
+    run(parser.parse_args())
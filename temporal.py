@@ -0,0 +1,366 @@
+import os
+import glob
+import shutil
+import argparse
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import numpy as np
+import rasterio
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.transform import Affine
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window, from_bounds, transform as window_transform
+
+from coastline import WATER_LABEL, LAND_LABEL
+from instrumentation import metrics, timed
+from pipeline import load_manifest, save_manifest
+from stitching import NODATA_LABEL
+from util import read_aoi_geometries, geometry_window_from_bounds, tiled_profile, cog_output
+
+# Codes of the per-revisit change rasters (NODATA_LABEL: not observed now or never before)
+NO_CHANGE = 0
+LAND_TO_WATER = 1
+WATER_TO_LAND = 2
+
+
+def _tile_path(state_dir, tile):
+    return os.path.join(state_dir, "tiles", f"{tile[0]}_{tile[1]}.npz")
+
+
+def _previous_tile_path(state_dir, tile):
+    # State of the tile before the ingest in progress, kept until that ingest completes
+    return os.path.join(state_dir, "tiles", f"{tile[0]}_{tile[1]}.prev.npz")
+
+
+def _load_tile(state_dir, tile, shape):
+    """State of one grid tile; a tile never observed starts empty."""
+    path = _tile_path(state_dir, tile)
+    if not os.path.isfile(path):
+        return {
+            "water_count": np.zeros(shape, dtype="uint16"),
+            "valid_count": np.zeros(shape, dtype="uint16"),
+            "last_label": np.full(shape, NODATA_LABEL, dtype="uint8"),
+            "change": np.full(shape, NODATA_LABEL, dtype="uint8"),
+            "scene": np.array(""),
+        }
+    with np.load(path) as data:
+        return {name: data[name] for name in data.files}
+
+
+def _save_tile(state_dir, tile, state):
+    path = _tile_path(state_dir, tile)
+    tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+    np.savez_compressed(tmp_path, **state)
+    # Atomic, so an interrupted update leaves the previous state of the tile
+    os.replace(tmp_path, path)
+
+
+def _update_tile(state_dir, grid, tile, window, mask_path, scene_id, water_label, land_label):
+    """
+    Fold one scene's labels into the state of one tile and return the change against the last
+    observed labels. A tile that already holds this scene (an interrupted ingest being resumed)
+    returns the change it recorded; otherwise its current state is kept aside so the ingest can
+    be rolled back.
+
+    :return: (tile, window, change array)
+    """
+    state = _load_tile(state_dir, tile, (window.height, window.width))
+    if str(state["scene"]) == scene_id:
+        return tile, window, state["change"]
+
+    # Align the scene onto the fixed grid; pixels outside the scene read as nodata
+    with rasterio.open(mask_path) as src, \
+            WarpedVRT(src, crs=grid["crs"], transform=grid["transform"], width=grid["width"],
+                      height=grid["height"], resampling=Resampling.nearest, nodata=NODATA_LABEL) as vrt:
+        labels = vrt.read(1, window=window)
+
+    water = labels == water_label
+    valid = water | (labels == land_label)
+    previous = state["last_label"]
+
+    change = np.full(labels.shape, NODATA_LABEL, dtype="uint8")
+    seen = valid & (previous != NODATA_LABEL)
+    change[seen] = NO_CHANGE
+    change[seen & water & (previous == land_label)] = LAND_TO_WATER
+    change[seen & ~water & (previous == water_label)] = WATER_TO_LAND
+
+    state["water_count"] += water
+    state["valid_count"] += valid
+    state["last_label"] = np.where(valid, labels, previous).astype("uint8")
+    state["change"] = change
+    state["scene"] = np.array(scene_id)
+
+    path = _tile_path(state_dir, tile)
+    if os.path.isfile(path):
+        previous_path = _previous_tile_path(state_dir, tile)
+        tmp_path = f"{previous_path}.{os.getpid()}.tmp.npz"
+        shutil.copyfile(path, tmp_path)
+        os.replace(tmp_path, previous_path)
+    _save_tile(state_dir, tile, state)
+    return tile, window, change
+
+
+class TemporalState:
+    """
+    Per-pixel history of successive water/land masks of the same area, on a fixed grid.
+
+    The grid is split into tiles, and each tile keeps its own state file under
+    `state_dir/tiles`: water and valid observation counts and the last observed label. A new
+    revisit only updates the tiles it covers, in parallel worker processes that each hold one
+    tile at a time, so neither the history nor the full scene is ever loaded at once and the
+    earlier scenes are never reprocessed. `state_dir/temporal.json` records the grid, the
+    ingested scenes and the scene being ingested, if any.
+    """
+
+    def __init__(self, state_dir):
+        self.state_dir = state_dir
+        manifest = load_manifest(state_dir, "temporal")
+        if not manifest:
+            raise FileNotFoundError(f"No temporal state found in: {state_dir}")
+
+        grid = manifest["grid"]
+        self.crs = CRS.from_wkt(grid["crs"])
+        self.transform = Affine(*grid["transform"])
+        self.width, self.height = grid["width"], grid["height"]
+        self.tile_size = grid["tile_size"]
+        self.scenes = manifest["scenes"]
+        self.ingesting = manifest.get("ingesting")
+
+    @classmethod
+    def create(cls, state_dir, crs, transform, width, height, tile_size=1024):
+        """Start an empty history on the given grid."""
+        if load_manifest(state_dir, "temporal"):
+            raise FileExistsError(f"A temporal state already exists in: {state_dir}")
+
+        os.makedirs(os.path.join(state_dir, "tiles"), exist_ok=True)
+        grid = {"crs": CRS.from_user_input(crs).to_wkt(), "transform": list(transform)[:6], "width": width,
+                "height": height, "tile_size": tile_size}
+        save_manifest(state_dir, "temporal", {"grid": grid, "scenes": []})
+        return cls(state_dir)
+
+    @classmethod
+    def open(cls, state_dir, reference_path=None, aoi_path=None, tile_size=1024):
+        """
+        Open the history in state_dir, or start one on the grid of a reference mask (usually the
+        first revisit), cropped to the AOI if one is given.
+
+        :param state_dir: folder of the state
+        :param reference_path: raster defining the grid of a new state
+        :param aoi_path: optional AOI file restricting the grid
+        :param tile_size: tile size in pixels of a new state
+        :return: TemporalState
+        """
+        if load_manifest(state_dir, "temporal"):
+            return cls(state_dir)
+        if reference_path is None:
+            raise FileNotFoundError(f"No temporal state found in {state_dir} and no reference raster for its grid")
+
+        with rasterio.open(reference_path) as src:
+            crs, transform = src.crs, src.transform
+            window = Window(0, 0, src.width, src.height)
+            if aoi_path:
+                window = geometry_window_from_bounds(read_aoi_geometries(aoi_path, dst_crs=src.crs), src.transform,
+                                                     src.width, src.height)
+        return cls.create(state_dir, crs, window_transform(window, transform), int(window.width),
+                          int(window.height), tile_size=tile_size)
+
+    @property
+    def tiles(self):
+        """{(tile row, tile col): Window} of the grid."""
+        size = self.tile_size
+        return {
+            (row // size, col // size): Window(col, row, min(size, self.width - col), min(size, self.height - row))
+            for row in range(0, self.height, size)
+            for col in range(0, self.width, size)
+        }
+
+    def _profile(self, count=1):
+        profile = {"driver": "GTiff", "dtype": "uint8", "count": count, "nodata": NODATA_LABEL, "crs": self.crs,
+                   "transform": self.transform, "width": self.width, "height": self.height}
+        return tiled_profile(profile, block_size=min(512, self.tile_size))
+
+    @timed("temporal_ingest")
+    def ingest(self, scene_id, date, mask_path, change_path=None, workers=None, water_label=WATER_LABEL,
+               land_label=LAND_LABEL):
+        """
+        Update the history with the mask of a new revisit and write the change against the last
+        observed labels (NO_CHANGE, LAND_TO_WATER, WATER_TO_LAND, or NODATA_LABEL where the pixel is
+        not observed now or was never observed before) as a COG.
+
+        A scene that was already ingested is skipped, and an interrupted ingest resumes with the
+        tiles it did not update yet. While an ingest is unfinished, no other scene can be
+        ingested: resume it, or undo it with `rollback`.
+
+        :param scene_id: scene identifier
+        :param date: acquisition date (ISO 8601); scenes must be ingested in date order
+        :param mask_path: stitched label mask of the scene, in any CRS/extent
+        :param change_path: output change raster (default: state_dir/changes/<scene_id>.tif)
+        :param workers: number of worker processes (default: CPU count)
+        :param water_label: label of water pixels
+        :param land_label: label of land pixels
+        :return: scene report (dict), or None if the scene was already ingested
+        """
+        if any(scene["id"] == scene_id for scene in self.scenes):
+            print(f"Skipping {scene_id}: already ingested")
+            return None
+        if self.scenes and date < self.scenes[-1]["date"]:
+            raise ValueError(f"{scene_id} ({date}) is older than the last ingested scene ({self.scenes[-1]['date']})")
+
+        if self.ingesting and self.ingesting["id"] != scene_id:
+            raise RuntimeError(f"The ingest of {self.ingesting['id']} did not complete: ingest it again to resume it, "
+                               f"or roll it back before ingesting {scene_id}")
+
+        grid = {"crs": self.crs, "transform": self.transform, "width": self.width, "height": self.height}
+
+        # Only the tiles the scene covers change
+        with rasterio.open(mask_path) as src:
+            bounds = transform_bounds(src.crs, self.crs, *src.bounds)
+        covered = from_bounds(*bounds, transform=self.transform)
+        tiles = {tile: window for tile, window in self.tiles.items() if _overlaps(window, covered)}
+
+        change_path = change_path or os.path.join(self.state_dir, "changes", f"{scene_id}.tif")
+        os.makedirs(os.path.dirname(change_path) or ".", exist_ok=True)
+
+        report = {"id": scene_id, "date": date, "mask": mask_path, "change": change_path, "tiles": len(tiles),
+                  "compared": 0, "land_to_water": 0, "water_to_land": 0}
+        if self.ingesting:
+            print(f"Resuming the interrupted ingest of {scene_id}")
+        self.ingesting = {"id": scene_id, "date": date, "mask": mask_path}
+        self._save()
+
+        workers = workers or os.cpu_count()
+        with ProcessPoolExecutor(max_workers=workers) as executor, \
+                cog_output(change_path, block_size=min(512, self.tile_size), resampling="mode") as tiled_path, \
+                rasterio.open(tiled_path, "w", **self._profile()) as dst:
+            pending = set()
+            for tile, window in tiles.items():
+                pending.add(executor.submit(_update_tile, self.state_dir, grid, tile, window, mask_path, scene_id,
+                                            water_label, land_label))
+                # Bounded number of tiles in flight, so finished blocks never pile up in memory
+                if len(pending) >= 2 * workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    self._collect(done, dst, report)
+            self._collect(pending, dst, report)
+
+        self.scenes.append(report)
+        self.ingesting = None
+        self._save()
+        self._discard_previous_tiles()
+        print(f"Ingested {scene_id} ({date}): {report['land_to_water']} px land to water, "
+              f"{report['water_to_land']} px water to land")
+        print(f"Change raster saved to: {change_path}")
+        return report
+
+    @staticmethod
+    def _collect(futures, dst, report):
+        for future in futures:
+            _, window, change = future.result()
+            dst.write(change, 1, window=window)
+            report["compared"] += int((change != NODATA_LABEL).sum())
+            report["land_to_water"] += int((change == LAND_TO_WATER).sum())
+            report["water_to_land"] += int((change == WATER_TO_LAND).sum())
+            metrics.count("temporal_ingest.tiles")
+
+    def rollback(self):
+        """
+        Undo an interrupted ingest: the tiles it updated get back their previous state.
+
+        :return: id of the scene rolled back, or None if no ingest was in progress
+        """
+        if not self.ingesting:
+            return None
+        scene_id = self.ingesting["id"]
+        for tile, window in self.tiles.items():
+            path = _tile_path(self.state_dir, tile)
+            if not os.path.isfile(path):
+                continue
+            if str(_load_tile(self.state_dir, tile, (window.height, window.width))["scene"]) != scene_id:
+                continue
+            previous_path = _previous_tile_path(self.state_dir, tile)
+            if os.path.isfile(previous_path):
+                os.replace(previous_path, path)
+            else:
+                # First observed by this scene
+                os.remove(path)
+        self._discard_previous_tiles()
+
+        self.ingesting = None
+        self._save()
+        print(f"Rolled back the interrupted ingest of {scene_id}")
+        return scene_id
+
+    def _discard_previous_tiles(self):
+        for path in glob.glob(os.path.join(self.state_dir, "tiles", "*.prev.npz")):
+            os.remove(path)
+
+    def _save(self):
+        manifest = load_manifest(self.state_dir, "temporal")
+        manifest["scenes"] = self.scenes
+        manifest["ingesting"] = self.ingesting
+        save_manifest(self.state_dir, "temporal", manifest)
+
+    def composite(self, output_path):
+        """
+        Write the history as a 2-band COG: the water frequency in percent of the valid
+        observations, and the last observed label (NODATA_LABEL where never observed).
+
+        :param output_path: output GeoTIFF path
+        """
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+        with cog_output(output_path, block_size=min(512, self.tile_size)) as tiled_path, \
+                rasterio.open(tiled_path, "w", **self._profile(count=2)) as dst:
+            dst.descriptions = ("water_frequency", "last_label")
+            for tile, window in self.tiles.items():
+                state = _load_tile(self.state_dir, tile, (window.height, window.width))
+                valid = state["valid_count"] > 0
+                frequency = np.full(valid.shape, NODATA_LABEL, dtype="uint8")
+                frequency[valid] = np.round(100 * state["water_count"][valid] / state["valid_count"][valid])
+                dst.write(np.stack([frequency, state["last_label"]]), window=window)
+
+        print(f"Composite of {len(self.scenes)} scenes saved to: {output_path}")
+
+
+def _overlaps(window, covered):
+    return (window.col_off < covered.col_off + covered.width and covered.col_off < window.col_off + window.width
+            and window.row_off < covered.row_off + covered.height
+            and covered.row_off < window.row_off + window.height)
+
+
+def add_arguments(parser):
+    """Options shared by `python temporal.py` and `python cli.py temporal`."""
+    commands = parser.add_subparsers(dest="action", required=True)
+
+    ingest = commands.add_parser("ingest", help="Add the mask of a new revisit and write its change raster.")
+    ingest.add_argument("state_dir", help="Folder of the temporal state (created on the first ingest).")
+    ingest.add_argument("scene_id", help="Scene identifier.")
+    ingest.add_argument("date", help="Acquisition date, e.g. 2021-07-05.")
+    ingest.add_argument("mask_path", help="Stitched mask of the scene (e.g. outputs/stitched_output.tif).")
+    ingest.add_argument("--change_path", help="Output change raster (default: <state_dir>/changes/<scene_id>.tif).")
+    ingest.add_argument("--aoi", help="Crop the grid of a new state to this AOI.")
+    ingest.add_argument("--tile_size", type=int, default=1024, help="Tile size in pixels of a new state.")
+    ingest.add_argument("--workers", type=int, help="Worker processes (default: CPU count).")
+
+    rollback = commands.add_parser("rollback", help="Undo an interrupted ingest.")
+    rollback.add_argument("state_dir", help="Folder of the temporal state.")
+
+    composite = commands.add_parser("composite", help="Write the water frequency and last observed label.")
+    composite.add_argument("state_dir", help="Folder of the temporal state.")
+    composite.add_argument("output_path", help="Output GeoTIFF.")
+    return parser
+
+
+def run(args):
+    if args.action == "ingest":
+        state = TemporalState.open(args.state_dir, reference_path=args.mask_path, aoi_path=args.aoi,
+                                   tile_size=args.tile_size)
+        state.ingest(args.scene_id, args.date, args.mask_path, change_path=args.change_path, workers=args.workers)
+    elif args.action == "rollback":
+        TemporalState(args.state_dir).rollback()
+    else:
+        TemporalState(args.state_dir).composite(args.output_path)
+
+
+if __name__ == "__main__":
+    parser = add_arguments(argparse.ArgumentParser(description="Track water/land masks of successive revisits on a fixed grid."))
+    run(parser.parse_args())
@@ -0,0 +1,29 @@
+import os
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from batch import run_batch
+
+
+def fake_download(scene):
+    if scene == "broken":
+        raise IOError("connection reset")
+    return f"raw/{scene}"
+
+
+def fake_process(scene, raw_data_path):
+    if scene == "bad":
+        raise ValueError("no IMG_DATA")
+    return (raw_data_path, os.getpid())
+
+
+def test_run_batch_processes_downloaded_scenes():
+    scenes = ["a", "b", "broken", "bad", "c"]
+    results, failures = run_batch(scenes, fake_download, fake_process, download_workers=2, scene_workers=2)
+
+    assert {scene: path for scene, (path, _) in results.items()} == {"a": "raw/a", "b": "raw/b", "c": "raw/c"}
+    assert sorted(failures) == ["bad", "broken"]
+    # Processing happens in worker processes
+    assert all(pid != os.getpid() for _, pid in results.values())
@@ -0,0 +1,22 @@
+import sys
+import json
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from benchmark import run_benchmark
+
+
+def test_run_benchmark_reports_every_stage(tmp_path):
+    report = run_benchmark(str(tmp_path), size=256, patch_size=64, overlap=0, batch_size=2, max_patches=2,
+                           trace_memory=True)
+
+    stages = {stage["stage"]: stage for stage in report["stages"]}
+    assert list(stages) == ["re_projection_B02", "re_projection_B03", "re_projection_B04", "re_projection_B08",
+                            "combine_bands", "split_and_save_patches", "SentinelDataset", "run_inference",
+                            "stitch_tiff_patches"]
+    assert stages["split_and_save_patches"]["patches"] == report["config"]["patches"] > 0
+    assert stages["run_inference"]["patches"] == 2
+    assert all(stage["seconds"] > 0 and stage["peak_rss_mb"] > 0 for stage in stages.values())
+    assert all(stage["rss_delta_mb"] >= 0 and "peak_traced_mb" in stage for stage in stages.values())
+    json.dumps(report)
@@ -0,0 +1,71 @@
+import os
+import sys
+import time
+import numpy as np
+import torch
+import rasterio
+from rasterio.transform import from_origin
+from torch.utils.data import DataLoader
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from cache import PredictionCache
+from util import split_and_save_patches
+from dataloader import SentinelDataset
+from inference import run_inference
+
+
+class CountingModel(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.seen = 0
+
+    def forward(self, x):
+        self.seen += len(x)
+        water = x[:, 0:1] > 0.05
+        return {'out': torch.cat([(~water).float(), water.float()], dim=1)}
+
+
+def test_cache_keys_and_lru_eviction(tmp_path):
+    cache = PredictionCache(str(tmp_path), "weights-a", max_bytes=1200)  # three 384-byte entries fit
+    patch = np.arange(64, dtype=np.uint16).reshape(1, 8, 8)
+
+    assert cache.key(patch) == PredictionCache(str(tmp_path), "weights-a").key(patch.copy())
+    assert cache.key(patch) != PredictionCache(str(tmp_path), "weights-b").key(patch)
+    assert cache.key(patch, kind="pred") != cache.key(patch, kind="prob")
+
+    keys = [cache.key(patch + i) for i in range(4)]
+    for i, key in enumerate(keys[:3]):
+        cache.put(key, np.full((1, 16, 16), i, dtype='uint8'))
+        os.utime(cache._path(key), (time.time() - 100 + i, time.time() - 100 + i))
+    assert cache.get(keys[0]) is not None  # refreshes the oldest entry
+
+    cache.put(keys[3], np.zeros((1, 16, 16), dtype='uint8'))  # exceeds max_bytes
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) is not None
+    assert cache.size <= 1200
+
+
+def test_run_inference_skips_cached_patches(tmp_path):
+    data = np.random.randint(0, 1000, (4, 64, 96), dtype=np.uint16)
+    scene_path = tmp_path / "combined_4band.tif"
+    with rasterio.open(scene_path, 'w', driver='GTiff', height=64, width=96, count=4,
+                       dtype='uint16', crs='EPSG:4326', transform=from_origin(0, 64, 1, 1)) as dst:
+        dst.write(data)
+    patch_dir = tmp_path / "patches"
+    split_and_save_patches(str(scene_path), str(patch_dir), patch_size=32)
+
+    cache = PredictionCache(str(tmp_path / "cache"), "weights")
+    model = CountingModel()
+    dataloader = DataLoader(SentinelDataset(str(patch_dir), raw=True), batch_size=4)
+
+    run_inference(model, dataloader, str(tmp_path / "first"), "cpu", cache=cache)
+    assert model.seen == 6 and cache.misses == 6
+
+    run_inference(model, dataloader, str(tmp_path / "second"), "cpu", cache=cache)
+    assert model.seen == 6 and cache.hits == 6
+
+    for pred_path in (tmp_path / "first").glob("*.tif"):
+        with rasterio.open(pred_path) as first, rasterio.open(tmp_path / "second" / pred_path.name) as second:
+            np.testing.assert_array_equal(first.read(), second.read())
@@ -0,0 +1,71 @@
+import sys
+import time
+import subprocess
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.append(str(ROOT))
+
+from cli import build_parser
+
+# Wall time budgets of `python cli.py [command] --help`: the CLI itself, and subcommands that
+# load rasterio but nothing heavier (importing torch alone takes longer)
+STARTUP_BUDGET_S = {None: 0.5, "stitch": 0.75, "preprocess": 0.75}
+STARTUP_RUNS = 3
+HEAVY_MODULES = ["torch", "torchvision", "geopandas", "fiona", "boto3", "pystac_client"]
+
+
+def _imported_heavy_modules(command):
+    # A fresh interpreter: this test session has imported torch already
+    script = (f"import sys; import cli; cli.build_parser({command!r}); "
+              f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))")
+    result = subprocess.run([sys.executable, "-c", script], cwd=ROOT, capture_output=True, text=True, check=True)
+    return [m for m in result.stdout.strip().split(",") if m]
+
+
+def _startup_seconds(command):
+    # Fastest of a few runs: the first one pays for cold file caches, and a loaded machine only
+    # slows down some of them
+    args = [sys.executable, str(ROOT / "cli.py")] + ([command] if command else []) + ["--help"]
+    times = []
+    for _ in range(STARTUP_RUNS):
+        start = time.perf_counter()
+        result = subprocess.run(args, capture_output=True, text=True)
+        times.append(time.perf_counter() - start)
+        assert result.returncode == 0, result.stderr
+    return min(times), result.stdout
+
+
+@pytest.mark.parametrize("command", list(STARTUP_BUDGET_S))
+def test_help_within_startup_budget(command):
+    seconds, usage = _startup_seconds(command)
+    if command is None:
+        assert all(name in usage for name in ("download", "preprocess", "infer", "stitch"))
+    assert seconds < STARTUP_BUDGET_S[command], f"cli.py {command or ''} --help took {seconds:.2f}s"
+
+
+@pytest.mark.parametrize("command", [None, "infer", "download"])
+def test_no_heavy_imports(command):
+    assert _imported_heavy_modules(command) == []
+
+
+@pytest.mark.parametrize("command", ["stitch", "preprocess"])
+def test_raster_commands_do_not_import_torch(command):
+    # rasterio may pull in boto3 for its S3 support, but nothing needs torch to stitch or preprocess
+    assert not {"torch", "torchvision"} & set(_imported_heavy_modules(command))
+
+
+def test_subcommand_options():
+    args = build_parser("stitch").parse_args(["stitch", "in", "out.tif", "--blend", "--overlap", "5"])
+    assert (args.command, args.input_dir, args.blend, args.overlap, args.no_cog) == ("stitch", "in", True, 5, False)
+
+    args = build_parser("infer").parse_args(["infer", "--weights", "w.pth", "--input_tif", "scene.tif"])
+    assert (args.input_tif, args.data_path, args.engine) == ("scene.tif", None, "eager")
+
+    with pytest.raises(SystemExit):
+        build_parser("infer").parse_args(["infer", "--weights", "w.pth"])
+
+    args = build_parser("export").parse_args(["export", "--weights", "w.pth", "--quantize", "dynamic"])
+    assert (args.command, args.weights, args.quantize, args.output_dir) == ("export", "w.pth", "dynamic", "weights")
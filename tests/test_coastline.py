@@ -0,0 +1,43 @@
+import sys
+import numpy as np
+import rasterio
+import geopandas as gpd
+from shapely.geometry import Polygon
+from rasterio.transform import from_origin
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from coastline import extract_coastline
+
+
+def write_mask(path, labels):
+    with rasterio.open(path, 'w', driver='GTiff', height=labels.shape[0], width=labels.shape[1], count=1,
+                       dtype='uint8', nodata=255, crs='EPSG:32633', transform=from_origin(1000, 2000, 10, 10)) as dst:
+        dst.write(labels, 1)
+
+
+def test_extract_coastline_joins_blocks(tmp_path):
+    # A circular lake crossing the seams of 16px blocks, and a straight shore along a nodata edge
+    rows, cols = np.mgrid[0:60, 0:70]
+    labels = np.zeros((60, 70), dtype='uint8')
+    labels[(rows - 30) ** 2 + (cols - 30) ** 2 < 15 ** 2] = 1
+    labels[:, 60:] = 255
+    mask_path = tmp_path / "stitched_output.tif"
+    write_mask(mask_path, labels)
+
+    blocked = tmp_path / "coastline.gpkg"
+    whole = tmp_path / "coastline.geojson"
+    assert extract_coastline(str(mask_path), str(blocked), block_size=16, workers=2, simplify=0) == 1
+    assert extract_coastline(str(mask_path), str(whole), block_size=128, workers=1, simplify=0) == 1
+
+    lake = gpd.read_file(blocked).geometry[0]
+    assert lake.is_ring
+    assert lake.equals(gpd.read_file(whole).geometry[0])
+    # The ring is the lake's outline, in map coordinates (10m pixels)
+    assert Polygon(lake).area == (labels == 1).sum() * 100
+
+    assert extract_coastline(str(mask_path), str(tmp_path / "simple.gpkg"), block_size=16, simplify=1.5) == 1
+    simple = gpd.read_file(tmp_path / "simple.gpkg").geometry[0]
+    assert len(simple.coords) < len(lake.coords)
+    assert simple.hausdorff_distance(lake) <= 15
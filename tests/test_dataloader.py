@@ -0,0 +1,46 @@
+import sys
+import numpy as np
+import rasterio
+import torch
+from rasterio.transform import from_origin
+from torch.utils.data import DataLoader
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from util import split_and_save_patches
+from dataloader import SentinelDataset, SentinelArrayDataset
+from preprocessing import prepare_batch
+
+
+def write_scene(path):
+    data = np.random.randint(0, 65535, (4, 128, 128), dtype=np.uint16)
+    with rasterio.open(path, 'w', driver='GTiff', height=128, width=128, count=4,
+                       dtype='uint16', crs='EPSG:4326', transform=from_origin(0, 128, 1, 1)) as dst:
+        dst.write(data)
+
+
+def test_array_dataset_matches_tif_patches(tmp_path):
+    scene = tmp_path / "combined_4band.tif"
+    write_scene(scene)
+    split_and_save_patches(str(scene), str(tmp_path / "tif"), patch_size=64)
+    split_and_save_patches(str(scene), str(tmp_path / "npy"), patch_size=64, output_format="npy")
+
+    tif_dataset = SentinelDataset(str(tmp_path / "tif"))
+    array_dataset = SentinelArrayDataset(str(tmp_path / "npy"))
+    assert len(array_dataset) == len(tif_dataset) == 4
+
+    tif_batch = next(iter(DataLoader(tif_dataset, batch_size=4)))
+    array_batch = next(iter(DataLoader(array_dataset, batch_size=4)))
+    assert array_batch['image'].dtype == torch.int16
+    assert list(array_batch['filename']) == list(tif_batch['filename'])
+
+    torch.testing.assert_close(prepare_batch(array_batch['image']), tif_batch['image'])
+
+    raw_batch = next(iter(DataLoader(SentinelDataset(str(tmp_path / "tif"), raw=True), batch_size=4)))
+    torch.testing.assert_close(prepare_batch(raw_batch['image']), tif_batch['image'])
+
+    with rasterio.open(tif_dataset.image_files[3]) as src:
+        profile = array_dataset.get_profile(3)
+        assert profile['transform'] == src.transform
+        assert (profile['height'], profile['width'], profile['count']) == (64, 64, 4)
@@ -0,0 +1,157 @@
+import os
+import sys
+import pytest
+from io import BytesIO
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+boto3 = pytest.importorskip("boto3")
+moto = pytest.importorskip("moto")
+
+from boto3.s3.transfer import TransferConfig
+from downloader import download_s3_product, BAND_PATTERNS
+
+PREFIX = "Sentinel-2/MSI/L2A/S2A_TEST.SAFE"
+IMG_DATA = f"{PREFIX}/GRANULE/L2A_T33/IMG_DATA"
+KEYS = [f"{IMG_DATA}/R10m/T33_B{b}_10m.jp2" for b in ("02", "03", "04", "08")] + [
+    f"{IMG_DATA}/R10m/T33_TCI_10m.jp2",
+    f"{IMG_DATA}/R20m/T33_B05_20m.jp2",
+    f"{PREFIX}/MTD_MSIL2A.xml",
+]
+
+
+@pytest.fixture
+def bucket():
+    with moto.mock_aws():
+        s3 = boto3.resource("s3", region_name="us-east-1")
+        bucket = s3.Bucket("eodata")
+        bucket.create()
+        for i, key in enumerate(KEYS):
+            bucket.put_object(Key=key, Body=bytes([i]) * 1000)
+        # A multipart upload, so the ETag is an MD5 of part MD5s
+        config = TransferConfig(multipart_threshold=5 * 1024 * 1024, multipart_chunksize=5 * 1024 * 1024)
+        big_key = f"{IMG_DATA}/R10m/T33_B08_10m.jp2"
+        bucket.upload_fileobj(BytesIO(os.urandom(11 * 1024 * 1024)), big_key, Config=config)
+        yield bucket
+
+
+def test_download_filters_and_resumes(tmp_path, bucket):
+    config = TransferConfig(multipart_threshold=5 * 1024 * 1024, multipart_chunksize=5 * 1024 * 1024)
+    summary = download_s3_product(bucket, PREFIX, target_dir=str(tmp_path), patterns=BAND_PATTERNS,
+                                  transfer_config=config)
+    assert sorted(summary["downloaded"]) == sorted(KEYS[:4])
+    assert (tmp_path / KEYS[3]).stat().st_size == 11 * 1024 * 1024
+    assert not (tmp_path / KEYS[4]).exists()
+
+    # Complete files are skipped; a truncated one is fetched again
+    with open(tmp_path / KEYS[0], "r+b") as f:
+        f.truncate(10)
+    summary = download_s3_product(bucket, PREFIX, target_dir=str(tmp_path), patterns=BAND_PATTERNS,
+                                  transfer_config=config)
+    assert summary["downloaded"] == [KEYS[0]]
+    assert sorted(summary["skipped"]) == sorted(KEYS[1:4])
+
+
+def test_resume_with_another_uploader_part_size(tmp_path, bucket):
+    # 20 MiB in 15 MiB parts: as many parts as our 16 MiB chunks, at other boundaries
+    key = f"{PREFIX}/GRANULE/L2A_T33/IMG_DATA/R10m/T33_B02_10m.jp2"
+    uploaded = TransferConfig(multipart_threshold=5 * 1024 * 1024, multipart_chunksize=15 * 1024 * 1024)
+    bucket.upload_fileobj(BytesIO(os.urandom(20 * 1024 * 1024)), key, Config=uploaded)
+
+    config = TransferConfig(multipart_threshold=5 * 1024 * 1024, multipart_chunksize=16 * 1024 * 1024)
+    summary = download_s3_product(bucket, key, target_dir=str(tmp_path), transfer_config=config)
+    assert summary["downloaded"] == [key]
+    summary = download_s3_product(bucket, key, target_dir=str(tmp_path), transfer_config=config)
+    assert summary["skipped"] == [key] and not summary["downloaded"]
+
+    # 12 MiB in 6 MiB parts: the part size implied by the ETag reproduces it
+    from downloader import is_complete
+    from instrumentation import metrics
+
+    key = f"{PREFIX}/GRANULE/L2A_T33/IMG_DATA/R10m/T33_B03_10m.jp2"
+    uploaded = TransferConfig(multipart_threshold=5 * 1024 * 1024, multipart_chunksize=6 * 1024 * 1024)
+    bucket.upload_fileobj(BytesIO(os.urandom(12 * 1024 * 1024)), key, Config=uploaded)
+    download_s3_product(bucket, key, target_dir=str(tmp_path), transfer_config=config)
+    obj = bucket.Object(key)
+    metrics.reset()
+    assert is_complete(str(tmp_path / key), obj.content_length, obj.e_tag, 16 * 1024 * 1024)
+    assert "download_s3_product.etag_unverified" not in metrics.snapshot()["counters"]
+
+
+def test_download_retries(tmp_path, bucket, monkeypatch):
+    client = bucket.meta.client
+    real_download = client.download_file
+    failures = []
+
+    def flaky_download(*args, **kwargs):
+        if not failures:
+            failures.append(1)
+            raise OSError("connection reset")
+        return real_download(*args, **kwargs)
+
+    monkeypatch.setattr(client, "download_file", flaky_download)
+    monkeypatch.setattr("downloader.time.sleep", lambda seconds: None)
+
+    summary = download_s3_product(bucket, f"{PREFIX}/MTD", target_dir=str(tmp_path), workers=1)
+    assert summary["downloaded"] == [KEYS[-1]]
+    assert failures
+
+
+def test_download_retries_only_transient_errors(tmp_path, bucket, monkeypatch):
+    from boto3.exceptions import S3TransferFailedError
+    from botocore.exceptions import ClientError
+    from downloader import download_file, default_transfer_config
+
+    client = bucket.meta.client
+    real_download = client.download_file
+    calls = []
+
+    def dropped_once(*args, **kwargs):
+        calls.append(args[1])
+        if len(calls) == 1:
+            raise S3TransferFailedError("connection dropped")
+        return real_download(*args, **kwargs)
+
+    monkeypatch.setattr(client, "download_file", dropped_once)
+    monkeypatch.setattr("downloader.time.sleep", lambda seconds: None)
+
+    # A failed transfer is retried
+    download_file(client, "eodata", KEYS[-1], str(tmp_path / "MTD.xml"), default_transfer_config())
+    assert len(calls) == 2 and (tmp_path / "MTD.xml").exists()
+
+    # A missing object fails on the first attempt
+    calls.clear()
+    with pytest.raises(ClientError):
+        download_file(client, "eodata", f"{PREFIX}/missing.xml", str(tmp_path / "missing.xml"),
+                      default_transfer_config())
+    assert len(calls) == 1
+
+
+def test_select_covering_items():
+    from types import SimpleNamespace
+    from shapely.geometry import box, mapping
+    from downloader import select_covering_items
+
+    def item(name, bounds, cloud):
+        return SimpleNamespace(id=name, geometry=mapping(box(*bounds)), properties={"cloudCover": cloud})
+
+    items = [
+        item("west_cloudy", (0, 0, 1, 1), 2.5),
+        item("west_clear", (0, 0, 1, 1), 0.1),
+        item("east", (1, 0, 2, 1), 1.0),
+        item("middle", (0.5, 0, 1.5, 1), 0.5),
+        item("elsewhere", (5, 5, 6, 6), 0.0),
+    ]
+    selected = select_covering_items(items, box(0, 0, 2, 1))
+    assert [i.id for i in selected] == ["west_clear", "middle", "east"]
+
+
+def test_connect_s3_pool_fits_the_transfers(monkeypatch):
+    import downloader
+
+    monkeypatch.setattr(downloader, "ACCESS_KEY", "key")
+    monkeypatch.setattr(downloader, "SECRET_KEY", "secret")
+    s3 = downloader.connect_s3()
+    expected = downloader.DOWNLOAD_WORKERS * downloader.TRANSFER_SETTINGS["max_concurrency"]
+    assert s3.meta.client.meta.config.max_pool_connections == expected
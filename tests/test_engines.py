@@ -0,0 +1,68 @@
+import sys
+import pytest
+import torch
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from model_utils import load_model, model_input_channels
+from engines import ENGINES, export_torchscript, export_onnx, quantize_onnx, load_engine, check_parity
+
+
+@pytest.fixture
+def model(tmp_path):
+    # Randomly initialized weights stand in for the trained model
+    empty = tmp_path / "empty.pth"
+    torch.save({}, empty)
+    return load_model(str(empty)).eval()
+
+
+def test_torchscript_parity(tmp_path, model):
+    example = torch.rand(1, 6, 64, 64)
+    path = tmp_path / "model.pt"
+    export_torchscript(model, str(path), example)
+
+    engine = load_engine("torchscript", str(path))
+    assert model_input_channels(engine) == 6
+    parity = check_parity(model, engine, torch.rand(2, 6, 64, 64))
+    assert parity["max_abs_diff"] < 1e-3
+    assert parity["label_agreement"] > 0.99
+
+
+def test_onnxruntime_parity(tmp_path, model):
+    pytest.importorskip("onnxruntime")
+    pytest.importorskip("onnx")
+    path = tmp_path / "model.onnx"
+    export_onnx(model, str(path), torch.rand(1, 6, 64, 64))
+
+    engine = load_engine("onnxruntime", str(path))
+    assert model_input_channels(engine) == 6
+    # Dynamic axes: a different batch and patch size than the export example
+    parity = check_parity(model, engine, torch.rand(2, 6, 96, 96))
+    assert parity["max_abs_diff"] < 1e-3
+
+
+def test_int8_quantization_parity(tmp_path, model):
+    pytest.importorskip("onnxruntime")
+    pytest.importorskip("onnx")
+    fp32_path, int8_path = tmp_path / "model.onnx", tmp_path / "model_int8.onnx"
+    export_onnx(model, str(fp32_path), torch.rand(1, 6, 64, 64))
+    quantize_onnx(str(fp32_path), str(int8_path))
+
+    assert int8_path.stat().st_size < fp32_path.stat().st_size / 2
+    engine = load_engine("onnxruntime", str(int8_path))
+    # int8 weights shift the logits a little, but should rarely flip a label
+    parity = check_parity(model, engine, torch.rand(2, 6, 64, 64))
+    assert parity["max_abs_diff"] < 1.0
+    assert parity["label_agreement"] > 0.9
+
+
+def test_cli_engine_choices():
+    import argparse
+    from main import add_arguments
+
+    parser = add_arguments(argparse.ArgumentParser())
+    engine = next(action for action in parser._actions if action.dest == "engine")
+    assert tuple(engine.choices) == ENGINES
+    with pytest.raises(SystemExit):
+        parser.parse_args(["--weights", "w.pth", "--input_tif", "scene.tif", "--engine", "onnx"])
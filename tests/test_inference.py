@@ -0,0 +1,204 @@
+import sys
+import json
+import pytest
+import numpy as np
+import rasterio
+import torch
+import torch.nn as nn
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+from torch.utils.data import DataLoader
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from util import split_and_save_patches
+from dataloader import SentinelDataset, SentinelWindowDataset
+from model_utils import load_model
+from inference import (PredictionWriter, run_inference, run_windowed_inference, run_sharded_inference,
+                       run_adaptive_inference)
+from preprocessing import PatchPrefilter
+from cache import PredictionCache
+
+
+class ThresholdModel(nn.Module):
+    """Stand-in for the segmentation model: water wherever the first band is bright."""
+
+    def forward(self, x):
+        water = x[:, 0:1] > 0.05
+        return {'out': torch.cat([(~water).float(), water.float()], dim=1)}
+
+
+def write_scene(path, height=150, width=170):
+    data = np.random.randint(0, 1000, (4, height, width), dtype=np.uint16)
+    with rasterio.open(path, 'w', driver='GTiff', height=height, width=width, count=4,
+                       dtype='uint16', crs='EPSG:4326', transform=from_origin(0, height, 1, 1)) as dst:
+        dst.write(data)
+    return data
+
+
+def test_run_inference_writes_georeferenced_predictions(tmp_path):
+    scene_path = tmp_path / "combined_4band.tif"
+    write_scene(scene_path, 128, 128)
+    patch_dir = tmp_path / "patches"
+    split_and_save_patches(str(scene_path), str(patch_dir), patch_size=64)
+
+    dataloader = DataLoader(SentinelDataset(str(patch_dir), raw=True), batch_size=3)
+    out_dir = tmp_path / "inference_outputs"
+    run_inference(ThresholdModel(), dataloader, str(out_dir), "cpu", writers=3)
+
+    for patch_path in sorted(patch_dir.glob("*.tif")):
+        with rasterio.open(patch_path) as patch, rasterio.open(out_dir / f"pred_{patch_path.name}") as pred:
+            assert pred.transform == patch.transform
+            assert pred.crs == patch.crs
+            np.testing.assert_array_equal(pred.read(1), (patch.read(1) / 10000. > 0.05).astype('uint8'))
+
+
+def test_run_windowed_inference(tmp_path):
+    scene_path = tmp_path / "combined_4band.tif"
+    data = write_scene(scene_path)
+
+    dataset = SentinelWindowDataset(str(scene_path), patch_size=64, overlap=10, raw=True)
+    dataloader = DataLoader(dataset, batch_size=3, shuffle=False)
+    out_path = tmp_path / "stitched_output.tif"
+    run_windowed_inference(ThresholdModel(), dataloader, str(out_path), "cpu", overlap=10)
+
+    with rasterio.open(out_path) as src:
+        assert src.shape == (150, 170)
+        assert src.transform == from_origin(0, 150, 1, 1)
+        assert src.tags(ns="IMAGE_STRUCTURE")["LAYOUT"] == "COG"
+        pred = src.read(1)
+
+    np.testing.assert_array_equal(pred, (data[0] / 10000. > 0.05).astype('uint8'))
+
+
+def test_run_sharded_inference(tmp_path):
+    scene_path = tmp_path / "combined_4band.tif"
+    write_scene(scene_path, 96, 96)
+    patch_dir = tmp_path / "patches"
+    split_and_save_patches(str(scene_path), str(patch_dir), patch_size=32)
+
+    empty = tmp_path / "empty.pth"
+    torch.save({}, empty)
+    weights = tmp_path / "weights.pth"
+    torch.save(load_model(str(empty)).state_dict(), weights)
+
+    out_dir = tmp_path / "inference_outputs"
+    cache = PredictionCache(str(tmp_path / "cache"), "model")
+    prefilter = PatchPrefilter()
+    count = run_sharded_inference("eager", str(weights), SentinelDataset(str(patch_dir), raw=True), str(out_dir),
+                                  workers=2, threads_per_worker=1, batch_size=2, loader_workers=1, cache=cache,
+                                  prefilter=prefilter)
+
+    assert count == 9
+    assert sorted(p.name for p in out_dir.glob("*.tif")) == sorted(f"pred_{p.name}" for p in patch_dir.glob("*.tif"))
+    # The counters of both workers are added up in the parent's cache and prefilter
+    assert sum(prefilter.counts.values()) == 9
+    assert (cache.hits, cache.misses) == (0, prefilter.counts["model"])
+
+
+class CountingModel(ThresholdModel):
+    def __init__(self):
+        super().__init__()
+        self.seen = 0
+
+    def forward(self, x):
+        self.seen += x.shape[0]
+        return super().forward(x)
+
+
+def test_prediction_writer_keeps_the_loop_error():
+    def _fail(*args):
+        raise IOError("disk full")
+
+    # A failing loop keeps its own error, even when a write has failed too
+    with pytest.raises(RuntimeError):
+        with PredictionWriter(_fail, num_workers=1) as writer:
+            writer.submit(0)
+            raise RuntimeError("out of memory")
+    assert isinstance(writer.errors[0], IOError)
+
+    # Leaving normally still surfaces the write error
+    with pytest.raises(IOError):
+        with PredictionWriter(_fail, num_workers=1) as writer:
+            writer.submit(0)
+
+
+def test_run_inference_prefilter(tmp_path):
+    # Four 64px patches side by side: empty, open water, land, and a water/land boundary
+    data = np.zeros((4, 64, 256), dtype=np.uint16)
+    data[:, :, 64:128] = np.array([300, 900, 400, 100])[:, None, None]  # green >> NIR: water
+    data[:, :, 128:192] = np.array([300, 500, 400, 3000])[:, None, None]  # NIR >> green: land
+    data[:, :, 192:] = np.array([300, 500, 400, 3000])[:, None, None]
+    data[:, :32, 192:] = np.array([300, 900, 400, 100])[:, None, None]
+    data[:, 0, 64] = 0  # a nodata pixel inside the water patch
+    scene_path = tmp_path / "combined_4band.tif"
+    with rasterio.open(scene_path, 'w', driver='GTiff', height=64, width=256, count=4,
+                       dtype='uint16', crs='EPSG:4326', transform=from_origin(0, 64, 1, 1)) as dst:
+        dst.write(data)
+    patch_dir = tmp_path / "patches"
+    split_and_save_patches(str(scene_path), str(patch_dir), patch_size=64, skip_nodata=False)
+
+    model, prefilter = CountingModel(), PatchPrefilter()
+    dataloader = DataLoader(SentinelDataset(str(patch_dir), raw=True), batch_size=4)
+    out_dir = tmp_path / "inference_outputs"
+    assert run_inference(model, dataloader, str(out_dir), "cpu", prefilter=prefilter) == 4
+
+    assert model.seen == 1
+    assert prefilter.counts == {"nodata": 1, "water": 1, "land": 1, "model": 1}
+    preds = []
+    for i in range(4):
+        with rasterio.open(out_dir / f"pred_patch_{i:05d}.tif") as src:
+            preds.append(src.read(1))
+    assert (preds[0] == 255).all()
+    assert preds[1][0, 0] == 255 and (preds[1].flatten()[1:] == 1).all()
+    assert (preds[2] == 0).all()
+
+
+def test_run_adaptive_inference_refines_boundary_windows(tmp_path):
+    # Water (bright first band) left of column 100, land right of it
+    data = np.full((4, 256, 256), 100, dtype=np.uint16)
+    data[0, :, :100] = 1000
+    scene_path = tmp_path / "combined_4band.tif"
+    with rasterio.open(scene_path, 'w', driver='GTiff', height=256, width=256, count=4,
+                       dtype='uint16', crs='EPSG:4326', transform=from_origin(0, 256, 1, 1)) as dst:
+        dst.write(data)
+
+    model = CountingModel()
+    out_path = tmp_path / "stitched_output.tif"
+    # The stand-in model's softmax confidence is 0.73
+    report = run_adaptive_inference(model, str(scene_path), str(out_path), "cpu", patch_size=64, factor=4,
+                                    min_confidence=0.7, compare=True)
+
+    # Only the column of windows holding the shoreline is refined
+    assert report["windows"] == 16 and report["refined"] == 4
+    assert report["full_res_passes_avoided"] == 0.75
+    assert report["pixel_agreement"] == 1.0 and report["water_iou"] == 1.0
+    with rasterio.open(out_path) as src:
+        np.testing.assert_array_equal(src.read(1), (data[0] == 1000).astype('uint8'))
+
+
+def test_run_adaptive_inference_coarse_pass_stays_in_aoi(tmp_path):
+    data = np.full((4, 512, 512), 100, dtype=np.uint16)
+    data[0, :, :40] = 1000
+    scene_path = tmp_path / "combined_4band.tif"
+    with rasterio.open(scene_path, 'w', driver='GTiff', height=512, width=512, count=4, dtype='uint16',
+                       crs='EPSG:4326', transform=from_origin(0, 64, 0.125, 0.125)) as dst:
+        dst.write(data)
+    # The top-left 50 x 50 pixels
+    aoi_path = tmp_path / "aoi.geojson"
+    aoi_path.write_text(json.dumps({"type": "FeatureCollection", "features": [{
+        "type": "Feature", "properties": {},
+        "geometry": {"type": "Polygon", "coordinates": [[[0, 57.75], [6.25, 57.75], [6.25, 64], [0, 64], [0, 57.75]]]},
+    }]}))
+
+    model = CountingModel()
+    out_path = tmp_path / "stitched_output.tif"
+    report = run_adaptive_inference(model, str(scene_path), str(out_path), "cpu", patch_size=32, factor=4,
+                                    min_confidence=0.7, aoi_path=str(aoi_path), cog=False)
+
+    # One coarse tile around the AOI instead of the 16 of the whole downsampled scene
+    assert report["windows"] == 4 and report["refined"] == 2
+    assert model.seen == 1 + report["refined"]
+    with rasterio.open(out_path) as src:
+        np.testing.assert_array_equal(src.read(1, window=Window(0, 0, 64, 64)), (data[0, :64, :64] == 1000))
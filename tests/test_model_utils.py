@@ -0,0 +1,28 @@
+import sys
+import torch
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from model_utils import load_model, model_input_channels
+from preprocessing import prepare_batch
+
+
+def test_fold_channels_matches_padded_input(tmp_path):
+    # Randomly initialized weights stand in for the trained model
+    empty = tmp_path / "empty.pth"
+    torch.save({}, empty)
+    weights = tmp_path / "weights.pth"
+    torch.save(load_model(str(empty)).state_dict(), weights)
+
+    model = load_model(str(weights)).eval()
+    folded = load_model(str(weights), fold_channels=True).eval()
+    assert model_input_channels(model) == 6
+    assert model_input_channels(folded) == 4
+
+    raw = torch.randint(0, 20000, (2, 4, 64, 64), dtype=torch.int32).to(torch.int16)
+    with torch.no_grad():
+        expected = model(prepare_batch(raw, out_channels=6))['out']
+        actual = folded(prepare_batch(raw, out_channels=4))['out']
+
+    torch.testing.assert_close(actual, expected, rtol=1e-4, atol=1e-4)
@@ -0,0 +1,94 @@
+import os
+import sys
+import argparse
+import numpy as np
+import rasterio
+import torch
+from rasterio.transform import from_origin
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from util import split_and_save_patches
+from model_utils import load_model
+from pipeline import run_stage, run_inference_stage, run_reprojection_stages, load_manifest
+
+
+def test_run_stage_skips_until_inputs_change(tmp_path):
+    src = tmp_path / "input.txt"
+    dst = tmp_path / "output.txt"
+    src.write_text("a")
+    calls = []
+
+    def copy():
+        calls.append(1)
+        dst.write_text(src.read_text())
+
+    manifests = str(tmp_path / "manifests")
+    assert run_stage(manifests, "copy", [str(src)], {"n": 1}, [str(dst)], copy)
+    assert not run_stage(manifests, "copy", [str(src)], {"n": 1}, [str(dst)], copy)
+    assert run_stage(manifests, "copy", [str(src)], {"n": 2}, [str(dst)], copy)  # parameters changed
+
+    src.write_text("changed")
+    assert run_stage(manifests, "copy", [str(src)], {"n": 2}, [str(dst)], copy, checksum=True)
+    dst.unlink()
+    assert run_stage(manifests, "copy", [str(src)], {"n": 2}, [str(dst)], copy, checksum=True)
+    assert len(calls) == 4
+
+
+def test_run_reprojection_stages(tmp_path):
+    band_paths, proj_paths = {}, {}
+    for b in ("02", "03"):
+        band_paths[b] = str(tmp_path / f"T33_B{b}_10m.tif")
+        proj_paths[b] = str(tmp_path / f"T33_B{b}_10m_wgs84.tif")
+        with rasterio.open(band_paths[b], 'w', driver='GTiff', height=100, width=100, count=1, dtype='uint16',
+                           crs='EPSG:32633', transform=from_origin(500000, 4000000, 10, 10)) as dst:
+            dst.write(np.full((1, 100, 100), int(b), dtype=np.uint16))
+
+    manifests = str(tmp_path / "manifests")
+    assert run_reprojection_stages(manifests, band_paths, proj_paths) == ["02", "03"]
+    assert all(load_manifest(manifests, f"re_projection_B{b}")["completed"] for b in band_paths)
+    assert run_reprojection_stages(manifests, band_paths, proj_paths) == []
+
+    # Only the band whose input changed is reprojected again
+    with rasterio.open(band_paths["03"], 'r+') as dst:
+        dst.write(np.full((1, 100, 100), 7, dtype=np.uint16))
+    assert run_reprojection_stages(manifests, band_paths, proj_paths, checksum=True) == ["02", "03"]
+    assert run_reprojection_stages(manifests, band_paths, proj_paths, checksum=True) == []
+    with rasterio.open(band_paths["03"], 'r+') as dst:
+        dst.write(np.full((1, 100, 100), 8, dtype=np.uint16))
+    assert run_reprojection_stages(manifests, band_paths, proj_paths, checksum=True) == ["03"]
+    with rasterio.open(proj_paths["03"]) as src:
+        assert src.crs.to_string() == "EPSG:4326" and src.read(1).max() == 8
+
+
+def test_run_inference_stage_resumes(tmp_path):
+    data = np.random.randint(0, 1000, (4, 64, 64), dtype=np.uint16)
+    scene_path = tmp_path / "combined_4band.tif"
+    with rasterio.open(scene_path, 'w', driver='GTiff', height=64, width=64, count=4,
+                       dtype='uint16', crs='EPSG:4326', transform=from_origin(0, 64, 1, 1)) as dst:
+        dst.write(data)
+    patch_dir = tmp_path / "patches"
+    split_and_save_patches(str(scene_path), str(patch_dir), patch_size=32)
+
+    empty = tmp_path / "empty.pth"
+    torch.save({}, empty)
+    weights = tmp_path / "weights.pth"
+    torch.save(load_model(str(empty)).state_dict(), weights)
+    args = argparse.Namespace(weights=str(weights), engine="eager", blend=False, batch_size=2)
+
+    manifests, out_dir = str(tmp_path / "manifests"), tmp_path / "inference_outputs"
+    assert run_inference_stage(manifests, str(patch_dir), str(out_dir), args, chunk_size=2) == 4
+    assert run_inference_stage(manifests, str(patch_dir), str(out_dir), args) == 0
+
+    # A lost prediction and a changed patch are the only work left
+    os.remove(out_dir / "pred_patch_00001.tif")
+    with rasterio.open(patch_dir / "patch_00002.tif", 'r+') as patch:
+        patch.write(patch.read() + 1)
+    assert run_inference_stage(manifests, str(patch_dir), str(out_dir), args) == 2
+
+    # Predictions of removed patches and of the other mode are cleared before stitching
+    os.remove(patch_dir / "patch_00003.tif")
+    (out_dir / "prob_patch_00000.tif").write_bytes(b"")
+    assert run_inference_stage(manifests, str(patch_dir), str(out_dir), args) == 0
+    assert sorted(p.name for p in out_dir.iterdir()) == [f"pred_patch_0000{i}.tif" for i in range(3)]
@@ -0,0 +1,131 @@
+import sys
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from stitching import (
+    edge_weights,
+    stitch_blended_patches,
+    stitch_tiff_patches,
+    stitch_tiff_patches_blockwise,
+    read_mask_bbox,
+    NODATA_LABEL,
+)
+
+
+def write_patch(path, data, left, top):
+    with rasterio.open(path, 'w', driver='GTiff', height=data.shape[1], width=data.shape[2],
+                       count=data.shape[0], dtype=data.dtype, crs='EPSG:4326',
+                       transform=from_origin(left, top, 1, 1)) as dst:
+        dst.write(data)
+
+
+def test_edge_weights_taper():
+    weights = edge_weights(32, 32, overlap=8, mode="cosine")
+
+    assert weights.shape == (32, 32)
+    assert weights[16, 16] == 1
+    assert 0 < weights[0, 0] < weights[4, 4] < 1
+    np.testing.assert_allclose(weights, weights[::-1, ::-1])
+
+
+def test_stitch_blended_patches(tmp_path):
+    # Two 2-class patches overlapping by 8 columns; the left one is confident about
+    # class 1, the right one mildly prefers class 0
+    left = np.zeros((2, 16, 24), dtype='uint8')
+    left[1] = 230
+    left[0] = 25
+    right = np.zeros((2, 16, 24), dtype='uint8')
+    right[0] = 140
+    right[1] = 115
+    write_patch(tmp_path / "prob_patch_00000.tif", left, 0, 16)
+    write_patch(tmp_path / "prob_patch_00001.tif", right, 16, 16)
+
+    out_path = tmp_path / "stitched.tif"
+    stitch_blended_patches(str(tmp_path), str(out_path), overlap=8, strip_height=5)
+
+    with rasterio.open(out_path) as src:
+        assert src.shape == (16, 40)
+        labels = src.read(1)
+
+    assert NODATA_LABEL not in labels
+    assert (labels[:, :16] == 1).all()
+    assert (labels[:, 32:] == 0).all()
+    # The seam moves to where the right patch's weight overtakes the left one
+    assert 16 < np.argmin(labels[8]) < 32
+
+
+def test_stitch_picks_patches_of_its_mode(tmp_path):
+    # main.py writes label and probability patches of both modes into the same directory
+    write_patch(tmp_path / "pred_patch_00000.tif", np.ones((1, 16, 16), dtype='uint8'), 0, 16)
+    write_patch(tmp_path / "prob_patch_00000.tif", np.stack([np.full((16, 16), 200, 'uint8'),
+                                                             np.full((16, 16), 55, 'uint8')]), 0, 16)
+
+    stitch_blended_patches(str(tmp_path), str(tmp_path / "blended.tif"), overlap=0)
+    stitch_tiff_patches_blockwise(str(tmp_path), str(tmp_path / "labels.tif"))
+    with rasterio.open(tmp_path / "blended.tif") as blended, rasterio.open(tmp_path / "labels.tif") as labels:
+        assert (blended.read(1) == 0).all()
+        assert (labels.read(1) == 1).all()
+
+    write_patch(tmp_path / "prob_patch_00001.tif", np.zeros((3, 16, 16), dtype='uint8'), 16, 16)
+    with pytest.raises(ValueError):
+        stitch_blended_patches(str(tmp_path), str(tmp_path / "blended.tif"))
+
+
+def test_stitch_tiff_patches_blockwise_matches_merge(tmp_path):
+    # Overlapping patches cut from one label map, so the result does not depend on
+    # which patch wins in the overlaps
+    labels = np.random.randint(0, 2, (1, 64, 84), dtype='uint8')
+    patch_dir = tmp_path / "patches"
+    patch_dir.mkdir()
+    count = 0
+    for top in range(0, 41, 20):
+        for left in range(0, 61, 20):
+            write_patch(patch_dir / f"pred_patch_{count:05d}.tif",
+                        labels[:, top:top + 24, left:left + 24], left, 64 - top)
+            count += 1
+
+    merged_path = tmp_path / "merged.tif"
+    blockwise_path = tmp_path / "blockwise.tif"
+    stitch_tiff_patches(str(patch_dir), str(merged_path))
+    stitch_tiff_patches_blockwise(str(patch_dir), str(blockwise_path), max_memory_mb=0, tile_size=16)
+
+    with rasterio.open(merged_path) as merged, rasterio.open(blockwise_path) as blockwise:
+        assert blockwise.transform == merged.transform
+        assert blockwise.block_shapes[0] == (16, 16)
+        np.testing.assert_array_equal(blockwise.read(), merged.read())
+        np.testing.assert_array_equal(blockwise.read(), labels)
+
+
+def test_stitched_cog_and_bbox_query(tmp_path):
+    # A 1024 x 1280 label map cut into 256px prediction patches
+    labels = (np.random.rand(1024, 1280) > 0.5).astype('uint8')
+    patch_dir = tmp_path / "inference_outputs"
+    patch_dir.mkdir()
+    for top in range(0, 1024, 256):
+        for left in range(0, 1280, 256):
+            write_patch(patch_dir / f"pred_patch_{top}_{left}.tif", labels[None, top:top + 256, left:left + 256],
+                        left, 1024 - top)
+
+    out_path = tmp_path / "stitched_output.tif"
+    stitch_tiff_patches_blockwise(str(patch_dir), str(out_path), max_memory_mb=1, compress="zstd")
+    assert not (tmp_path / "stitched_output.tif.tiled.tif").exists()
+
+    with rasterio.open(out_path) as src:
+        assert src.tags(ns="IMAGE_STRUCTURE")["LAYOUT"] == "COG"
+        assert src.block_shapes[0] == (512, 512)
+        assert src.overviews(1) == [2, 4]
+        np.testing.assert_array_equal(src.read(1), labels)
+
+    # bbox in map units: x 100.5-300, y 624-900.2 -> rows 123.8-400, cols 100.5-300, rounded outwards
+    window_labels, transform = read_mask_bbox(str(out_path), (100.5, 624, 300, 900.2))
+    np.testing.assert_array_equal(window_labels, labels[123:400, 100:300])
+    assert transform == from_origin(100, 901, 1, 1)
+
+    preview, transform = read_mask_bbox(str(out_path), (0, 0, 1280, 1024), max_size=640)
+    assert preview.shape == (512, 640)
+    assert transform.a == 2
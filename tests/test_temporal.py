@@ -0,0 +1,114 @@
+import sys
+import json
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from temporal import TemporalState, NO_CHANGE, LAND_TO_WATER, WATER_TO_LAND, _update_tile
+from stitching import NODATA_LABEL
+
+
+def write_mask(path, labels, left=10.0, top=50.0, res=0.001):
+    with rasterio.open(path, 'w', driver='GTiff', height=labels.shape[0], width=labels.shape[1], count=1,
+                       dtype='uint8', crs='EPSG:4326', transform=from_origin(left, top, res, res),
+                       nodata=NODATA_LABEL) as dst:
+        dst.write(labels, 1)
+    return str(path)
+
+
+def test_incremental_change_detection(tmp_path):
+    # Water on the left of column 20, then the water advances to column 30
+    first = np.zeros((64, 64), dtype='uint8')
+    first[:, :20] = 1
+    second = np.zeros((64, 64), dtype='uint8')
+    second[:, :30] = 1
+    second[:8] = NODATA_LABEL  # e.g. clouds
+
+    first_path = write_mask(tmp_path / "first.tif", first)
+    state = TemporalState.open(str(tmp_path / "state"), reference_path=first_path, tile_size=32)
+    assert len(state.tiles) == 4
+
+    state.ingest("S1", "2021-07-01", first_path, workers=2)
+    assert json.loads((tmp_path / "state" / "temporal.json").read_text())["scenes"][0]["id"] == "S1"
+    with rasterio.open(tmp_path / "state" / "changes" / "S1.tif") as src:
+        assert (src.read(1) == NODATA_LABEL).all()  # nothing to compare against yet
+
+    state = TemporalState(str(tmp_path / "state"))
+    report = state.ingest("S2", "2021-07-06", write_mask(tmp_path / "second.tif", second), workers=2)
+    assert report["land_to_water"] == 10 * 56
+    assert report["water_to_land"] == 0
+    with rasterio.open(tmp_path / "state" / "changes" / "S2.tif") as src:
+        change = src.read(1)
+    assert (change[8:, 20:30] == LAND_TO_WATER).all()
+    assert (change[8:, 30:] == NO_CHANGE).all() and (change[8:, :20] == NO_CHANGE).all()
+    assert (change[:8] == NODATA_LABEL).all()
+
+    # A revisit covering only the right part of the grid, shifted by 16 pixels
+    third = np.full((64, 48), 0, dtype='uint8')
+    state.ingest("S3", "2021-07-11", write_mask(tmp_path / "third.tif", third, left=10.016), workers=1)
+    with rasterio.open(tmp_path / "state" / "changes" / "S3.tif") as src:
+        change = src.read(1)
+    assert (change[8:, 16:30] == WATER_TO_LAND).all()
+    assert (change[:, :16] == NODATA_LABEL).all()
+
+    # Already ingested scenes are skipped, older ones refused
+    assert state.ingest("S2", "2021-07-06", str(tmp_path / "second.tif")) is None
+    with pytest.raises(ValueError):
+        state.ingest("S0", "2021-06-01", first_path)
+
+    state.composite(str(tmp_path / "composite.tif"))
+    with rasterio.open(tmp_path / "composite.tif") as src:
+        frequency, last_label = src.read()
+    assert frequency[20, 5] == 100  # water in S1 and S2, not covered by S3
+    assert frequency[20, 25] == 33  # water only in S2
+    assert frequency[4, 25] == 0  # land in S1 and S3, clouded in S2
+    assert last_label[20, 5] == 1 and last_label[20, 25] == 0
+
+
+def _interrupt_ingest(state, scene_id, date, mask_path, tiles):
+    # What an ingest leaves behind when it dies after updating some of its tiles
+    state.ingesting = {"id": scene_id, "date": date, "mask": mask_path}
+    state._save()
+    grid = {"crs": state.crs, "transform": state.transform, "width": state.width, "height": state.height}
+    for tile in tiles:
+        _update_tile(state.state_dir, grid, tile, state.tiles[tile], mask_path, scene_id, 1, 0)
+
+
+def test_interrupted_ingest_resumes_or_rolls_back(tmp_path):
+    first = np.zeros((64, 64), dtype='uint8')
+    first[:, :20] = 1
+    second = np.zeros((64, 64), dtype='uint8')
+    second[:, :30] = 1
+    first_path = write_mask(tmp_path / "first.tif", first)
+    second_path = write_mask(tmp_path / "second.tif", second)
+
+    state = TemporalState.open(str(tmp_path / "state"), reference_path=first_path, tile_size=32)
+    state.ingest("S1", "2021-07-01", first_path, workers=1)
+    _interrupt_ingest(state, "X", "2021-07-03", first_path, [(0, 0), (1, 0)])
+
+    # Another scene must not take over the tiles the interrupted ingest updated
+    state = TemporalState(str(tmp_path / "state"))
+    with pytest.raises(RuntimeError):
+        state.ingest("S2", "2021-07-06", second_path, workers=1)
+
+    # Resuming the same scene updates the remaining tiles only
+    report = state.ingest("X", "2021-07-03", first_path, workers=1)
+    assert report["compared"] == 64 * 64 and report["land_to_water"] == report["water_to_land"] == 0
+    assert not list((tmp_path / "state" / "tiles").glob("*.prev.npz"))
+
+    # Rolled back, the interrupted scene leaves no trace in the history
+    _interrupt_ingest(state, "Y", "2021-07-04", second_path, [(0, 0), (0, 1)])
+    state = TemporalState(str(tmp_path / "state"))
+    assert state.rollback() == "Y"
+    report = state.ingest("S2", "2021-07-06", second_path, workers=1)
+    assert report["land_to_water"] == 10 * 64
+    assert [scene["id"] for scene in state.scenes] == ["S1", "X", "S2"]
+
+    state.composite(str(tmp_path / "composite.tif"))
+    with rasterio.open(tmp_path / "composite.tif") as src:
+        frequency = src.read(1)
+    assert frequency[5, 5] == 100 and frequency[5, 25] == 33 and frequency[5, 40] == 0
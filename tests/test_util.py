@@ -1,5 +1,6 @@
 
 import sys
+import json
 import pytest
 import numpy as np
 import rasterio
@@ -13,9 +14,14 @@ sys.path.append(str(Path(__file__).resolve().parent.parent))
 from util import (
     find_img_data_folder,
     re_projection,
+    batch_re_projection,
     combine_bands,
+    reproject_merge_clip,
+    cog_output,
     crop_image,
     split_and_save_patches,
+    generate_windows,
+    AOICellMask,
 )
 
 @pytest.fixture
@@ -77,6 +83,20 @@ def test_re_projection(tmp_path, dummy_jp2):
     with rasterio.open(out_path) as src:
         assert src.crs.to_string() == "EPSG:4326"
 
+def test_batch_re_projection(tmp_path, dummy_jp2):
+    out_paths = [tmp_path / "reprojected_a.tif", tmp_path / "reprojected_b.tif"]
+    timings = batch_re_projection([str(dummy_jp2)] * 2, [str(p) for p in out_paths], workers=2)
+    assert set(timings) == {str(p) for p in out_paths}
+
+    reference = tmp_path / "reference.tif"
+    re_projection(str(dummy_jp2), str(reference))
+    with rasterio.open(reference) as ref:
+        for out_path in out_paths:
+            with rasterio.open(out_path) as src:
+                assert src.crs.to_string() == "EPSG:4326"
+                assert src.transform == ref.transform
+                np.testing.assert_array_equal(src.read(), ref.read())
+
 def test_combine_bands(tmp_path, dummy_tif):
     out_path = tmp_path / "combined.tif"
     combine_bands([str(dummy_tif), str(dummy_tif)], str(out_path))
@@ -85,6 +105,67 @@ def test_combine_bands(tmp_path, dummy_tif):
     with rasterio.open(out_path) as src:
         assert src.count == 2
 
+def test_reproject_merge_clip(tmp_path, dummy_jp2):
+    reference = tmp_path / "reference.tif"
+    re_projection(str(dummy_jp2), str(reference))
+
+    out_path = tmp_path / "fused.tif"
+    reproject_merge_clip([str(dummy_jp2)] * 2, str(out_path), block_size=16)
+
+    with rasterio.open(reference) as ref, rasterio.open(out_path) as src:
+        assert src.count == 2
+        assert src.transform == ref.transform
+        assert src.block_shapes[0] == (16, 16)
+        assert src.overviews(1)
+        np.testing.assert_array_equal(src.read(1), ref.read(1))
+        np.testing.assert_array_equal(src.read(2), ref.read(1))
+        left, bottom, right, top = ref.bounds
+
+    # Clip to the lower-left quarter of the scene
+    aoi_path = tmp_path / "aoi.geojson"
+    gpd.GeoDataFrame({'id': [1]}, geometry=[box(left, bottom, (left + right) / 2, (bottom + top) / 2)],
+                     crs='EPSG:4326').to_file(aoi_path)
+    clipped_path = tmp_path / "clipped.tif"
+    reproject_merge_clip([str(dummy_jp2)], str(clipped_path), aoi_path=str(aoi_path), cog=False)
+
+    with rasterio.open(clipped_path) as src:
+        assert src.width < 100 and src.height < 100
+        assert src.profile["tiled"]
+        assert src.read(1).any()
+    assert not (tmp_path / "fused.tif.tiled.tif").exists()
+
+    # A failing write leaves neither the output nor the scene-sized intermediate behind
+    with pytest.raises(rasterio.errors.RasterioIOError):
+        reproject_merge_clip([str(dummy_jp2), str(tmp_path / "missing.jp2")], str(tmp_path / "failed.tif"))
+    with pytest.raises(RuntimeError):
+        with cog_output(str(tmp_path / "failed.tif")) as tiled_path:
+            with rasterio.open(reference) as ref, rasterio.open(tiled_path, "w", **ref.profile) as dst:
+                dst.write(ref.read())
+            raise RuntimeError("interrupted")
+    assert not list(tmp_path.glob("failed.tif*"))
+
+def test_combine_bands_in_memory(tmp_path, dummy_multi_band_tif):
+    band_path = tmp_path / "band2.tif"
+    with rasterio.open(dummy_multi_band_tif) as src:
+        profile = src.profile
+        profile.update(count=1)
+        expected = src.read(2)
+    with rasterio.open(band_path, 'w', **profile) as dst:
+        dst.write(expected, 1)
+
+    memfile = combine_bands([str(band_path)] * 3, block_size=32)
+    with memfile.open() as src:
+        assert src.count == 3
+        assert src.block_shapes[0] == (32, 32)
+        assert src.compression is not None
+        np.testing.assert_array_equal(src.read(3), expected)
+
+    # The /vsimem/ path can be handed to the next stage directly
+    patch_dir = tmp_path / "patches"
+    split_and_save_patches(memfile.name, str(patch_dir), patch_size=64)
+    assert len(list(patch_dir.glob("*.tif"))) == 4
+    memfile.close()
+
 def test_crop_image(tmp_path, dummy_tif, dummy_geojson):
     out_path = tmp_path / "cropped.tif"
     crop_image(str(dummy_tif), str(dummy_geojson), str(out_path))
@@ -106,8 +187,63 @@ def test_split_and_save_patches(tmp_path, dummy_multi_band_tif):
         assert patch.width == 64
         assert patch.height == 64
 
+def test_split_and_save_patches_npy_skips_nodata(tmp_path, dummy_multi_band_tif):
+    with rasterio.open(dummy_multi_band_tif, 'r+') as src:
+        data = src.read()
+        data[:, :64, :64] = 0  # one all-nodata patch
+        src.write(data)
+
+    tif_dir = tmp_path / "tif_patches"
+    npy_dir = tmp_path / "npy_patches"
+    assert split_and_save_patches(str(dummy_multi_band_tif), str(tif_dir), patch_size=64) == 3
+    assert split_and_save_patches(str(dummy_multi_band_tif), str(npy_dir), patch_size=64, output_format="npy") == 3
+
+    with open(npy_dir / "patches.json") as f:
+        index = json.load(f)
+    patches = np.memmap(npy_dir / "patches.dat", dtype=index["dtype"], mode="r", shape=tuple(index["shape"]))
+    assert patches.shape == (3, 3, 64, 64)
+
+    for i, entry in enumerate(index["patches"]):
+        with rasterio.open(tif_dir / f"{entry['name']}.tif") as patch:
+            np.testing.assert_array_equal(patch.read(), patches[i])
+            assert list(patch.transform)[:6] == entry["transform"]
+
 def test_find_img_data_folder(tmp_path):
     safe_dir = tmp_path / "S2_test.SAFE" / "GRANULE" / "IMG_DATA"
     safe_dir.mkdir(parents=True)
     found = find_img_data_folder(str(tmp_path))
     assert "IMG_DATA" in found
+
+def test_generate_windows_covers_image():
+    windows = generate_windows(130, 100, patch_size=64, overlap=8)
+
+    assert all(w.width == 64 and w.height == 64 for w in windows)
+    covered = np.zeros((100, 130), dtype=bool)
+    for w in windows:
+        covered[w.row_off:w.row_off + w.height, w.col_off:w.col_off + w.width] = True
+    assert covered.all()
+
+
+
+def test_split_and_save_patches_aoi(tmp_path, dummy_multi_band_tif, dummy_geojson):
+    # The AOI is the bottom-left 50x50 pixels: only one of the four 64px patches touches it
+    patch_dir = tmp_path / "patches"
+    assert split_and_save_patches(str(dummy_multi_band_tif), str(patch_dir), patch_size=64,
+                                  aoi_path=str(dummy_geojson)) == 1
+    with rasterio.open(next(patch_dir.glob("*.tif"))) as patch, rasterio.open(dummy_multi_band_tif) as src:
+        assert patch.bounds == (0, 0, 64, 64)
+        np.testing.assert_array_equal(patch.read(), src.read(window=rasterio.windows.Window(0, 64, 64, 64)))
+
+    # A 20px buffer reaches into the other three
+    assert split_and_save_patches(str(dummy_multi_band_tif), str(tmp_path / "buffered"), patch_size=64,
+                                  aoi_path=str(dummy_geojson), aoi_buffer=20) == 4
+
+
+def test_generate_windows_aoi(dummy_multi_band_tif, dummy_geojson):
+    with rasterio.open(dummy_multi_band_tif) as src:
+        aoi_mask = AOICellMask(str(dummy_geojson), src.transform, src.width, src.height, crs=src.crs, cell_size=16)
+
+    windows = generate_windows(128, 128, patch_size=32, aoi_mask=aoi_mask)
+    # 50 px of AOI span 4 of the 16px cells and 2 of the 32px windows per side
+    assert aoi_mask.fraction == 16 / 64
+    assert [(w.col_off, w.row_off) for w in windows] == [(0, 64), (32, 64), (0, 96), (32, 96)]
@@ -2,14 +2,26 @@
 # Extract the Sentinel 2 data by bands and merge into one imagery
 
 import os
+import math
+import time
+import json
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import numpy as np
 import rasterio
+import rasterio.shutil
+from rasterio.io import MemoryFile
 from rasterio.merge import merge
-from rasterio.warp import calculate_default_transform, reproject, Resampling
-import fiona
+from rasterio.warp import calculate_default_transform, reproject, transform_geom, Resampling
+from rasterio.vrt import WarpedVRT
+from rasterio.features import geometry_mask, rasterize
 from rasterio.mask import mask
-from rasterio.windows import Window
+from rasterio.windows import Window, from_bounds
+from shapely.geometry import shape, mapping
 from tqdm import tqdm
 
+from instrumentation import metrics, timed
+
 
 def find_img_data_folder(root_path):
     """
@@ -30,18 +42,34 @@ def find_img_data_folder(root_path):
     return None  # Not found
 
 
-def re_projection(intif, outtif):
+def compute_dst_grid(intif, dst_crs='EPSG:4326'):
+    """
+    Compute the destination grid (transform, width, height) of a reprojection
+
+    :param intif: input imagery path
+    :param dst_crs: target CRS
+    :return: (transform, width, height)
+    """
+    with rasterio.open(intif) as src:
+        return calculate_default_transform(src.crs, dst_crs, src.width, src.height, *src.bounds)
+
+
+@timed("re_projection")
+def re_projection(intif, outtif, dst_crs='EPSG:4326', dst_grid=None, num_threads=1):
     """
     Image reprojection to project the raw imagery bands into WGS-84
 
     :param intif: input imagery path
     :param outtif: reprojected imagery
+    :param dst_crs: target CRS
+    :param dst_grid: precomputed (transform, width, height) of the output, see compute_dst_grid
+    :param num_threads: number of GDAL warp threads
     :return:
     """
-    dst_crs = 'EPSG:4326'
-
     src = rasterio.open(intif, driver='JP2OpenJPEG')
-    transform, width, height = calculate_default_transform(src.crs, dst_crs, src.width, src.height, *src.bounds)
+    if dst_grid is None:
+        dst_grid = calculate_default_transform(src.crs, dst_crs, src.width, src.height, *src.bounds)
+    transform, width, height = dst_grid
     kwargs = src.meta.copy()
     kwargs.update({
         'crs': dst_crs,
@@ -51,6 +79,9 @@ def re_projection(intif, outtif):
         'driver': 'GTiff'
     })
 
+    metrics.count("re_projection.bytes_read", src.width * src.height * src.count * np.dtype(src.dtypes[0]).itemsize)
+    metrics.count("re_projection.bytes_written", width * height * src.count * np.dtype(src.dtypes[0]).itemsize)
+
     with rasterio.open(outtif, 'w', **kwargs) as dst:
         for i in range(1, src.count + 1):
             reproject(
@@ -60,16 +91,314 @@ def re_projection(intif, outtif):
                 src_crs=src.crs,
                 dst_transform=transform,
                 dst_crs=dst_crs,
-                resampling=Resampling.nearest)
+                resampling=Resampling.nearest,
+                num_threads=num_threads)
+
+    src.close()
+
+
+def _timed_re_projection(intif, outtif, dst_crs, dst_grid, num_threads):
+    start = time.perf_counter()
+    re_projection(intif, outtif, dst_crs=dst_crs, dst_grid=dst_grid, num_threads=num_threads)
+    return time.perf_counter() - start
 
 
-def combine_bands(band_paths, output_path):
+def batch_re_projection(in_paths, out_paths, dst_crs='EPSG:4326', workers=None, num_threads=None, on_done=None):
     """
-    The raw imagery are downloaded as individual band, merge the band into a multisplectral imagery
-    :param band_paths: path to all band info
+    Reproject several bands concurrently in a process pool.
+
+    Bands that share the same source grid (e.g. the Sentinel-2 10m bands) share a single
+    destination grid, which is computed once instead of once per band.
+
+    :param in_paths: input imagery paths
+    :param out_paths: reprojected imagery paths, one per input
+    :param dst_crs: target CRS
+    :param workers: number of worker processes (default: one per band, up to the CPU count)
+    :param num_threads: GDAL warp threads per worker (default: spread the CPUs over the workers)
+    :param on_done: optional callback(in_path, out_path, seconds), called as each band finishes
+    :return: dict of output path -> reprojection time in seconds
+    """
+    if not in_paths:
+        return {}
+
+    cpus = os.cpu_count() or 1
+    workers = workers or min(len(in_paths), cpus)
+    num_threads = num_threads or max(1, cpus // workers)
+
+    # Plan the warp once per distinct source grid
+    grids = {}
+    dst_grids = []
+    for path in in_paths:
+        with rasterio.open(path) as src:
+            key = (src.crs.to_string(), tuple(src.transform), src.width, src.height)
+        if key not in grids:
+            grids[key] = compute_dst_grid(path, dst_crs)
+        dst_grids.append(grids[key])
+
+    timings = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(_timed_re_projection, intif, outtif, dst_crs, grid, num_threads): (intif, outtif)
+            for intif, outtif, grid in zip(in_paths, out_paths, dst_grids)
+        }
+        for future in as_completed(futures):
+            intif, outtif = futures[future]
+            timings[outtif] = future.result()
+            print(f"Reprojected {os.path.basename(intif)} in {timings[outtif]:.1f}s")
+            if on_done is not None:
+                on_done(intif, outtif, timings[outtif])
+
+    return timings
+
+
+def tiled_profile(profile, block_size=512, compress='deflate'):
+    """
+    Copy a raster profile and switch it to a tiled, compressed GeoTIFF layout
+
+    :param profile: rasterio profile
+    :param block_size: internal tile size in pixels (multiple of 16)
+    :param compress: GDAL compression
+    :return: updated profile
+    """
+    profile = profile.copy()
+    profile.update({
+        'driver': 'GTiff',
+        'tiled': True,
+        'blockxsize': block_size,
+        'blockysize': block_size,
+        'compress': compress,
+        'interleave': 'pixel',
+    })
+    if compress in ('deflate', 'lzw', 'zstd'):
+        profile['predictor'] = 2
+    return profile
+
+
+def write_cog(src_path, dst_path, block_size=512, compress='deflate', resampling='nearest'):
+    """
+    Translate a raster into a Cloud-Optimized GeoTIFF (internal tiles + overview pyramid)
+
+    :param src_path: input raster
+    :param dst_path: output COG path
+    :param block_size: internal tile size in pixels
+    :param compress: GDAL compression
+    :param resampling: overview resampling method ('mode' for label masks)
+    :return:
+    """
+    # Same horizontal differencing predictor as tiled_profile
+    predictor = 'YES' if compress.lower() in ('deflate', 'lzw', 'zstd') else 'NO'
+    rasterio.shutil.copy(src_path, dst_path, driver='COG', blocksize=block_size, compress=compress,
+                         predictor=predictor, overview_resampling=resampling)
+
+
+@contextlib.contextmanager
+def cog_output(output_path, cog=True, block_size=512, compress='deflate', resampling='nearest'):
+    """
+    Path to write a raster to, translated into a COG at output_path once the block is left
+    without error. GDAL can only create COGs by copy, so with cog=True the raster is written to a
+    tiled intermediate next to the output, which is removed whether or not the writing succeeds.
+
+    :param output_path: final output path
+    :param cog: write a COG; with False the raster is written to output_path directly
+    :param block_size: internal tile size of the COG
+    :param compress: GDAL compression
+    :param resampling: overview resampling method ('mode' for label masks)
+    :return: path to write the raster to
+    """
+    if not cog:
+        yield output_path
+        return
+
+    tiled_path = output_path + '.tiled.tif'
+    try:
+        yield tiled_path
+        with metrics.timer("write_cog"):
+            write_cog(tiled_path, output_path, block_size=block_size, compress=compress, resampling=resampling)
+    finally:
+        if os.path.exists(tiled_path):
+            os.remove(tiled_path)
+
+
+def read_aoi_geometries(aoi_path, dst_crs=None):
+    """
+    Read the AOI geometries, optionally transformed into the raster CRS
+
+    :param aoi_path: AOI file path
+    :param dst_crs: target CRS, or None to keep the file CRS
+    :return: list of GeoJSON-like geometries
+    """
+    import fiona
+
+    with fiona.open(aoi_path, "r") as shapefile:
+        aoi_crs = shapefile.crs
+        aoi_geometries = [feature["geometry"] for feature in shapefile]
+
+    if dst_crs is not None and aoi_crs:
+        aoi_geometries = [transform_geom(aoi_crs, dst_crs, geom) for geom in aoi_geometries]
+    return aoi_geometries
+
+
+def geometry_window_from_bounds(geometries, transform, width, height):
+    """
+    Pixel window of a raster grid covering the bounds of the given geometries
+
+    :param geometries: GeoJSON-like geometries in the grid CRS
+    :param transform: grid transform
+    :param width: grid width
+    :param height: grid height
+    :return: rasterio Window, clipped to the grid
+    """
+    bounds = [shape(geom).bounds for geom in geometries]
+    left = min(b[0] for b in bounds)
+    bottom = min(b[1] for b in bounds)
+    right = max(b[2] for b in bounds)
+    top = max(b[3] for b in bounds)
+
+    window = from_bounds(left, bottom, right, top, transform=transform)
+    col_off, row_off = math.floor(window.col_off), math.floor(window.row_off)
+    col_end = math.ceil(window.col_off + window.width)
+    row_end = math.ceil(window.row_off + window.height)
+    window = Window(col_off, row_off, col_end - col_off, row_end - row_off)
+    return window.intersection(Window(0, 0, width, height))
+
+
+class AOICellMask:
+    """
+    The AOI rasterized once onto a coarse grid of `cell_size` x `cell_size` pixel cells of a
+    raster, so whether a window touches the AOI is a lookup of a few cells instead of a
+    geometry test per window.
+    """
+
+    def __init__(self, aoi_path, transform, width, height, crs=None, cell_size=64, buffer=0):
+        """
+        :param aoi_path: AOI file path
+        :param transform: raster transform
+        :param width: raster width
+        :param height: raster height
+        :param crs: raster CRS the AOI is transformed into (None keeps the file CRS)
+        :param cell_size: cell size in pixels
+        :param buffer: buffer around the AOI in pixels
+        """
+        geometries = read_aoi_geometries(aoi_path, dst_crs=crs)
+        if buffer:
+            distance = buffer * max(abs(transform.a), abs(transform.e))
+            geometries = [mapping(shape(geom).buffer(distance)) for geom in geometries]
+
+        self.cell_size = cell_size
+        # all_touched: a cell is kept as soon as the AOI touches any part of it
+        self.cells = rasterize(
+            geometries,
+            out_shape=(math.ceil(height / cell_size), math.ceil(width / cell_size)),
+            transform=transform * transform.scale(cell_size),
+            all_touched=True,
+            dtype='uint8',
+        ).astype(bool)
+
+    @property
+    def fraction(self):
+        """Fraction of the raster cells touched by the AOI."""
+        return float(self.cells.mean())
+
+    def intersects(self, window):
+        """Whether a pixel window touches an AOI cell."""
+        size = self.cell_size
+        row0, col0 = int(window.row_off) // size, int(window.col_off) // size
+        row1 = math.ceil((window.row_off + window.height) / size)
+        col1 = math.ceil((window.col_off + window.width) / size)
+        return bool(self.cells[row0:row1, col0:col1].any())
+
+
+@timed("reproject_merge_clip")
+def reproject_merge_clip(band_paths, output_path, dst_crs='EPSG:4326', aoi_path=None, block_size=512,
+                         compress='deflate', cog=True, num_threads=1):
+    """
+    Fused re_projection + combine_bands + crop_image: warp every raw band straight into its band of
+    one tiled, compressed output, block by block, optionally clipped to the AOI during the warp.
+
+    Only one block per band is held in memory and no per-band or merged intermediates are written.
+    With cog=True the tiled GeoTIFF is translated into a COG at the end (GDAL can only create
+    COGs by copy).
+
+    :param band_paths: raw band paths (e.g. the B02/B03/B04/B08 JP2s), all on the same grid
     :param output_path: output path
+    :param dst_crs: target CRS
+    :param aoi_path: optional AOI file; pixels outside it are set to nodata and the output is
+                     cropped to its bounds
+    :param block_size: internal tile size / processing block size in pixels
+    :param compress: GDAL compression
+    :param cog: write a Cloud-Optimized GeoTIFF
+    :param num_threads: number of GDAL warp threads
     :return:
     """
+    band_data = [rasterio.open(path) for path in band_paths]
+
+    ref = band_data[0]
+    for b in band_data:
+        assert b.width == ref.width and b.height == ref.height, "Band dimensions do not match"
+        assert b.crs == ref.crs, "Band CRS do not match"
+        assert b.transform == ref.transform, "Band transforms do not match"
+
+    transform, width, height = calculate_default_transform(ref.crs, dst_crs, ref.width, ref.height, *ref.bounds)
+
+    aoi_geometries = None
+    if aoi_path:
+        aoi_geometries = read_aoi_geometries(aoi_path, dst_crs)
+        # Shrink the output grid to the AOI bounds
+        aoi_window = geometry_window_from_bounds(aoi_geometries, transform, width, height)
+        transform = rasterio.windows.transform(aoi_window, transform)
+        width, height = int(aoi_window.width), int(aoi_window.height)
+
+    nodata = ref.nodata if ref.nodata is not None else 0
+    profile = tiled_profile(ref.profile, block_size=block_size, compress=compress)
+    profile.update({
+        'crs': dst_crs,
+        'transform': transform,
+        'width': width,
+        'height': height,
+        'count': len(band_data),
+        'nodata': nodata,
+    })
+
+    vrts = [WarpedVRT(src, crs=dst_crs, transform=transform, width=width, height=height,
+                      resampling=Resampling.nearest, nodata=nodata, warp_extras={'NUM_THREADS': num_threads})
+            for src in band_data]
+
+    try:
+        with cog_output(output_path, cog, block_size=block_size, compress=compress) as tiled_path, \
+                rasterio.open(tiled_path, 'w', **profile) as dst:
+            for _, window in tqdm(list(dst.block_windows(1)), desc="Warping blocks"):
+                block = np.stack([vrt.read(1, window=window) for vrt in vrts])
+
+                if aoi_geometries is not None:
+                    outside = geometry_mask(aoi_geometries, out_shape=(window.height, window.width),
+                                            transform=dst.window_transform(window))
+                    block[:, outside] = nodata
+
+                dst.write(block, window=window)
+    finally:
+        for vrt in vrts:
+            vrt.close()
+        for src in band_data:
+            src.close()
+
+    print(f"Fused multiband imagery written to: {output_path}")
+
+
+@timed("combine_bands")
+def combine_bands(band_paths, output_path=None, block_size=512, compress='deflate'):
+    """
+    The raw imagery are downloaded as individual band, merge the band into a multisplectral imagery
+
+    The bands are copied block by block into a tiled, compressed, pixel-interleaved GeoTIFF, so only
+    one block per band is held in memory. Without an output path the result is written to an
+    in-memory file, whose `.name` (a /vsimem/ path) can be passed to the next stage as-is.
+
+    :param band_paths: path to all band info
+    :param output_path: output path, or None to write to a rasterio MemoryFile
+    :param block_size: internal tile size in pixels (multiple of 16)
+    :param compress: GDAL compression
+    :return: the MemoryFile when output_path is None
+    """
     # Open all the input bands
     band_data = [rasterio.open(path) for path in band_paths]
 
@@ -81,18 +410,27 @@ def combine_bands(band_paths, output_path):
         assert b.transform == ref_profile['transform'], "Band transforms do not match"
 
     # Update the profile to write multiple bands
-    out_profile = ref_profile.copy()
+    out_profile = tiled_profile(ref_profile, block_size=block_size, compress=compress)
     out_profile.update(count=len(band_data))
 
+    memfile = MemoryFile() if output_path is None else None
+
     # Write to output file
-    with rasterio.open(output_path, 'w', **out_profile) as dst:
-        for i, src in enumerate(band_data, start=1):
-            dst.write(src.read(1), i)
+    with (memfile.open(**out_profile) if memfile is not None else rasterio.open(output_path, 'w', **out_profile)) as dst:
+        for _, window in dst.block_windows(1):
+            block = np.stack([src.read(1, window=window) for src in band_data])
+            dst.write(block, window=window)
+            metrics.count("combine_bands.bytes_read", block.nbytes)
+            metrics.count("combine_bands.bytes_written", block.nbytes)
 
     # Close all band files
     for src in band_data:
         src.close()
 
+    if memfile is not None:
+        print(f"Combined TIFF written to: {memfile.name}")
+        return memfile
+
     print(f"Combined TIFF written to: {output_path}")
 
 
@@ -105,6 +443,8 @@ def crop_image(tiff_path, aoi_path, output_path):
     :param output_path: output path
     :return:
     """
+    import fiona
+
     with fiona.open(aoi_path, "r") as shapefile:
         aoi_geometries = [feature["geometry"] for feature in shapefile]
 
@@ -128,10 +468,23 @@ def crop_image(tiff_path, aoi_path, output_path):
 
 
 
-def split_and_save_patches(input_tif, output_dir, patch_size=256, overlap=0, bands=None, skip_partial=True):
+def _write_patch(patch_path, patch, meta):
+    with rasterio.open(patch_path, 'w', **meta) as dst:
+        dst.write(patch)
+
+
+@timed("split_and_save_patches")
+def split_and_save_patches(input_tif, output_dir, patch_size=256, overlap=0, bands=None, skip_partial=True,
+                           skip_nodata=True, output_format="tif", workers=4, aoi_path=None, aoi_buffer=0):
     """
     Create image patches for model training/inferencing
 
+    Each row of patches is read from the image once as a full-width strip and the patches are
+    sliced out of it as NumPy views; GeoTIFF patches are written concurrently by a thread pool.
+    With output_format="npy" all patches go into a single raw (N, C, H, W) array, patches.dat,
+    that can be opened with numpy.memmap, plus a patches.json index holding the array
+    shape/dtype, the CRS and every patch's window and transform.
+
     Parameters:
         input_tif (str): Path to input image.
         output_dir (str): Output directory for patches.
@@ -139,13 +492,27 @@ def split_and_save_patches(input_tif, output_dir, patch_size=256, overlap=0, ban
         overlap (int): Overlap between patches in pixels.
         bands (list or None): List of band indices to include (1-based). If None, includes all.
         skip_partial (bool): Skip patches that would go beyond image bounds.
+        skip_nodata (bool): Skip patches where every pixel of every band is nodata (0 if unset).
+        output_format (str): "tif" for one GeoTIFF per patch, "npy" for a single array + index.
+        workers (int): Number of threads writing GeoTIFF patches.
+        aoi_path (str or None): Only write patches intersecting this AOI; pixels outside it are not read.
+        aoi_buffer (int): Buffer around the AOI in pixels.
+
+    Returns:
+        int: Number of patches written.
     """
+    if output_format not in ("tif", "npy"):
+        raise ValueError(f"Unknown output format: {output_format}")
+    if output_format == "npy" and not skip_partial:
+        raise ValueError("npy output needs equally sized patches, use skip_partial=True")
+
     os.makedirs(output_dir, exist_ok=True)
 
     with rasterio.open(input_tif) as src:
         img_width = src.width
         img_height = src.height
         total_bands = src.count if bands is None else len(bands)
+        nodata = src.nodata if src.nodata is not None else 0
 
         step = patch_size - overlap
         count = 0
@@ -153,35 +520,129 @@ def split_and_save_patches(input_tif, output_dir, patch_size=256, overlap=0, ban
         col_steps = range(0, img_width - (patch_size if skip_partial else 0) + 1, step)
         row_steps = range(0, img_height - (patch_size if skip_partial else 0) + 1, step)
 
-        for top in tqdm(row_steps, desc="Processing rows"):
-            for left in col_steps:
-                win_width = min(patch_size, img_width - left)
-                win_height = min(patch_size, img_height - top)
-
-                if skip_partial and (win_width < patch_size or win_height < patch_size):
-                    continue
+        # Metadata shared by every patch, only the window-specific keys change
+        meta = src.meta.copy()
+        meta.update({
+            "driver": "GTiff",
+            "count": total_bands
+        })
 
-                window = Window(left, top, win_width, win_height)
-                transform = src.window_transform(window)
+        aoi_mask = None
+        if aoi_path is not None:
+            aoi_mask = AOICellMask(aoi_path, src.transform, img_width, img_height, crs=src.crs, buffer=aoi_buffer)
+            print(f"AOI covers {aoi_mask.fraction:.1%} of the image")
 
-                # Read only selected bands and window
-                patch = src.read(indexes=bands, window=window) if bands else src.read(window=window)
+        index = []
+        array_file = open(os.path.join(output_dir, "patches.dat"), "wb") if output_format == "npy" else None
+        executor = ThreadPoolExecutor(max_workers=workers)
+        pending = []
 
-                meta = src.meta.copy()
-                meta.update({
-                    "driver": "GTiff",
-                    "height": win_height,
-                    "width": win_width,
-                    "transform": transform,
-                    "count": total_bands
-                })
+        try:
+            for top in tqdm(row_steps, desc="Processing rows"):
+                strip_height = min(patch_size, img_height - top)
+                if skip_partial and strip_height < patch_size:
+                    continue
 
-                patch_path = os.path.join(output_dir, f"patch_{count:05d}.tif")
-                with rasterio.open(patch_path, 'w', **meta) as dst:
-                    dst.write(patch)
+                windows = [Window(left, top, min(patch_size, img_width - left), strip_height) for left in col_steps]
+                windows = [w for w in windows if not (skip_partial and w.width < patch_size)]
+                if aoi_mask is not None:
+                    windows = [w for w in windows if aoi_mask.intersects(w)]
+                if not windows:
+                    continue
 
-                count += 1
+                # Read only selected bands, one strip per row of patches spanning its kept windows
+                strip_left = windows[0].col_off
+                strip_right = windows[-1].col_off + windows[-1].width
+                strip = src.read(indexes=bands, window=Window(strip_left, top, strip_right - strip_left, strip_height))
+                metrics.count("split_and_save_patches.bytes_read", strip.nbytes)
+                submitted = []
+
+                for window in windows:
+                    left, win_width = window.col_off, window.width
+                    patch = strip[:, :, left - strip_left:left - strip_left + win_width]
+                    if skip_nodata and (patch == nodata).all():
+                        continue
+
+                    transform = src.window_transform(window)
+
+                    if array_file is not None:
+                        array_file.write(np.ascontiguousarray(patch).tobytes())
+                        index.append({
+                            "name": f"patch_{count:05d}",
+                            "window": [left, top, win_width, strip_height],
+                            "transform": list(transform)[:6]
+                        })
+                    else:
+                        patch_meta = dict(meta, height=strip_height, width=win_width, transform=transform)
+                        patch_path = os.path.join(output_dir, f"patch_{count:05d}.tif")
+                        submitted.append(executor.submit(_write_patch, patch_path, patch, patch_meta))
+
+                    count += 1
+                    metrics.count("split_and_save_patches.patches")
+                    metrics.count("split_and_save_patches.bytes_written", patch.nbytes)
+
+                # Keep at most two strips in flight so memory stays bounded
+                metrics.gauge("split_and_save_patches.pending_writes", len(pending) + len(submitted))
+                for future in pending:
+                    future.result()
+                pending = submitted
+
+            for future in pending:
+                future.result()
+        finally:
+            executor.shutdown(wait=True)
+            if array_file is not None:
+                array_file.close()
+
+        if output_format == "npy":
+            with open(os.path.join(output_dir, "patches.json"), "w") as f:
+                json.dump({
+                    "shape": [count, total_bands, patch_size, patch_size],
+                    "dtype": src.dtypes[0],
+                    "crs": src.crs.to_wkt() if src.crs else None,
+                    "nodata": src.nodata,
+                    "patches": index
+                }, f)
 
     print(f"{count} patches saved to {output_dir}")
+    return count
+
+
+def generate_windows(img_width, img_height, patch_size=512, overlap=0, aoi_mask=None):
+    """
+    Tile the full image extent with equally sized windows for windowed reading.
+
+    Unlike split_and_save_patches, nothing is skipped at the right/bottom edge: the last
+    column/row of windows is shifted back to end on the image border, so every pixel is
+    covered and every window has the same shape (which keeps batches stackable).
+
+    :param img_width: image width in pixels
+    :param img_height: image height in pixels
+    :param patch_size: window size in pixels (square)
+    :param overlap: overlap between neighbouring windows in pixels
+    :param aoi_mask: optional AOICellMask; only windows intersecting it are kept
+    :return: list of rasterio Windows in row-major order
+    """
+    step = patch_size - overlap
+    if step <= 0:
+        raise ValueError("overlap must be smaller than patch_size")
+
+    def _offsets(size):
+        if size <= patch_size:
+            return [0]
+        offsets = list(range(0, size - patch_size + 1, step))
+        if offsets[-1] + patch_size < size:
+            offsets.append(size - patch_size)
+        return offsets
+
+    win_width = min(patch_size, img_width)
+    win_height = min(patch_size, img_height)
+
+    windows = [Window(left, top, win_width, win_height)
+               for top in _offsets(img_height)
+               for left in _offsets(img_width)]
+    if aoi_mask is not None:
+        windows = [window for window in windows if aoi_mask.intersects(window)]
+    return windows
 
 